@@ -7,7 +7,6 @@ import argparse
 import os
 import sys
 import datetime
-import pkg_resources
 
 script_help = '''A SoS script that defines one or more workflows, in format
     .sos or .ipynb. The script can be a filename or a URL from which the
@@ -101,13 +100,13 @@ def get_convert_parser(desc_only=False):
     parser.set_defaults(func=cmd_convert)
     subparsers = parser.add_subparsers(title='converters (name of converter is not needed from command line)',
                                        dest='converter_name')
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    from .utils import get_plugin_index, load_plugin
+    for name, (spec, _) in get_plugin_index().get('sos_converters', {}).items():
         try:
-            name = entrypoint.name
             if not name.endswith('.parser'):
                 continue
             f_format, t_format = name.rsplit('.', 1)[0].split('-')
-            subparser = add_sub_parser(subparsers, entrypoint.load()(),
+            subparser = add_sub_parser(subparsers, load_plugin(spec)(),
                                        name='{}-{}'.format(f_format, t_format))
             subparser.add_argument('from_file', metavar='FROM', nargs='?',
                                    help='''File to be converted.''')
@@ -119,7 +118,7 @@ def get_convert_parser(desc_only=False):
                     extension of `to_file` filename, but is needed if `to_file` is
                     unspecified.''')
         except Exception as e:
-            print('Failed to load converter {}: {}'.format(entrypoint.name, e))
+            print('Failed to load converter {}: {}'.format(name, e))
     return parser
 
 
@@ -150,34 +149,33 @@ def print_converter_help():
         [x for x in sys.argv[2:] if x != '-h'])
     if from_format is None or to_format is None:
         return
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    from .utils import get_plugin_index, load_plugin
+    for name, (spec, _) in get_plugin_index().get('sos_converters', {}).items():
         try:
-            name = entrypoint.name
             if not name.endswith('.parser'):
                 continue
             f_format, t_format = name.rsplit('.', 1)[0].split('-')
             if from_format != f_format or to_format != t_format:
                 continue
-            parser = entrypoint.load()()
+            parser = load_plugin(spec)()
             sys.exit(parser.print_help())
         except Exception as e:
-            sys.exit('Failed to load converter {}: {}'.format(
-                entrypoint.name, e))
+            sys.exit('Failed to load converter {}: {}'.format(name, e))
 
 
 def cmd_convert(args, unknown_args):
-    from .utils import env, get_traceback
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_converters'):
+    from .utils import env, get_traceback, get_plugin_index, load_plugin
+    for name, (spec, _) in get_plugin_index().get('sos_converters', {}).items():
         try:
-            if entrypoint.name == args.converter_name + '.func':
-                func = entrypoint.load()
+            if name == args.converter_name + '.func':
+                func = load_plugin(spec)
                 func(args.from_file, args.to_file, args, unknown_args)
         except Exception as e:
             # if no other parameter, with option list all
             if args.verbosity and args.verbosity > 2:
                 sys.stderr.write(get_traceback())
             env.logger.error('Failed to execute converter {}: {}'.format(
-                entrypoint.name.rsplit('.', 1)[0], e))
+                name.rsplit('.', 1)[0], e))
             sys.exit(1)
 
 #
@@ -208,6 +206,49 @@ def get_run_parser(interactive=False, with_workflow=True, desc_only=False):
             overrides option "max_running_jobs" of a task queue (option -q)
             so that you can, for example, submit one job at a time (with
             -J 1) to test the task queue.''')
+    parser.add_argument('--max-substeps-per-worker', type=int, metavar='N',
+                        dest='__max_substeps_per_worker__',
+                        help='''Retire a substep worker and start a new one after it has
+            executed N substeps. This limits the accumulation of memory leaked by
+            user code (e.g. R libraries loaded through rpy2) in workflows with a
+            large number of substeps.''')
+    parser.add_argument('--worker-max-rss', metavar='SIZE',
+                        dest='__worker_max_rss__',
+                        help='''Retire a step or substep worker and start a new one, between
+            the execution of steps or substeps, if its resident memory exceeds
+            SIZE (e.g. 4G).''')
+    parser.add_argument('--socket-transport', choices=['ipc', 'tcp'], default='ipc',
+                        dest='__socket_transport__',
+                        help='''Transport of sockets used for the communication between
+            the master process and local workers. SoS uses unix domain sockets
+            (ipc) under a temporary directory by default, and tcp sockets on
+            localhost if ipc is not supported by the system or if tcp is
+            specified.''')
+    parser.add_argument('--trace', metavar='FILE', dest='__trace__',
+                        help='''Record the time spent by the master process, step and
+            substep workers on different stages of the execution of the workflow
+            and save it to FILE in the trace event format, which can be opened
+            by chrome://tracing or other trace viewers.''')
+    parser.add_argument('--metrics', action='store_true', dest='__metrics__',
+                        help='''Keep counters and latency histograms of messages handled
+            by the controller, the depth of the substep queue, and the number
+            of busy substep workers, and output a summary at the end of the
+            execution of the workflow.''')
+    parser.add_argument('--metrics-endpoint', metavar='ENDPOINT', dest='__metrics_endpoint__',
+                        help='''Serve metrics of the controller (implies --metrics) in the
+            plain text format of prometheus during the execution of the workflow,
+            over http if ENDPOINT is a tcp endpoint such as tcp://127.0.0.1:9100,
+            or as replies to any request to a zmq REP socket otherwise (e.g.
+            ipc:///tmp/sos_metrics).''')
+    parser.add_argument('--dag-cache', action='store_true', dest='__dag_cache__',
+                        help='''Reuse the DAG saved by the last successful run of the
+            workflow if the workflow, its parameters, configuration files, and
+            the files and directories used by the DAG are unchanged. Because
+            environment variables, new files under directories that are not
+            used by the DAG, and other changes are not tracked, this option should only be used if they do not affect
+            the DAG. DAGs that depend on targets other than files, steps and
+            variables (e.g. executables and remote targets) are not saved.
+            Saved DAGs are removed by "sos remove -s".''')
     parser.add_argument('-c', dest='__config__', metavar='CONFIG_FILE',
                         help='''A configuration file in the format of YAML/JSON. The content
             of the configuration file will be available as a dictionary
@@ -283,7 +324,7 @@ def cmd_run(args, workflow_args):
     # if sys.platform != 'win32':
     #    mp.set_start_method('forkserver')
 
-    from .utils import env, get_traceback, load_config_files
+    from .utils import env, get_traceback, load_config_files, expand_size
     from .parser import SoS_Script
 
 
@@ -365,6 +406,13 @@ def cmd_run(args, workflow_args):
             'default_queue': '' if args.__queue__ is None else args.__queue__,
             'max_procs': args.__max_procs__,
             'max_running_jobs': args.__max_running_jobs__,
+            'max_substeps_per_worker': args.__max_substeps_per_worker__,
+            'worker_max_rss': expand_size(args.__worker_max_rss__) if args.__worker_max_rss__ else None,
+            'socket_transport': args.__socket_transport__,
+            'trace_file': args.__trace__,
+            'metrics': args.__metrics__ or bool(args.__metrics_endpoint__),
+            'metrics_endpoint': args.__metrics_endpoint__,
+            'dag_cache': args.__dag_cache__,
             'sig_mode': 'ignore' if args.dryrun else args.__sig_mode__,
             'run_mode': 'dryrun' if args.dryrun else 'run',
             'verbosity': args.verbosity,
@@ -471,6 +519,13 @@ def cmd_dryrun(args, workflow_args):
     args.__sig_mode__ = 'ignore'
     args.__max_procs__ = 1
     args.__max_running_jobs__ = 1
+    args.__max_substeps_per_worker__ = None
+    args.__worker_max_rss__ = None
+    args.__socket_transport__ = 'ipc'
+    args.__trace__ = None
+    args.__metrics__ = False
+    args.__metrics_endpoint__ = None
+    args.__dag_cache__ = False
     args.dryrun = True
     args.__bin_dirs__ = []
     args.__remote__ = None
@@ -1235,6 +1290,13 @@ def cmd_remove(args, unknown_args):
         else:
             env.logger.info(
                 'No signatures is found from workflows executed under the current directory.')
+        # DAGs saved with option --dag-cache
+        from .workflow_executor import dag_cache_dir
+        dag_cache = dag_cache_dir(os.getcwd())
+        if dag_cache is not None and os.path.isdir(dag_cache):
+            import shutil
+            shutil.rmtree(dag_cache, ignore_errors=True)
+            env.logger.info('Saved DAGs of workflows are removed.')
         return
     #
     tracked_files = list(set(sum([sum(x[1].values(), []) for x in sig_files], [])))
@@ -1617,10 +1679,11 @@ def cmd_config(args, workflow_args):
 # Handling addon commands
 #
 def handle_addon(args, unknown_args):
-    for entrypoint in pkg_resources.iter_entry_points(group='sos_addons'):
-        name = entrypoint.name.strip()
+    from .utils import get_plugin_index, load_plugin
+    for name, (spec, _) in get_plugin_index().get('sos_addons', {}).items():
+        name = name.strip()
         if name.endswith('.func') and name.rsplit('.', 1)[0] == args.addon_name:
-            func = entrypoint.load()
+            func = load_plugin(spec)
             func(args, unknown_args)
 
 #
@@ -1643,6 +1706,53 @@ def sosrunner():
     args, workflow_args = parser.parse_known_args()
     cmd_run(args, workflow_args)
 
+#
+# command bench
+#
+
+
+def get_bench_parser(desc_only=False):
+    parser = argparse.ArgumentParser('bench',
+                                     description='''Run benchmarks with synthetic workloads to
+        measure the performance of SoS, and output results in JSON format that
+        can be compared across versions of SoS.''')
+    if desc_only:
+        return parser
+    parser.add_argument('benchmarks', nargs='*', help='''Benchmarks to run, which can
+        be dag_build, step_signatures, substep_dispatch, input_files, and check_tasks.
+        All benchmarks will be run if no benchmark is specified.''')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='''Multiply the size of workloads by SCALE, for example 0.1
+        for a quick check of performance regression, or 10 for a large number of
+        files and tasks. Default to 1.''')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='''Number of times each benchmark is repeated, default to 3.''')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='''Save results to FILE instead of standard output.''')
+    parser.add_argument('-v', dest='verbosity', type=int, choices=range(5), default=2,
+                        help='''Output error (0), warning (1), info (2), debug (3) and trace (4)
+            information to standard output (default to 2).''')
+    parser.set_defaults(func=cmd_bench)
+    return parser
+
+
+def cmd_bench(args, unknown_args):
+    import json
+    from .benchmark import benchmarks, run_benchmarks
+    from .utils import env
+    env.verbosity = args.verbosity
+    unknown = [x for x in args.benchmarks if x not in benchmarks]
+    if unknown:
+        env.logger.error(
+            f'Unknown benchmark {", ".join(unknown)}. Please choose from {", ".join(benchmarks.keys())}')
+        sys.exit(1)
+    results = run_benchmarks(args.benchmarks, args.scale, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
 
 # add another ArgumentParser to an existing ArgumentParser as
 # a subparser
@@ -1684,7 +1794,7 @@ def main():
         master_parser.add_argument('--version', action='version',
                                    version='%(prog)s {}'.format(SOS_FULL_VERSION))
         subparsers = master_parser.add_subparsers(title='subcommands',
-                                                  metavar='{install,run,dryrun,status,push,pull,execute,kill,purge,config,convert,remove}')
+                                                  metavar='{install,run,dryrun,status,push,pull,execute,kill,purge,config,convert,remove,bench}')
 
         # command install
         # add_sub_parser(subparsers, get_install_parser(desc_only='install'!=subcommand))
@@ -1743,13 +1853,19 @@ def main():
         add_sub_parser(subparsers, get_remove_parser(
             desc_only='remove' != subcommand))
         #
+        # command bench
+        add_sub_parser(subparsers, get_bench_parser(
+            desc_only='bench' != subcommand))
+        #
         # addon packages
         if subcommand is None or subcommand not in ['install', 'run', 'dryrun', 'convert', 'push', 'pull',
-                                                    'remove', 'config']:
-            for entrypoint in pkg_resources.iter_entry_points(group='sos_addons'):
-                if entrypoint.name.strip().endswith('.parser'):
-                    name = entrypoint.name.rsplit('.', 1)[0]
-                    func = entrypoint.load()
+                                                    'remove', 'config', 'bench', 'status', 'remote',
+                                                    'preview', 'execute', 'kill', 'purge']:
+            from .utils import get_plugin_index, load_plugin
+            for name, (spec, _) in get_plugin_index().get('sos_addons', {}).items():
+                if name.strip().endswith('.parser'):
+                    name = name.rsplit('.', 1)[0]
+                    func = load_plugin(spec)
                     parser = add_sub_parser(subparsers, func(), name=name)
                     parser.add_argument('--addon-name', help=argparse.SUPPRESS,
                                         default=name)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from ._version import __version__
+from .utils import env
+
+#
+# Benchmarks of performance-critical components of SoS (command sos bench).
+#
+# Each benchmark generates a synthetic workload of given size in a temporary
+# directory, and returns the time used by the operation that is measured. The
+# size of workloads are multiplied by option --scale so that the benchmarks
+# can be run quickly to detect regressions, or at scale to find bottlenecks.
+#
+
+
+def _bench_dag_build(size):
+    '''Build the DAG of a chain of auxiliary steps'''
+    from .parser import SoS_Script
+    from .workflow_executor import Base_Executor
+    script = '[default]\n' + '\n'.join(
+        f'''[chain{i}: provides='f{i}.txt']\n''' +
+        (f'''depends: 'f{i-1}.txt'\n''' if i > 0 else '') +
+        '_output.touch()\n' for i in range(size))
+    wf = SoS_Script(script).workflow()
+    start = time.time()
+    Base_Executor(wf).initialize_dag(targets=[f'f{size - 1}.txt'])
+    return time.time() - start
+
+
+def _bench_step_signatures(size):
+    '''Write and read step signatures'''
+    from .signatures import StepSignatures
+    sigs = StepSignatures()
+    signature = {'input': {f'input_{i}.txt': 'a' * 32 for i in range(10)},
+                 'output': {f'output_{i}.txt': 'b' * 32 for i in range(10)},
+                 'depends': {}, 'end_context': {'a': 1}}
+    ids = [uuid.uuid4().hex for i in range(size)]
+    start = time.time()
+    for id in ids:
+        sigs.set(id, signature)
+    sigs.commit()
+    for id in ids:
+        sigs.get(id)
+    elapsed = time.time() - start
+    sigs.close()
+    return elapsed
+
+
+def _bench_substep_dispatch(size):
+    '''Execute empty concurrent substeps of a wide for_each loop'''
+    from .parser import SoS_Script
+    from .workflow_executor import Base_Executor
+    wf = SoS_Script(f'''
+input: for_each=dict(i=range({size})), concurrent=True
+pass
+''').workflow()
+    start = time.time()
+    Base_Executor(wf, config={'sig_mode': 'ignore'}).run()
+    return time.time() - start
+
+
+def _bench_input_files(size):
+    '''Process a step with a large number of input files grouped by 1'''
+    from .parser import SoS_Script
+    from .workflow_executor import Base_Executor
+    os.mkdir('files')
+    for i in range(size):
+        with open(os.path.join('files', f'{i}.txt'), 'w'):
+            pass
+    wf = SoS_Script('''
+input: 'files/*.txt', group_by=1
+pass
+''').workflow()
+    start = time.time()
+    Base_Executor(wf, config={'sig_mode': 'ignore'}).run()
+    return time.time() - start
+
+
+def _bench_check_tasks(size):
+    '''Check the status of local tasks'''
+    from .tasks import TaskFile, TaskParams, check_tasks
+    # tasks are saved to ~/.sos/tasks so the home directory is pointed to the
+    # temporary directory of the benchmark, which is removed afterwards
+    home = {x: os.environ.get(x) for x in ('HOME', 'USERPROFILE')}
+    os.environ['HOME'] = os.environ['USERPROFILE'] = os.getcwd()
+    try:
+        os.makedirs(os.path.join(os.path.expanduser('~'), '.sos', 'tasks'), exist_ok=True)
+        tasks = [uuid.uuid4().hex[:16] for i in range(size)]
+        for task in tasks:
+            TaskFile(task).save(TaskParams(name=task, global_def='',
+                task='pass', sos_dict={'_runtime': {}}, tags=['sos_bench']))
+        start = time.time()
+        check_tasks(tasks, False)
+        return time.time() - start
+    finally:
+        for name, value in home.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+# name: (function, base size, unit)
+benchmarks = {
+    'dag_build': (_bench_dag_build, 200, 'step'),
+    'step_signatures': (_bench_step_signatures, 10000, 'signature'),
+    'substep_dispatch': (_bench_substep_dispatch, 500, 'substep'),
+    'input_files': (_bench_input_files, 10000, 'file'),
+    'check_tasks': (_bench_check_tasks, 1000, 'task'),
+}
+
+
+def run_benchmark(name, scale=1, repeat=3):
+    '''Run benchmark name for repeat times in temporary directories and
+    return its results.'''
+    func, base_size, unit = benchmarks[name]
+    size = max(1, int(base_size * scale))
+    times = []
+    cwd = os.getcwd()
+    exec_dir = env.exec_dir
+    verbosity = env.verbosity
+    for i in range(repeat):
+        bench_dir = tempfile.mkdtemp(prefix='sos_bench_')
+        try:
+            os.chdir(bench_dir)
+            os.mkdir('.sos')
+            env.exec_dir = bench_dir
+            # suppress messages from the execution of workflows
+            env.verbosity = 0
+            times.append(func(size))
+        finally:
+            os.chdir(cwd)
+            env.exec_dir = exec_dir
+            env.verbosity = verbosity
+            shutil.rmtree(bench_dir, ignore_errors=True)
+    return {
+        'name': name,
+        'description': func.__doc__,
+        'size': size,
+        'unit': unit,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        # throughput and latency of the fastest run
+        'throughput': size / min(times) if min(times) > 0 else None,
+        'latency': min(times) / size,
+    }
+
+
+def run_benchmarks(names=None, scale=1, repeat=3):
+    '''Run specified (default to all) benchmarks and return results that
+    can be saved in JSON format and compared across versions of SoS.'''
+    results = {
+        'sos_version': __version__,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': scale,
+        'repeat': repeat,
+        'benchmarks': []
+    }
+    for name in (names if names else benchmarks.keys()):
+        env.logger.info(f'Running benchmark ``{name}``')
+        res = run_benchmark(name, scale, repeat)
+        env.logger.info(
+            f'{name}: {res["size"]} {res["unit"]}s in {res["min"]:.3f} seconds ({res["throughput"] or 0:.1f} {res["unit"]}s/second)')
+        results['benchmarks'].append(res)
+    return results
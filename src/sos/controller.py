@@ -3,17 +3,39 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 import os
+import shutil
 import sys
+import tempfile
 import zmq
 import time
 import threading
-from collections import defaultdict
+import uuid
+from collections import defaultdict, deque
 from .utils import env
 from .signatures import StepSignatures, WorkflowSignatures
 
 
 # from zmq.utils.monitor import recv_monitor_message
 
+def bind_to_random_endpoint(socket):
+    '''Bind socket to a random ipc endpoint under env.config['ipc_dir'], or to
+    a random port on localhost if tcp transport is used (no ipc_dir). Returns
+    the endpoint to which other processes should connect.'''
+    if env.config.get('ipc_dir', None):
+        addr = f'ipc://{env.config["ipc_dir"]}/{uuid.uuid4().hex[:8]}'
+        socket.bind(addr)
+        return addr
+    return f'tcp://127.0.0.1:{socket.bind_to_random_port("tcp://127.0.0.1")}'
+
+
+def endpoint(addr):
+    '''Return the endpoint to connect to. addr can be an endpoint returned by
+    bind_to_random_endpoint, or a port on localhost.'''
+    if isinstance(addr, int):
+        return f'tcp://127.0.0.1:{addr}'
+    return addr
+
+
 def connect_controllers(context=None):
     if not context:
         env.logger.trace(f'create context at {os.getpid()}')
@@ -22,28 +44,28 @@ def connect_controllers(context=None):
 
     env.signature_push_socket = context.socket(zmq.PUSH)
     env.signature_push_socket.connect(
-        f'tcp://127.0.0.1:{env.config["sockets"]["signature_push"]}')
+        endpoint(env.config["sockets"]["signature_push"]))
     env.signature_req_socket = context.socket(zmq.REQ)
     env.signature_req_socket.connect(
-        f'tcp://127.0.0.1:{env.config["sockets"]["signature_req"]}')
+        endpoint(env.config["sockets"]["signature_req"]))
 
     env.controller_push_socket = context.socket(zmq.PUSH)
     env.controller_push_socket.connect(
-        f'tcp://127.0.0.1:{env.config["sockets"]["controller_push"]}')
+        endpoint(env.config["sockets"]["controller_push"]))
     env.controller_req_socket = context.socket(zmq.REQ)
     env.controller_req_socket.connect(
-        f'tcp://127.0.0.1:{env.config["sockets"]["controller_req"]}')
+        endpoint(env.config["sockets"]["controller_req"]))
 
     env.substep_frontend_socket = context.socket(zmq.PUSH)
     env.substep_frontend_socket.connect(
-        f'tcp://127.0.0.1:{env.config["sockets"]["substep_frontend"]}')
+        endpoint(env.config["sockets"]["substep_frontend"]))
 
     # if this instance of sos is being tapped. It should connect to a few sockets
     #
     if env.config['exec_mode'] == 'slave':
         env.tapping_logging_socket = context.socket(zmq.PUSH)
         env.tapping_logging_socket.connect(
-            f'tcp://127.0.0.1:{env.config["sockets"]["tapping_logging"]}')
+            endpoint(env.config["sockets"]["tapping_logging"]))
         # change logging to socket
         env.set_socket_logger(env.tapping_logging_socket)
 
@@ -51,7 +73,7 @@ def connect_controllers(context=None):
     if env.config['exec_mode'] in ('master', 'slave'):
         env.tapping_listener_socket = context.socket(zmq.PUSH)
         env.tapping_listener_socket.connect(
-            f'tcp://127.0.0.1:{env.config["sockets"]["tapping_listener"]}')
+            endpoint(env.config["sockets"]["tapping_listener"]))
 
     return context
 
@@ -84,48 +106,97 @@ def disconnect_controllers(context=None):
         context.term()
 
 
-class Controller(threading.Thread):
-    '''This controller is used by both sos and sos-notebook, and there
-    can be two controllers one as a slave (sos) and one as a master
-    (notebook). We shared the same code base because step executors need
-    need to talk to the same controller (signature, controller etc) when
-    they are executed in sos or sos notebook.
-    '''
-    LRU_READY = b"\x01"
-
-    def __init__(self, ready, kernel=None):
+class ControllerMetrics:
+    '''Counters and latency histograms of messages handled by controller
+    threads, and gauges such as the depth of substep queue and the number of
+    substep workers. Each metric is updated by only one thread.'''
+    # upper bounds of latency buckets in seconds
+    buckets = (0.0001, 0.001, 0.01, 0.1, 1, 10, float('inf'))
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.histograms = {}
+        self.latency_sum = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.max_gauges = {}
+
+    def observe(self, name, latency):
+        if name not in self.histograms:
+            self.histograms[name] = [0] * len(self.buckets)
+        hist = self.histograms[name]
+        for idx, bound in enumerate(self.buckets):
+            if latency <= bound:
+                hist[idx] += 1
+                break
+        self.latency_sum[name] += latency
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+        if value > self.max_gauges.get(name, 0):
+            self.max_gauges[name] = value
+
+    def render(self):
+        '''Return metrics in the plain text format of prometheus'''
+        lines = [f'sos_controller_uptime_seconds {time.time() - self.start_time:.3f}']
+        for name, hist in sorted(list(self.histograms.items())):
+            cnt = 0
+            for bound, value in zip(self.buckets, hist):
+                cnt += value
+                lines.append(
+                    f'sos_controller_latency_seconds_bucket{{type="{name}",le="{"+Inf" if bound == float("inf") else bound}"}} {cnt}')
+            lines.append(f'sos_controller_latency_seconds_sum{{type="{name}"}} {self.latency_sum[name]:.6f}')
+            lines.append(f'sos_controller_latency_seconds_count{{type="{name}"}} {cnt}')
+        for name, value in sorted(list(self.counters.items())):
+            lines.append(f'sos_controller_{name}_total {value}')
+        for name, value in sorted(list(self.gauges.items())):
+            lines.append(f'sos_controller_{name} {value}')
+            lines.append(f'sos_controller_{name}_max {self.max_gauges.get(name, value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''Return a summary of metrics in human readable format'''
+        lines = [f'{"message":<30} {"count":>10} {"mean (ms)":>10} {"max bucket":>10}']
+        for name, hist in sorted(list(self.histograms.items())):
+            cnt = sum(hist)
+            slowest = max(idx for idx, value in enumerate(hist) if value)
+            lines.append(f'{name:<30} {cnt:>10} {self.latency_sum[name] / cnt * 1000:>10.3f} ' +
+                         f'{"<=" + str(self.buckets[slowest]) + "s" if slowest + 1 < len(self.buckets) else ">" + str(self.buckets[-2]) + "s":>10}')
+        for name, value in sorted(list(self.counters.items())):
+            lines.append(f'{name}: {value}')
+        for name, value in sorted(list(self.gauges.items())):
+            lines.append(f'{name}: {value} (max {self.max_gauges.get(name, value)})')
+        return '\n'.join(lines)
+
+
+def stop_thread(thread):
+    '''Stop a SignatureController or SubstepBroker thread by sending a stop
+    message to its inproc socket, and wait for it to exit.'''
+    socket = zmq.Context.instance().socket(zmq.PAIR)
+    socket.connect(thread.stop_endpoint)
+    socket.send(b'stop')
+    thread.join()
+    socket.LINGER = 0
+    socket.close()
+
+
+class SignatureController(threading.Thread):
+    '''Thread that owns the signature databases and handles signature_push
+    and signature_req sockets, so that slow database operations would not
+    block the routing of substeps and other controller messages.'''
+
+    def __init__(self, ready, metrics):
         threading.Thread.__init__(self)
-        #self.daemon = True
+        self.ready = ready
+        self.metrics = metrics
+        self.stop_endpoint = f'inproc://sos_signature_{id(self)}'
 
         self.step_signatures = StepSignatures()
         self.workflow_signatures = WorkflowSignatures()
 
-        self.ready = ready
-        self.kernel = kernel
-        # number of active running master processes
-        self._nprocs = 0
-
-        self._completed = defaultdict(int)
-        self._ignored = defaultdict(int)
-        self._subprogressbar_cnt = 0
-        # size of sub progress bar
-        self._subprogressbar_size = 25
-        self._subprogressbar_last_updated = time.time()
-
-        # completed steps
-        self._completed_steps = {}
-
-        # substgep workers
-        self._frontend_requests = []
-        self._substep_workers = []
-        self._n_working_workers = 0
-        # self.event_map = {}
-        # for name in dir(zmq):
-        #     if name.startswith('EVENT_'):
-        #         value = getattr(zmq, name)
-        #          self.event_map[value] = name
-        self.console_logger = None
-
     def handle_sig_push_msg(self, msg):
         try:
             if msg[0] == 'workflow':
@@ -140,14 +211,17 @@ class Controller(threading.Thread):
         except Exception as e:
             env.logger.warning(f'Failed to push signature {msg}: {e}')
 
+    def handle_all_sig_push_msgs(self):
+        while True:
+            if self.sig_push_socket.poll(0):
+                self.handle_sig_push_msg(self.sig_push_socket.recv_pyobj())
+            else:
+                break
+
     def handle_sig_req_msg(self, msg):
         try:
             # make sure all records have been saved before returning information
-            while True:
-                if self.sig_push_socket.poll(0):
-                    self.handle_sig_push_msg(self.sig_push_socket.recv_pyobj())
-                else:
-                    break
+            self.handle_all_sig_push_msgs()
             if msg[0] == 'workflow':
                 if msg[1] == 'clear':
                     self.workflow_signatures.clear()
@@ -173,32 +247,288 @@ class Controller(threading.Thread):
                 f'Failed to respond to signature request {msg}: {e}')
             self.sig_req_socket.send_pyobj(None)
 
+    def run(self):
+        # signature_push is used to write signatures. It is a single push operation with no reply.
+        # signature_req is used to query information. The sender would need to get an response.
+        self.context = zmq.Context.instance()
+
+        self.stop_socket = self.context.socket(zmq.PAIR)
+        self.stop_socket.bind(self.stop_endpoint)
+
+        self.sig_push_socket = self.context.socket(zmq.PULL)
+        env.config['sockets']['signature_push'] = bind_to_random_endpoint(self.sig_push_socket)
+        self.sig_req_socket = self.context.socket(zmq.REP)
+        env.config['sockets']['signature_req'] = bind_to_random_endpoint(self.sig_req_socket)
+        self.ready.set()
+
+        poller = zmq.Poller()
+        poller.register(self.stop_socket, zmq.POLLIN)
+        poller.register(self.sig_push_socket, zmq.POLLIN)
+        poller.register(self.sig_req_socket, zmq.POLLIN)
+
+        try:
+            while True:
+                socks = dict(poller.poll())
+
+                if self.sig_push_socket in socks:
+                    msg = self.sig_push_socket.recv_pyobj()
+                    start = time.time()
+                    self.handle_sig_push_msg(msg)
+                    self.metrics.observe(f'signature_push:{msg[0]}', time.time() - start)
+
+                if self.sig_req_socket in socks:
+                    msg = self.sig_req_socket.recv_pyobj()
+                    start = time.time()
+                    self.handle_sig_req_msg(msg)
+                    self.metrics.observe(f'signature_req:{msg[0]}', time.time() - start)
+
+                if self.stop_socket in socks:
+                    self.stop_socket.recv()
+                    # save all pending signatures before quit
+                    self.handle_all_sig_push_msgs()
+                    break
+        except Exception as e:
+            sys.stderr.write(f'signature controller get an error {e}')
+        finally:
+            # close all databses
+            self.step_signatures.close()
+            self.workflow_signatures.close()
+
+            poller.unregister(self.stop_socket)
+            poller.unregister(self.sig_push_socket)
+            poller.unregister(self.sig_req_socket)
+
+            self.stop_socket.LINGER = 0
+            self.stop_socket.close()
+            self.sig_push_socket.LINGER = 0
+            self.sig_push_socket.close()
+            self.sig_req_socket.LINGER = 0
+            self.sig_req_socket.close()
+
+
+class SubstepBroker(threading.Thread):
+    '''Thread that routes substeps from step executors (substep_frontend) to
+    substep workers (substep_backend), and starts and stops substep workers
+    as needed.'''
+    LRU_READY = b"\x01"
+    LRU_RETIRE = b"\x02"
+
+    def __init__(self, ready, controller, metrics):
+        threading.Thread.__init__(self)
+        self.ready = ready
+        self.metrics = metrics
+        self.stop_endpoint = f'inproc://sos_substep_broker_{id(self)}'
+        # the controller thread keeps track of the number of active running
+        # master processes, which we read when starting new workers
+        self.controller = controller
+
+        self._frontend_requests = deque()
+        # stop receiving substeps when the queue reaches its high-water mark
+        self._frontend_paused = False
+        self._substep_workers = []
+        self._n_working_workers = 0
+        # workers that are starting or executing a substep, as opposed to
+        # those waiting for substeps
+        self._n_busy_workers = 0
+
+    def handle_substep_frontend_msg(self, msg):
+        #  Get client request, route to first available worker
+        self._frontend_requests.append((time.time(), msg))
+
+        if self._n_working_workers == 0 or self._n_working_workers + self.controller._nprocs < env.config['max_procs']:
+            self.start_substep_worker()
+
+    def start_substep_worker(self):
+        from .workers import SoS_SubStep_Worker
+        # reap workers that have been stopped or retired
+        self._substep_workers = [x for x in self._substep_workers if x.is_alive()]
+        worker = SoS_SubStep_Worker(env.config)
+        worker.start()
+        self._substep_workers.append(worker)
+        self._n_working_workers += 1
+        self._n_busy_workers += 1
+        self.metrics.incr('substep_workers_started')
+        env.logger.debug(
+            f'Start a substep worker, {self._n_working_workers} in total')
+
+    def handle_substep_backend_msg(self, msg):
+        # Use worker address for LRU routing
+        if not msg:
+            return False
+
+        # a worker sends READY or RETIRE after it starts or completes a substep
+        self._n_busy_workers -= 1
+        if msg == self.LRU_RETIRE:
+            # the worker will quit after receiving None, and we replace it
+            # with a fresh worker if there are pending substeps
+            self.substep_backend_socket.send_pyobj(None)
+            self._n_working_workers -= 1
+            self.metrics.incr('substep_workers_retired')
+            env.logger.debug(
+                f'Retire a substep worker. {self._n_working_workers} remains.')
+            if self._frontend_requests:
+                self.start_substep_worker()
+            return
+
+        # Forward message to client if it's not a READY
+        if msg != self.LRU_READY:
+            raise RuntimeError(
+                f'substep worker should only send ready message: {msg} received')
+
+        # now see if we have any work to do
+        if self._frontend_requests:
+            queued_time, msg = self._frontend_requests.popleft()
+            self.substep_backend_socket.send_multipart(msg)
+            self._n_busy_workers += 1
+            self.metrics.incr('substeps_dispatched')
+            # time that substeps wait in the queue for idle workers
+            self.metrics.observe('substep_queue_wait', time.time() - queued_time)
+        else:
+            # stop the worker
+            self.substep_backend_socket.send_pyobj(None)
+            self._n_working_workers -= 1
+            self.metrics.incr('substep_workers_stopped')
+            env.logger.debug(
+                f'Kill a substep worker. {self._n_working_workers} remains.')
+
+    def run(self):
+        self.context = zmq.Context.instance()
+
+        self.stop_socket = self.context.socket(zmq.PAIR)
+        self.stop_socket.bind(self.stop_endpoint)
+
+        self.substep_frontend_socket = self.context.socket(zmq.PULL)  # ROUTER
+        env.config['sockets']['substep_frontend'] = bind_to_random_endpoint(self.substep_frontend_socket)
+        self.substep_backend_socket = self.context.socket(zmq.REP)  # ROUTER
+        env.config['sockets']['substep_backend'] = bind_to_random_endpoint(self.substep_backend_socket)
+        self.ready.set()
+
+        poller = zmq.Poller()
+        poller.register(self.stop_socket, zmq.POLLIN)
+        poller.register(self.substep_frontend_socket, zmq.POLLIN)
+        poller.register(self.substep_backend_socket, zmq.POLLIN)
+
+        try:
+            while True:
+                socks = dict(poller.poll())
+
+                if self.substep_frontend_socket in socks:
+                    msg = self.substep_frontend_socket.recv_multipart()
+                    start = time.time()
+                    self.handle_substep_frontend_msg(msg)
+                    self.metrics.observe('substep_frontend', time.time() - start)
+
+                if self.substep_backend_socket in socks:
+                    msg = self.substep_backend_socket.recv()
+                    start = time.time()
+                    self.handle_substep_backend_msg(msg)
+                    self.metrics.observe('substep_backend', time.time() - start)
+
+                self.metrics.set_gauge('substep_queue_depth', len(self._frontend_requests))
+                self.metrics.set_gauge('substep_workers', self._n_working_workers)
+                self.metrics.set_gauge('substep_workers_busy', self._n_busy_workers)
+
+                if self.stop_socket in socks:
+                    self.stop_socket.recv()
+                    # handle all push request from substep, used to for example kill workers
+                    while True:
+                        if self.substep_backend_socket.poll(0):
+                            self.handle_substep_backend_msg(
+                                self.substep_backend_socket.recv())
+                        else:
+                            break
+                    break
+
+                # apply backpressure: substeps will be held by zmq and then by
+                # the step executors if there are too many substeps in queue
+                saturated = len(self._frontend_requests) >= env.config['substep_queue_hwm']
+                if saturated and not self._frontend_paused:
+                    poller.unregister(self.substep_frontend_socket)
+                    self._frontend_paused = True
+                elif not saturated and self._frontend_paused:
+                    poller.register(self.substep_frontend_socket, zmq.POLLIN)
+                    self._frontend_paused = False
+        except Exception as e:
+            sys.stderr.write(f'substep broker get an error {e}')
+        finally:
+            poller.unregister(self.stop_socket)
+            if not self._frontend_paused:
+                poller.unregister(self.substep_frontend_socket)
+            poller.unregister(self.substep_backend_socket)
+
+            self.stop_socket.LINGER = 0
+            self.stop_socket.close()
+            self.substep_frontend_socket.LINGER = 0
+            self.substep_frontend_socket.close()
+            self.substep_backend_socket.LINGER = 0
+            self.substep_backend_socket.close()
+
+
+class Controller(threading.Thread):
+    '''This controller is used by both sos and sos-notebook, and there
+    can be two controllers one as a slave (sos) and one as a master
+    (notebook). We shared the same code base because step executors need
+    need to talk to the same controller (signature, controller etc) when
+    they are executed in sos or sos notebook.
+
+    The controller thread handles controller and tapping sockets, and starts
+    a SignatureController thread for signatures and a SubstepBroker thread
+    for the routing of substeps so that these concerns do not block each other.
+    '''
+
+    def __init__(self, ready, kernel=None):
+        threading.Thread.__init__(self)
+        #self.daemon = True
+
+        self.ready = ready
+        self.kernel = kernel
+        # number of active running master processes
+        self._nprocs = 0
+
+        self._completed = defaultdict(int)
+        self._ignored = defaultdict(int)
+        self._subprogressbar_cnt = 0
+        # size of sub progress bar
+        self._subprogressbar_size = 25
+        self._subprogressbar_last_updated = time.time()
+        # substeps completed and ignored since the last update of progress bar
+        self._new_completed = 0
+        self._new_ignored = 0
+
+        # completed steps
+        self._completed_steps = {}
+
+        self.signature_controller = None
+        self.substep_broker = None
+        # metrics updated by all controller threads
+        self.metrics = ControllerMetrics()
+        self.metrics_socket = None
+        # self.event_map = {}
+        # for name in dir(zmq):
+        #     if name.startswith('EVENT_'):
+        #         value = getattr(zmq, name)
+        #          self.event_map[value] = name
+        self.console_logger = None
+
     def handle_ctl_push_msg(self, msg):
         try:
             if msg[0] == 'nprocs':
                 env.logger.trace(f'Active running process set to {msg[1]}')
                 self._nprocs = msg[1]
+                self.metrics.set_gauge('active_processes', msg[1])
             elif msg[0] == 'progress':
-                if msg[1] == 'substep_ignored':
-                    self._ignored[msg[2]] += 1
-                elif msg[1] == 'substep_completed':
-                    self._completed[msg[2]] += 1
+                if msg[1] == 'substep_counts':
+                    # aggregated number of completed and ignored substeps
+                    # of a step since its last report
+                    if msg[3]:
+                        self._completed[msg[2]] += msg[3]
+                        self._new_completed += msg[3]
+                    if msg[4]:
+                        self._ignored[msg[2]] += msg[4]
+                        self._new_ignored += msg[4]
                 elif msg[1] == 'step_completed':
                     self._completed_steps[msg[3]] = msg[4]
                 if env.verbosity == 1 and env.config['run_mode'] != 'interactive':
-                    # remove existing subworkflow
-                    if time.time() - self._subprogressbar_last_updated > 1:
-                        if self._subprogressbar_cnt == self._subprogressbar_size:
-                            sys.stderr.write(
-                                '\b \b' * self._subprogressbar_cnt)
-                            self._subprogressbar_cnt = 0
-                        if msg[1] == 'substep_ignored':
-                            sys.stderr.write(f'\033[90m.\033[0m')
-                            self._subprogressbar_cnt += 1
-                        elif msg[1] == 'substep_completed':
-                            sys.stderr.write(f'\033[32m.\033[0m')
-                            self._subprogressbar_cnt += 1
-                        self._subprogressbar_last_updated = time.time()
                     if msg[1] == 'step_completed':
                         if self._subprogressbar_cnt > 0:
                             sys.stderr.write(
@@ -218,15 +548,28 @@ class Controller(threading.Thread):
         except Exception as e:
             env.logger.warning(f'Failed to push controller {msg}: {e}')
 
+    def update_subprogressbar(self):
+        # the sub progress bar is updated at most once a second, with one
+        # dot for all substeps that are completed or ignored since last update
+        if time.time() - self._subprogressbar_last_updated <= 1:
+            return
+        if self._new_completed or self._new_ignored:
+            if self._subprogressbar_cnt == self._subprogressbar_size:
+                sys.stderr.write('\b \b' * self._subprogressbar_cnt)
+                self._subprogressbar_cnt = 0
+            if self._new_completed:
+                sys.stderr.write(f'\033[32m.\033[0m')
+            else:
+                sys.stderr.write(f'\033[90m.\033[0m')
+            self._subprogressbar_cnt += 1
+            sys.stderr.flush()
+            self._new_completed = 0
+            self._new_ignored = 0
+        self._subprogressbar_last_updated = time.time()
+
     def handle_ctl_req_msg(self, msg):
         try:
-            # handle all sig_push_msg
-            while True:
-                if self.sig_push_socket.poll(0):
-                    self.handle_sig_push_msg(self.sig_push_socket.recv_pyobj())
-                else:
-                    break
-            # also handle ctrl push, which includes progress info
+            # handle ctrl push, which includes progress info
             while True:
                 if self.ctl_push_socket.poll(0):
                     self.handle_ctl_push_msg(self.ctl_push_socket.recv_pyobj())
@@ -249,13 +592,9 @@ class Controller(threading.Thread):
                     else:
                         break
 
-                # handle all push request from substep, used to for example kill workers
-                while True:
-                    if self.substep_backend_socket.poll(0):
-                        self.handle_substep_backend_msg(
-                            self.substep_backend_socket.recv())
-                    else:
-                        break
+                # stop substep broker and signature threads, which handle
+                # all pending messages before they quit
+                self.stop_threads()
                 # handle all push request from logging
                 if env.config['exec_mode'] in ('master', 'both'):
                     while True:
@@ -277,6 +616,10 @@ class Controller(threading.Thread):
                                      f'\033[32m]\033[0m {steps_text} ({completed_text}{", " if nCompleted and nIgnored else ""}{ignored_text})\n')
                     sys.stderr.flush()
 
+                if env.config.get('metrics', False):
+                    sys.stderr.write(f'Controller metrics:\n{self.metrics.summary()}\n')
+                    sys.stderr.flush()
+
                 self.ctl_req_socket.send_pyobj('bye')
 
                 return False
@@ -287,40 +630,6 @@ class Controller(threading.Thread):
             env.logger.warning(f'Failed to respond controller {msg}: {e}')
             self.ctl_req_socket.send_pyobj(None)
 
-    def handle_substep_frontend_msg(self, msg):
-        #  Get client request, route to first available worker
-        self._frontend_requests.insert(0, msg)
-
-        if self._n_working_workers == 0 or self._n_working_workers + self._nprocs < env.config['max_procs']:
-            from .workers import SoS_SubStep_Worker
-            worker = SoS_SubStep_Worker(env.config)
-            worker.start()
-            self._substep_workers.append(worker)
-            self._n_working_workers += 1
-            env.logger.debug(
-                f'Start a substep worker, {self._n_working_workers} in total')
-
-    def handle_substep_backend_msg(self, msg):
-        # Use worker address for LRU routing
-        if not msg:
-            return False
-
-        # Forward message to client if it's not a READY
-        if msg != self.LRU_READY:
-            raise RuntimeError(
-                f'substep worker should only send ready message: {msg} received')
-
-        # now see if we have any work to do
-        if self._frontend_requests:
-            msg = self._frontend_requests.pop()
-            self.substep_backend_socket.send(msg)
-        else:
-            # stop the worker
-            self.substep_backend_socket.send_pyobj(None)
-            self._n_working_workers -= 1
-            env.logger.debug(
-                f'Kill a substep worker. {self._n_working_workers} remains.')
-
     def handle_tapping_logging_msg(self, msg):
         if env.config['exec_mode'] == 'both':
             print(' '.join(x.decode() for x in msg))
@@ -350,12 +659,44 @@ class Controller(threading.Thread):
     def handle_tapping_controller_msg(self, msg):
         self.tapping_controller_socket.send(b'ok')
 
-    def run(self):
-        # there are two sockets
-        #
-        # signature_push is used to write signatures. It is a single push operation with no reply.
-        # signature_req is used to query information. The sender would need to get an response.
+    def bind_metrics_socket(self, addr):
+        '''Serve metrics over http if addr is a tcp endpoint (e.g.
+        tcp://127.0.0.1:5555), or reply to any request to a REP socket
+        otherwise (e.g. ipc:///tmp/sos_metrics).'''
+        try:
+            if addr.startswith('tcp://'):
+                self.metrics_socket = self.context.socket(zmq.STREAM)
+            else:
+                self.metrics_socket = self.context.socket(zmq.REP)
+            self.metrics_socket.bind(addr)
+            env.logger.info(f'Controller metrics are available at {addr}')
+        except Exception as e:
+            env.logger.warning(f'Failed to bind metrics endpoint {addr}: {e}')
+            if self.metrics_socket is not None:
+                self.metrics_socket.close()
+            self.metrics_socket = None
+
+    def handle_metrics_msg(self, msg):
+        if self.metrics_socket.type == zmq.REP:
+            self.metrics_socket.send_string(self.metrics.render())
+            return
+        # STREAM socket receives [id, data] and an empty data frame when
+        # a client connects or disconnects
+        if not msg[1]:
+            return
+        body = self.metrics.render().encode()
+        self.metrics_socket.send_multipart([msg[0],
+            b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' +
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body])
+        # close the connection
+        self.metrics_socket.send_multipart([msg[0], b''])
+
+    def stop_threads(self):
+        for thread in (self.substep_broker, self.signature_controller):
+            if thread is not None and thread.is_alive():
+                stop_thread(thread)
 
+    def run(self):
         self.context = zmq.Context.instance()
 
         env.logger.trace(f'controller started {os.getpid()}')
@@ -363,27 +704,26 @@ class Controller(threading.Thread):
         if 'sockets' not in env.config:
             env.config['sockets'] = {}
 
-        self.sig_push_socket = self.context.socket(zmq.PULL)
-        env.config['sockets']['signature_push'] = self.sig_push_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
-        self.sig_req_socket = self.context.socket(zmq.REP)
-        env.config['sockets']['signature_req'] = self.sig_req_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
+        # local sockets are created under a temporary directory of this run
+        # to avoid the overhead of tcp loopback and the exhaustion of ports.
+        # tapping sockets are connected from outside and always use tcp.
+        if env.config.get('socket_transport', 'ipc') == 'ipc' and zmq.has('ipc'):
+            env.config['ipc_dir'] = tempfile.mkdtemp(prefix='sos_')
+        else:
+            env.config['ipc_dir'] = None
+
+        # signatures and substeps are handled by their own threads
+        sig_ready = threading.Event()
+        self.signature_controller = SignatureController(sig_ready, self.metrics)
+        self.signature_controller.start()
+        broker_ready = threading.Event()
+        self.substep_broker = SubstepBroker(broker_ready, self, self.metrics)
+        self.substep_broker.start()
 
         self.ctl_push_socket = self.context.socket(zmq.PULL)
-        env.config['sockets']['controller_push'] = self.ctl_push_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
+        env.config['sockets']['controller_push'] = bind_to_random_endpoint(self.ctl_push_socket)
         self.ctl_req_socket = self.context.socket(zmq.REP)
-        env.config['sockets']['controller_req'] = self.ctl_req_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
-
-        # broker to handle the execution of substeps
-        self.substep_frontend_socket = self.context.socket(zmq.PULL)  # ROUTER
-        env.config['sockets']['substep_frontend'] = self.substep_frontend_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
-        self.substep_backend_socket = self.context.socket(zmq.REP)  # ROUTER
-        env.config['sockets']['substep_backend'] = self.substep_backend_socket.bind_to_random_port(
-            'tcp://127.0.0.1')
+        env.config['sockets']['controller_req'] = bind_to_random_endpoint(self.ctl_req_socket)
 
         # tapping
         if env.config['exec_mode'] == 'master':
@@ -402,25 +742,28 @@ class Controller(threading.Thread):
         if env.config['exec_mode'] == 'slave':
             self.tapping_controller_socket = self.context.socket(zmq.PULL)
             self.tapping_controller_socket.connect(
-                f'tcp://127.0.0.1:{env.config["sockets"]["tapping_controller"]}')
+                endpoint(env.config["sockets"]["tapping_controller"]))
+
+        if env.config.get('metrics_endpoint', None):
+            self.bind_metrics_socket(env.config['metrics_endpoint'])
 
         #monitor_socket = self.sig_req_socket.get_monitor_socket()
         # tell others that the sockets are ready
+        sig_ready.wait()
+        broker_ready.wait()
         self.ready.set()
 
         # Process messages from receiver and controller
         poller = zmq.Poller()
-        poller.register(self.sig_push_socket, zmq.POLLIN)
-        poller.register(self.sig_req_socket, zmq.POLLIN)
         poller.register(self.ctl_push_socket, zmq.POLLIN)
         poller.register(self.ctl_req_socket, zmq.POLLIN)
-        poller.register(self.substep_frontend_socket, zmq.POLLIN)
-        poller.register(self.substep_backend_socket, zmq.POLLIN)
         if env.config['exec_mode'] == 'master':
             poller.register(self.tapping_logging_socket, zmq.POLLIN)
             poller.register(self.tapping_listener_socket, zmq.POLLIN)
         if env.config['exec_mode'] == 'slave':
             poller.register(self.tapping_controller_socket, zmq.POLLIN)
+        if self.metrics_socket is not None:
+            poller.register(self.metrics_socket, zmq.POLLIN)
 
         #poller.register(monitor_socket, zmq.POLLIN)
         if env.verbosity == 1 and env.config['run_mode'] != 'interactive':
@@ -429,28 +772,29 @@ class Controller(threading.Thread):
             sys.stderr.flush()
 
         try:
+            show_progress = env.verbosity == 1 and env.config['run_mode'] != 'interactive'
             while True:
-                socks = dict(poller.poll())
-                if self.sig_push_socket in socks:
-                    self.handle_sig_push_msg(self.sig_push_socket.recv_pyobj())
-
-                if self.sig_req_socket in socks:
-                    self.handle_sig_req_msg(self.sig_req_socket.recv_pyobj())
+                # poll with a timeout so that the progress bar is updated
+                # even if there is no incoming message
+                socks = dict(poller.poll(1000 if show_progress else None))
+                if show_progress:
+                    self.update_subprogressbar()
 
                 if self.ctl_push_socket in socks:
-                    self.handle_ctl_push_msg(self.ctl_push_socket.recv_pyobj())
+                    msg = self.ctl_push_socket.recv_pyobj()
+                    start = time.time()
+                    self.handle_ctl_push_msg(msg)
+                    self.metrics.observe(f'controller_push:{msg[0]}', time.time() - start)
 
                 if self.ctl_req_socket in socks:
-                    if not self.handle_ctl_req_msg(self.ctl_req_socket.recv_pyobj()):
+                    msg = self.ctl_req_socket.recv_pyobj()
+                    start = time.time()
+                    if not self.handle_ctl_req_msg(msg):
                         break
+                    self.metrics.observe(f'controller_req:{msg[0]}', time.time() - start)
 
-                if self.substep_frontend_socket in socks:
-                    self.handle_substep_frontend_msg(
-                        self.substep_frontend_socket.recv())
-
-                if self.substep_backend_socket in socks:
-                    self.handle_substep_backend_msg(
-                        self.substep_backend_socket.recv())
+                if self.metrics_socket is not None and self.metrics_socket in socks:
+                    self.handle_metrics_msg(self.metrics_socket.recv_multipart())
 
                 if env.config['exec_mode'] == 'master':
                     if self.tapping_logging_socket in socks:
@@ -475,34 +819,26 @@ class Controller(threading.Thread):
             sys.stderr.write(f'{env.config["exec_mode"]} get an error {e}')
             return
         finally:
-            # close all databses
-            self.step_signatures.close()
-            self.workflow_signatures.close()
+            # threads are normally stopped by the done message
+            self.stop_threads()
 
-            poller.unregister(self.sig_push_socket)
-            poller.unregister(self.sig_req_socket)
             poller.unregister(self.ctl_push_socket)
             poller.unregister(self.ctl_req_socket)
-            poller.unregister(self.substep_frontend_socket)
-            poller.unregister(self.substep_backend_socket)
             if env.config['exec_mode'] == 'master':
                 poller.unregister(self.tapping_logging_socket)
                 poller.unregister(self.tapping_listener_socket)
             if env.config['exec_mode'] == 'slave':
                 poller.unregister(self.tapping_controller_socket)
+            if self.metrics_socket is not None:
+                poller.unregister(self.metrics_socket)
+                self.metrics_socket.LINGER = 0
+                self.metrics_socket.close()
+                self.metrics_socket = None
 
-            self.sig_push_socket.LINGER = 0
-            self.sig_push_socket.close()
-            self.sig_req_socket.LINGER = 0
-            self.sig_req_socket.close()
             self.ctl_push_socket.LINGER = 0
             self.ctl_push_socket.close()
             self.ctl_req_socket.LINGER = 0
             self.ctl_req_socket.close()
-            self.substep_frontend_socket.LINGER = 0
-            self.substep_frontend_socket.close()
-            self.substep_backend_socket.LINGER = 0
-            self.substep_backend_socket.close()
             if env.config['exec_mode'] == 'master':
                 self.tapping_logging_socket.LINGER = 0
                 self.tapping_logging_socket.close()
@@ -512,5 +848,8 @@ class Controller(threading.Thread):
             if env.config['exec_mode'] in ('master', 'slave'):
                 self.tapping_controller_socket.LINGER = 0
                 self.tapping_controller_socket.close()
+            if env.config['ipc_dir']:
+                shutil.rmtree(env.config['ipc_dir'], ignore_errors=True)
+                env.config['ipc_dir'] = None
 
             env.logger.trace(f'controller stopped {os.getpid()}')
@@ -13,6 +13,7 @@ import networkx as nx
 
 from .targets import (sos_step, sos_targets, sos_variable, textMD5,
                       BaseTarget)
+from .tracing import traced
 from .utils import ActivityNotifier, env, short_repr
 
 from typing import Union
@@ -266,6 +267,7 @@ class SoS_DAG(nx.DiGraph):
             ancestors |= nx.ancestors(self, node)
         return SoS_DAG(nx.subgraph(self, subnodes + list(ancestors)))
 
+    @traced
     def build(self, steps):
         '''Connect nodes according to status of targets'''
         # right now we do not worry about status of nodes
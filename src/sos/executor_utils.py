@@ -20,7 +20,8 @@ from tokenize import generate_tokens
 
 from .targets import (RemovedTarget, file_target, sos_targets, sos_step,
     dynamic, sos_variable, RuntimeInfo, textMD5)
-from .utils import env, short_repr
+from .tracing import traced
+from .utils import env, invalidate_dir_listing, short_repr
 from .eval import SoS_eval, SoS_exec, stmtHash
 from ._version import __version__
 from .tasks import TaskParams
@@ -79,6 +80,7 @@ def get_traceback_msg(e):
     else:
         return f'{error_class}: {detail}'
 
+@traced
 def prepare_env(global_def):
     env.sos_dict.set('__null_func__', __null_func__)
     # initial values
@@ -209,6 +211,8 @@ def kill_all_subprocesses(pid=None, include_self=False):
 
 
 def reevaluate_output():
+    # files could have been written by the substep
+    invalidate_dir_listing()
     # re-process the output statement to determine output files
     args, _ = SoS_eval(
         f'__null_func__({env.sos_dict["step_output"]._undetermined})')
@@ -220,6 +224,7 @@ def reevaluate_output():
     return sos_targets(*args, verify_existence=True)
 
 
+@traced
 def validate_step_sig(sig):
     if env.config['sig_mode'] == 'default':
         # if users use sos_run, the "scope" of the step goes beyong names in this step
@@ -13,8 +13,6 @@ import subprocess
 import sys
 from collections import Sequence
 
-import pexpect
-import pkg_resources
 
 from .eval import Undetermined, cfg_interpolate
 from .syntax import SOS_LOGLINE
@@ -922,13 +920,14 @@ class Host:
                 task_engine = None
 
                 available_engines = []
-                for entrypoint in pkg_resources.iter_entry_points(group='sos_taskengines'):
+                from .utils import get_plugin_index, load_plugin
+                for name, (spec, _) in get_plugin_index().get('sos_taskengines', {}).items():
                     try:
-                        if entrypoint.name == self._task_engine_type:
-                            task_engine = entrypoint.load()(
+                        if name == self._task_engine_type:
+                            task_engine = load_plugin(spec)(
                                 self.host_instances[self.alias])
                             break
-                        available_engines.append(entrypoint.name)
+                        available_engines.append(name)
                     except Exception as e:
                         raise RuntimeError(
                             f'Failed to load task engine {self._task_engine_type}: {e}')
@@ -1088,6 +1087,7 @@ def status_of_queues(cfg, hosts=[], verbosity=1):
 def test_ssh(host):
     if host.address == 'localhost':
         return 'OK'
+    import pexpect
     address, port = host.address, host.port
     try:
         cmd = cfg_interpolate('ssh {host} -p {port} true', {
@@ -1319,6 +1319,7 @@ def test_queues(cfg, hosts=[], verbosity=1):
 
 
 def copy_public_key(host, agent, password):
+    import pexpect
     try:
         if password is None:
             import getpass
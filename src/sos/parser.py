@@ -8,16 +8,19 @@ import builtins
 import copy
 import fnmatch
 import os
+import pickle
 import re
 import shutil
 import sys
 import textwrap
 import typing
+from collections import OrderedDict
 from io import StringIO, TextIOBase
 from tokenize import generate_tokens
 from typing import Dict, List, Optional, Tuple
 from uuid import UUID, uuid4
 
+from ._version import __version__
 from .eval import on_demand_options
 from .syntax import (INDENTED, SOS_AS, SOS_CELL, SOS_DIRECTIVE, SOS_DIRECTIVES,
                      SOS_ELIF, SOS_ELSE, SOS_ENDIF, SOS_FORMAT_LINE,
@@ -25,7 +28,8 @@ from .syntax import (INDENTED, SOS_AS, SOS_CELL, SOS_DIRECTIVE, SOS_DIRECTIVES,
                      SOS_MAGIC, SOS_SECTION_HEADER, SOS_SECTION_NAME,
                      SOS_SECTION_OPTION, SOS_STRU, SOS_SUBWORKFLOW, SOS_ACTION_OPTIONS)
 from .targets import file_target, path, paths, sos_targets, textMD5
-from .utils import Error, env, locate_script, text_repr, format_par, separate_options
+from .utils import (Error, env, load_private_pickle, locate_script, private_cache_dir,
+                    script_search_paths, text_repr, format_par, separate_options)
 
 __all__ = ['SoS_Script']
 
@@ -111,9 +115,8 @@ def is_type_hint(stmt: str) -> bool:
     # if action is registered
     global _action_list
     if _action_list is None:
-        import pkg_resources
-        _action_list = [
-            x.name for x in pkg_resources.iter_entry_points(group='sos_actions')]
+        from .utils import get_plugin_index
+        _action_list = list(get_plugin_index().get('sos_actions', {}).keys())
     if action in _action_list:
         return False
 
@@ -703,6 +706,29 @@ class SoS_ScriptContent:
         return self.md5 != other.md5
 
 
+# included files and pickled parsed scripts, keyed by cache files, with
+# the least recently used ones discarded first
+_parse_cache = OrderedDict()
+# number of parsed scripts kept in memory, and under ~/.sos/cache/parsed_scripts
+_max_parse_cache = 100
+_max_parsed_scripts = 500
+
+
+def _remember_parsed(cache_file: str, cached: Tuple) -> None:
+    _parse_cache[cache_file] = cached
+    _parse_cache.move_to_end(cache_file)
+    while len(_parse_cache) > _max_parse_cache:
+        _parse_cache.popitem(last=False)
+
+
+def _prune_parsed_scripts(cache_dir: str) -> None:
+    # keep the most recently saved or loaded parsed scripts
+    cached = sorted((os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+                     if x.endswith('.pkl')), key=os.path.getmtime, reverse=True)
+    for filename in cached[_max_parsed_scripts:]:
+        os.remove(filename)
+
+
 class SoS_Script:
     def __init__(self, content: Optional[str] = '', filename: Optional[str] = None) -> None:
         '''Parse a sectioned SoS script file. Please refer to the SoS manual
@@ -757,11 +783,20 @@ class SoS_Script:
         else:
             self.sos_script = '<string>'
             self.content = SoS_ScriptContent(content, None)
+        # parsed scripts are cached with the content of included files
+        cache_file = self._parse_cache_file()
+        if self._load_parse_cache(cache_file):
+            return
         # save a parsed version of the script for displaying purpose only
         self.global_def = ''
 
         self.description = []
         self._last_comment = ''
+        # all files included directly or indirectly by this script
+        self._included_files = []
+        # included scripts and where they were found, as (name, start
+        # path of search, script file)
+        self._include_searches = []
         # open the file
         if content:
             with StringIO(content) as fp:
@@ -792,6 +827,92 @@ class SoS_Script:
         for section in self.sections:
             if section.is_global:
                 section.names = self.workflows
+        #
+        self._save_parse_cache(cache_file)
+
+    def _parse_cache_file(self) -> Optional[str]:
+        # included files are searched from the directory of the script, or
+        # the current directory if the script is a string
+        cache_dir = private_cache_dir('parsed_scripts')
+        if cache_dir is None:
+            return None
+        key = textMD5(
+            f'{__version__}\n{self.sos_script}\n{os.getcwd()}\n{self.content.text()}')
+        return os.path.join(cache_dir, f'{key}.pkl')
+
+    @staticmethod
+    def _included_fingerprint(filenames: List[str]) -> List[Tuple[str, str]]:
+        fingerprint = []
+        for filename in filenames:
+            with open(filename) as script:
+                fingerprint.append((filename, textMD5(script.read())))
+        return fingerprint
+
+    @staticmethod
+    def _resolve_include(sos_file: str, start_path: str, search_paths: List[str]) -> Optional[str]:
+        # local file that would be found by _find_include_file
+        for ext in ('.sos', '.ipynb'):
+            filename = os.path.expanduser(sos_file + ext)
+            candidates = [os.path.abspath(filename)] + \
+                [os.path.join(os.path.expanduser(x), filename) for x in search_paths if x]
+            for candidate in candidates:
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def _includes_resolved(self, searches: List[Tuple[str, str, str]]) -> bool:
+        # included scripts could be shadowed by new files that are found
+        # earlier in the search path, or by changes to sos_path
+        search_paths = {}
+        for sos_file, start_path, script_file in searches:
+            if start_path not in search_paths:
+                search_paths[start_path] = script_search_paths(start_path)
+            if self._resolve_include(sos_file, start_path, search_paths[start_path]) != script_file:
+                return False
+        return True
+
+    def _load_parse_cache(self, cache_file: Optional[str]) -> bool:
+        if cache_file is None:
+            return False
+        cached = _parse_cache.get(cache_file, None)
+        if cached is None:
+            try:
+                cached = load_private_pickle(cache_file)
+                # so that the cache file is not pruned as an old one
+                os.utime(cache_file)
+            except Exception:
+                return False
+        try:
+            # the cache is invalid if any of the included files is changed,
+            # or if another file would be included
+            if self._included_fingerprint([x[0] for x in cached[0]]) != cached[0] or \
+                not self._includes_resolved(cached[1]):
+                return False
+            # the parsed script can be modified (e.g. by option -t) so we
+            # always restore a new copy
+            self.__dict__.update(pickle.loads(cached[2]))
+        except Exception as e:
+            env.logger.debug(f'Failed to load parsed script from cache: {e}')
+            return False
+        _remember_parsed(cache_file, cached)
+        return True
+
+    def _save_parse_cache(self, cache_file: Optional[str]) -> None:
+        if cache_file is None:
+            return
+        try:
+            cached = (self._included_fingerprint(self._included_files),
+                      self._include_searches, pickle.dumps(self.__dict__))
+            _remember_parsed(cache_file, cached)
+            # concurrent processes could write the same cache so we write
+            # to a temporary file and rename it
+            tmp_file = f'{cache_file}.{os.getpid()}'
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump(cached, cache)
+            os.replace(tmp_file, cache_file)
+            _prune_parsed_scripts(os.path.dirname(cache_file))
+        except Exception as e:
+            env.logger.debug(f'Failed to cache parsed script: {e}')
 
     def _find_include_file(self, sos_file: str) -> Tuple[str, str]:
         # we could almost use SoS_script directly but we need to be able to start searching
@@ -814,12 +935,14 @@ class SoS_Script:
             raise RuntimeError(
                 f'Source file for nested workflow {sos_file} with extension .sos or .ipynb does not exist')
 
+        self._include_searches.append((sos_file, start_path, script_file))
         return content, script_file
 
     def _include_namespace(self, sos_file: str, alias: Optional[str]) -> None:
         content, script_file = self._find_include_file(sos_file)
         self.content.add(content, script_file)
         script = SoS_Script(content, script_file)
+        self._add_included_files([script_file] + script._included_files, script._include_searches)
         if not alias:
             alias = sos_file
         # section names are changed from A to sos_file.A
@@ -832,6 +955,12 @@ class SoS_Script:
         self.sections.extend(script.sections)
         self.global_def += f"{alias} = sos_namespace_({repr(script.global_def)})\n"
 
+    def _add_included_files(self, filenames: List[str], searches: List[Tuple[str, str, str]]) -> None:
+        for filename in filenames:
+            if filename not in self._included_files:
+                self._included_files.append(filename)
+        self._include_searches.extend(x for x in searches if x not in self._include_searches)
+
     def add_comment(self, line: str) -> None:
         '''Keeping track of "last comment" for section and parameter '''
         # the rule is like
@@ -852,6 +981,7 @@ class SoS_Script:
         #
         self.content.add(content, script_file)
         script = SoS_Script(content, script_file)
+        self._add_included_files([script_file] + script._included_files, script._include_searches)
         if not name_map:
             self.sections.extend(script.sections)
             self.global_def += script.global_def
@@ -4,15 +4,15 @@
 # Distributed under the terms of the 3-clause BSD License.
 
 import collections
-import copy
 import os
 import re
 import sys
+from functools import lru_cache
 from itertools import chain
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from .syntax import SOS_WILDCARD
-from .utils import env
+from .utils import env, walk_dir
 
 __all__ = ['expand_pattern']
 
@@ -26,6 +26,7 @@ __all__ = ['expand_pattern']
 #
 
 
+@lru_cache(maxsize=1024)
 def regex(filepattern: str) -> str:
     f = []
     last = 0
@@ -50,11 +51,10 @@ def regex(filepattern: str) -> str:
     return "".join(f)
 
 
-def glob_wildcards(pattern: str, files: Optional[List[str]] = None) -> Dict[str, Union[List[Any], List[str]]]:
-    """
-    Glob the values of the wildcards by matching the given pattern to the filesystem.
-    Returns a named tuple with a list of values for each wildcard.
-    """
+@lru_cache(maxsize=1024)
+def compile_pattern(pattern: str) -> Tuple[Any, List[str], str]:
+    '''Return compiled regular expression, names of wildcards, and the
+    directory without wildcards of a pattern.'''
     pattern = os.path.normpath(pattern)
     if sys.platform == 'win32':
         # we perform path matching with / slash only
@@ -65,33 +65,53 @@ def glob_wildcards(pattern: str, files: Optional[List[str]] = None) -> Dict[str,
     if not dirname:
         dirname = "."
 
-    names = [match.group('name')
-             for match in SOS_WILDCARD.finditer(pattern)]
+    names = list(dict.fromkeys(match.group('name')
+                               for match in SOS_WILDCARD.finditer(pattern)))
+    return re.compile(regex(pattern)), names, dirname
+
+
+def glob_wildcards(pattern: str, files: Optional[List[str]] = None) -> Dict[str, Union[List[Any], List[str]]]:
+    """
+    Glob the values of the wildcards by matching the given pattern to the filesystem.
+    Returns a named tuple with a list of values for each wildcard.
+    """
+    compiled, names, dirname = compile_pattern(pattern)
     res = {x: [] for x in names}
-    pattern = re.compile(regex(pattern))
 
     if files is None:
         files = ((os.path.join(dirpath, f) if dirpath != "." else f)
-                 for dirpath, dirnames, filenames in os.walk(dirname)
+                 for dirpath, dirnames, filenames in walk_dir(dirname)
                  for f in chain(filenames, dirnames))
 
     for f in files:
         # we perform path matching with only / slash
-        match = re.match(pattern, str(f).replace('\\', '/'))
+        match = compiled.match(str(f).replace('\\', '/'))
         if match:
             for name, value in match.groupdict().items():
                 res[name].append(value)
     return res
 
 
+@lru_cache(maxsize=1024)
+def _split_pattern(pattern: str) -> Tuple[Union[str, Tuple[str]], ...]:
+    # pattern as a sequence of literal strings and (name,) of wildcards
+    pieces = []
+    last = 0
+    for match in SOS_WILDCARD.finditer(pattern):
+        pieces.append(pattern[last:match.start()])
+        pieces.append((match.group('name'),))
+        last = match.end()
+    pieces.append(pattern[last:])
+    return tuple(pieces)
+
+
 def apply_wildcards(pattern: str,
                     wildcards: Dict[str, Union[int, str]],
                     fill_missing: bool = False,
                     fail_dynamic: bool = False,
                     dynamic_fill: None = None,
                     keep_dynamic: bool = False) -> str:
-    def format_match(match):
-        name = match.group("name")
+    def format_match(name):
         try:
             value = wildcards[name]
             if fail_dynamic and value == dynamic_fill:
@@ -105,21 +125,24 @@ def apply_wildcards(pattern: str,
             else:
                 raise RuntimeError(f'Wildcard apply error: {ex} ({wildcards})')
 
-    return SOS_WILDCARD.sub(format_match, pattern)
+    return ''.join(x if isinstance(x, str) else format_match(x[0])
+                   for x in _split_pattern(pattern))
 
 
 def extract_pattern(pattern: str, ifiles: List[str]) -> Dict[str, any]:
     '''This function match pattern to a list of input files, extract and return
     pieces of filenames as a list of variables with keys defined by pattern.'''
-    res = glob_wildcards(pattern, [])
+    compiled, names, _ = compile_pattern(pattern)
+    res = {x: [] for x in names}
     for ifile in ifiles:
-        matched = glob_wildcards(pattern, [ifile])
-        for key in matched.keys():
-            if not matched[key]:
-                #env.logger.warning('Filename {} does not match pattern {}. None returned.'.format(ifile, pattern))
+        match = compiled.match(str(ifile).replace('\\', '/'))
+        if match:
+            for key, value in match.groupdict().items():
+                res[key].append(value)
+        else:
+            #env.logger.warning('Filename {} does not match pattern {}. None returned.'.format(ifile, pattern))
+            for key in names:
                 res[key].append(None)
-            else:
-                res[key].extend(matched[key])
     return res
 
 
@@ -128,16 +151,15 @@ def expand_pattern(pattern: str) -> List[str]:
     and return a list of filenames'''
     ofiles = []
     sz = None
-    res = glob_wildcards(pattern, [])
-    sz = None
+    _, names, _ = compile_pattern(pattern)
     wildcard = [{}]
-    for key in res.keys():
+    for key in names:
         if key not in env.sos_dict:
             raise ValueError(f'Undefined variable {key} in pattern {pattern}')
         if not isinstance(env.sos_dict[key], str) and isinstance(env.sos_dict[key], collections.Sequence):
             if sz is None:
                 sz = len(env.sos_dict[key])
-                wildcard = [copy.deepcopy(wildcard[0]) for x in range(sz)]
+                wildcard = [dict(wildcard[0]) for x in range(sz)]
             elif sz != len(env.sos_dict[key]):
                 raise ValueError(
                     f'Variables in output pattern should have the same length (other={sz}, len({key})={len(env.sos_dict[key])})')
@@ -2,7 +2,7 @@
 #
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
-import pkg_resources
+import sys
 
 from .eval import interpolate, sos_namespace_
 from .pattern import expand_pattern
@@ -15,34 +15,78 @@ interpolate, sos_namespace_
 expand_pattern, path, paths
 
 
-def _load_group(group: str) -> None:
-    for _entrypoint in pkg_resources.iter_entry_points(group=group):
-        # import all targets and actions from entry_points
-        # Grab the function that is the actual plugin.
-        _name = _entrypoint.name
-        try:
-            _plugin = _entrypoint.load()
-            globals()[_name] = _plugin
-        except Exception as e:
-            # look for sos version requirement
-            if 'Requirement.parse' in str(e):
-                import re
-                from ._version import __version__
-                from pkg_resources import parse_version
-                m = re.search("Requirement.parse\('sos>=([^)]*)'\)", str(e))
-                if m:
-                    if parse_version(__version__) < parse_version(m.group(1)):
-                        logger.warning(
-                            f'Failed to load target {_entrypoint.name}: please upgrade your version of sos from {__version__} to at least version {m.group(1)}')
-                        continue
-            if _name == 'run':
-                # this is critical so we print the warning
-                logger.warning(
-                    f'Failed to load target {_entrypoint.name}: {e}')
-            else:
-                logger.trace(f'Failed to load target {_entrypoint.name}: {e}')
-
-
-_load_group('sos_targets')
+class _LazyPlugin:
+    '''Placeholder of a plugin that is imported when it is first used, so
+    that importing sos.runtime does not import all installed plugins.'''
+
+    def __init__(self, group, name, spec, required):
+        self._group = group
+        self._name = name
+        self._spec = spec
+        self._required = required
+        self._plugin = None
+
+    def _load(self):
+        if self._plugin is None:
+            self._plugin = _load_plugin(self._group, self._name, self._spec, self._required)
+            # later references to the plugin from this module get the plugin itself
+            globals()[self._name] = self._plugin
+        return self._plugin
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        # do not import the plugin for protocols such as pickle and copy
+        if attr.startswith('__') and attr not in ('__name__', '__qualname__', '__wrapped__'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return repr(self._plugin) if self._plugin is not None else f'<sos plugin {self._name}>'
+
+
+def _load_plugin(group, name, spec, required):
+    if required:
+        from ._version import __version__
+        raise RuntimeError(
+            f'Failed to load {name}: please upgrade your version of sos from {__version__} to at least version {required}')
+    from .utils import load_plugin
+    try:
+        return load_plugin(spec)
+    except Exception as e:
+        if name == 'run':
+            # this is critical so we print the warning
+            logger.warning(f'Failed to load {group[4:-1]} {name}: {e}')
+        else:
+            logger.trace(f'Failed to load {group[4:-1]} {name}: {e}')
+        raise RuntimeError(f'Failed to load {group[4:-1]} {name}: {e}')
+
+
+def _load_group(group: str, lazy: bool = True) -> None:
+    # plugins are discovered from a cached index of entry points. Plugins
+    # from modules that are already imported (e.g. targets from sos.targets)
+    # are loaded right away and others are imported when they are used.
+    from .utils import get_plugin_index, load_plugin
+    for name, (spec, required) in get_plugin_index().get(group, {}).items():
+        if not lazy:
+            try:
+                globals()[name] = _load_plugin(group, name, spec, required)
+            except RuntimeError as e:
+                if required:
+                    logger.warning(e)
+            continue
+        if not required and spec.split(':')[0].strip() in sys.modules:
+            try:
+                globals()[name] = load_plugin(spec)
+                continue
+            except Exception:
+                pass
+        globals()[name] = _LazyPlugin(group, name, spec, required)
+
+
+# targets are classes that are used in isinstance checks and can be
+# subclassed so they are imported right away
+_load_group('sos_targets', lazy=False)
 _load_group('sos_actions')
 _load_group('sos_functions')
@@ -4,22 +4,232 @@
 # Distributed under the terms of the 3-clause BSD License.
 
 
+import ast
+import copy
+import hashlib
+import multiprocessing
+import pickle
 import subprocess
 import sys
 import re
+import types
+import weakref
 
 from collections import Iterable, Mapping, Sequence
-from typing import Any, Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+from typing import Any, Dict, List, Optional, Set
 
 from .eval import SoS_eval, SoS_exec, accessed_vars
 from .parser import SoS_Step
 from .targets import (dynamic, remote, sos_targets, sos_step)
-from .utils import env, get_traceback, separate_options
+from .utils import (add_glob_dirs, env, get_traceback, record_glob_dirs,
+                    separate_options)
 from .executor_utils import  __null_func__
 
-def analyze_section(section: SoS_Step, default_input: Optional[sos_targets] = None) -> Dict[str, Any]:
-    '''Analyze a section for how it uses input and output, what variables
-    it uses, and input, output, etc.'''
+#
+# variables defined by global definitions, which are executed only once for
+# each dictionary (namely each run) of a workflow
+_global_def_cache = weakref.WeakKeyDictionary()
+#
+# results of analyze_section, which are kept only during the construction
+# or extension of a DAG because the results depend on files on disk
+_section_cache = None
+#
+# sections that are analyzed by forked processes of prefetch_analysis
+_prefetch_sections = None
+
+
+def _assigned_names(script: str) -> Optional[Set[str]]:
+    '''Names that are assigned, imported, or defined by script at module
+    level, or None if they cannot be determined (e.g. import *, global
+    statements in functions, exec, or globals())'''
+    names = set()
+
+    def collect(node):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.add(child.name)
+            elif isinstance(child, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+                continue
+            elif isinstance(child, ast.Name):
+                if isinstance(child.ctx, ast.Store):
+                    names.add(child.id)
+            elif isinstance(child, ast.alias):
+                names.add((child.asname or child.name).split('.')[0])
+            else:
+                collect(child)
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Global) or (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Name) and node.func.id in ('exec', 'globals')):
+            return None
+    collect(tree)
+    return None if '*' in names else names
+
+
+def _copy_globals(values: Dict[str, Any]) -> Dict[str, Any]:
+    # copies of variables defined by global definitions, so that changes to
+    # the variables by one step do not affect the others. Modules are shared.
+    memo = {id(x): x for x in values.values() if isinstance(x, types.ModuleType)}
+    copied = {}
+    for name, value in values.items():
+        try:
+            copied[name] = copy.deepcopy(value, memo)
+        except Exception:
+            copied[name] = value
+    return copied
+
+
+def execute_global_def(global_def: str, with_parameters: bool = True) -> None:
+    '''Execute global definition of a section. If the global definition has
+    been executed in the same dictionary, variables defined by it are restored
+    without executing the statements again.'''
+    cache = _global_def_cache.setdefault(env.sos_dict, {})
+    if (global_def, with_parameters) in cache:
+        env.sos_dict.quick_update(_copy_globals(cache[(global_def, with_parameters)]))
+        return
+    if with_parameters:
+        SoS_exec(global_def)
+    else:
+        # parameters are considered variable and are not handled by removing
+        # function sos_handle_parameter_ from the SoS_dict namespace
+        try:
+            SoS_exec('del sos_handle_parameter_\n' + global_def)
+        finally:
+            SoS_exec('from sos.runtime import sos_handle_parameter_', None)
+    names = _assigned_names(global_def)
+    if names is None:
+        return
+    if not with_parameters:
+        names -= env.parameter_vars
+    cache[(global_def, with_parameters)] = _copy_globals({
+        x: env.sos_dict[x] for x in names if x in env.sos_dict})
+
+
+def analysis_cached(func):
+    '''Decorator that reuses results of analyze_section during the call to
+    func, which builds or extends a DAG.'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _section_cache
+        if _section_cache is not None:
+            return func(*args, **kwargs)
+        _section_cache = {}
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _section_cache = None
+    return wrapper
+
+
+def _uses_default_input(section: SoS_Step) -> bool:
+    '''If the input of section is determined by its default input, namely
+    the output of its previous step.'''
+    for statement in section.statements:
+        if statement[0] == ':' and statement[1] == 'input':
+            try:
+                call = ast.parse(f'__null_func__({statement[2]})', mode='eval').body
+            except SyntaxError:
+                return True
+            return not call.args or any(isinstance(x, ast.Starred) for x in call.args)
+    return False
+
+
+def _value_key(value: Any) -> bytes:
+    try:
+        return pickle.dumps(value)
+    except Exception:
+        # modules, functions etc that are not changed during a run
+        return f'{value.__class__.__name__}:{id(value)}'.encode()
+
+
+def _analysis_key(section: SoS_Step, default_input: Optional[sos_targets]) -> str:
+    # variables that are used by the evaluated directives of the section
+    if ('vars', section.uuid) not in _section_cache:
+        names = set()
+        for statement in section.statements:
+            if statement[0] == ':':
+                names |= accessed_vars(statement[2])
+        if 'shared' in section.options:
+            names |= accessed_vars(section.options._expressions['shared'])
+        _section_cache[('vars', section.uuid)] = (sorted(names), _uses_default_input(section))
+    names, uses_default_input = _section_cache[('vars', section.uuid)]
+    md5 = hashlib.md5()
+    md5.update(f'{section.uuid} {section.step_name()} {section.options!r}'.encode())
+    if uses_default_input:
+        md5.update(_value_key(default_input))
+    if 'provides' in section.options:
+        md5.update(_value_key(env.sos_dict.get('__default_output__', None)))
+    for name in names:
+        if name in env.sos_dict:
+            md5.update(name.encode())
+            md5.update(_value_key(env.sos_dict[name]))
+    return md5.hexdigest()
+
+
+def _analyze_in_process(idx: int):
+    # executed in a forked process, which has its own copy of the dictionary,
+    # working directory etc, so the analysis does not affect the master.
+    # Directories globbed by the analysis are returned to the master.
+    glob_dirs = set()
+    record_glob_dirs(glob_dirs)
+    section = _prefetch_sections[idx]
+    res = _analyze_statements(section, None, _prepare_analysis(section))
+    input_set = 'input' in env.sos_dict and env.sos_dict['input'] is res['step_input']
+    return (pickle.dumps(res), input_set), glob_dirs
+
+
+def prefetch_analysis(sections: List[SoS_Step], max_workers: int) -> None:
+    '''Analyze sections that do not depend on the output of their previous
+    steps in a pool of forked processes so that the evaluation of their input,
+    output and depends statements (e.g. glob of large directories) overlaps.
+    The results are saved to the cache of analyze_section and errors are left
+    to the sequential analysis.'''
+    global _prefetch_sections
+    if _section_cache is None or max_workers < 2 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        return
+    # auxiliary sections can appear more than once with different names
+    sections = [x for x in {id(x): x for x in sections}.values()
+                if 'skip' not in x.options and 'provides' not in x.options
+                and not _uses_default_input(x)]
+    # keys of the analysis are calculated from the dictionary prepared for
+    # each section, as analyze_section does
+    jobs = {}
+    for section in sections:
+        try:
+            _prepare_analysis(section)
+            key = _analysis_key(section, None)
+        except Exception as e:
+            env.logger.debug(f'Failed to prepare analysis of {section.step_name()}: {e}')
+            continue
+        if key not in _section_cache:
+            jobs.setdefault(key, section)
+    if len(jobs) < 2:
+        return
+    _prefetch_sections = list(jobs.values())
+    try:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs)),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = {key: executor.submit(_analyze_in_process, idx)
+                       for idx, key in enumerate(jobs)}
+            for key, future in futures.items():
+                try:
+                    _section_cache[key], glob_dirs = future.result()
+                    add_glob_dirs(glob_dirs)
+                except Exception as e:
+                    env.logger.debug(f'Failed to analyze {jobs[key].step_name()} in advance: {e}')
+    finally:
+        _prefetch_sections = None
+
+
+def _prepare_analysis(section: SoS_Step) -> sos_targets:
+    # prepare the dictionary for the analysis of section, namely execute its
+    # global definition, and return its default output
     from ._version import __version__
 
     # these are the information we need to build a DAG, by default
@@ -28,16 +238,10 @@ def analyze_section(section: SoS_Step, default_input: Optional[sos_targets] = No
     # step input and output can be true "Undetermined", namely unspecified,
     # can be dynamic and has to be determined at run time, or undetermined
     # at this stage because something cannot be determined now.
-    step_input: sos_targets = sos_targets()
     step_output: sos_targets = sos_targets()
-    step_depends: sos_targets = sos_targets([])
-    environ_vars = set()
-    signature_vars = set()
-    changed_vars = set()
     #
     # 1. execute global definition to get a basic environment
     #
-    # FIXME: this could be made much more efficient
     if 'provides' in section.options:
         if '__default_output__' in env.sos_dict:
             step_output = env.sos_dict['__default_output__']
@@ -56,12 +260,11 @@ def analyze_section(section: SoS_Step, default_input: Optional[sos_targets] = No
     #
     # Here we need to get "contant" values from the global section
     # Because parameters are considered variable, they has to be
-    # removed. We achieve this by removing function sos_handle_parameter_
-    # from the SoS_dict namespace
+    # removed.
     #
     if section.global_def:
         try:
-            SoS_exec('del sos_handle_parameter_\n' + section.global_def)
+            execute_global_def(section.global_def, with_parameters=False)
         except subprocess.CalledProcessError as e:
             raise RuntimeError(e.stderr)
         except RuntimeError as e:
@@ -69,9 +272,38 @@ def analyze_section(section: SoS_Step, default_input: Optional[sos_targets] = No
                 sys.stderr.write(get_traceback())
             raise RuntimeError(
                 f'Failed to execute statements\n"{section.global_def}"\n{e}')
-        finally:
-            SoS_exec('from sos.runtime import sos_handle_parameter_', None)
+    return step_output
 
+
+def analyze_section(section: SoS_Step, default_input: Optional[sos_targets] = None) -> Dict[str, Any]:
+    '''Analyze a section for how it uses input and output, what variables
+    it uses, and input, output, etc.'''
+    step_output = _prepare_analysis(section)
+    if _section_cache is None:
+        return _analyze_statements(section, default_input, step_output)
+    key = _analysis_key(section, default_input)
+    if key not in _section_cache:
+        res = _analyze_statements(section, default_input, step_output)
+        # remember if variable input is set by the analysis
+        input_set = 'input' in env.sos_dict and env.sos_dict['input'] is res['step_input']
+        try:
+            _section_cache[key] = (pickle.dumps(res), input_set)
+        except Exception as e:
+            env.logger.debug(f'Failed to cache analysis of {section.step_name()}: {e}')
+        return res
+    # results can be modified by the caller so we always return a new copy
+    res = pickle.loads(_section_cache[key][0])
+    if _section_cache[key][1]:
+        env.sos_dict.set('input', res['step_input'])
+    return res
+
+
+def _analyze_statements(section: SoS_Step, default_input: Optional[sos_targets], step_output: sos_targets) -> Dict[str, Any]:
+    step_input: sos_targets = sos_targets()
+    step_depends: sos_targets = sos_targets([])
+    environ_vars = set()
+    signature_vars = set()
+    changed_vars = set()
     #
     # 2. look for input statement
     if 'shared' in section.options:
@@ -4,7 +4,9 @@
 # Distributed under the terms of the 3-clause BSD License.
 
 import copy
+import heapq
 import os
+import pickle
 import subprocess
 import sys
 import time
@@ -14,6 +16,7 @@ from collections import Iterable, Mapping, Sequence, defaultdict
 from itertools import combinations, tee
 from typing import List, Union
 
+from .controller import bind_to_random_endpoint
 from .eval import SoS_eval, SoS_exec, accessed_vars
 from .pattern import extract_pattern
 from .syntax import (SOS_DEPENDS_OPTIONS, SOS_INPUT_OPTIONS,
@@ -22,8 +25,10 @@ from .targets import (RemovedTarget, RuntimeInfo, UnavailableLock,
                       UnknownTarget, dynamic, file_target,
                       sos_targets, sos_step)
 from .tasks import MasterTaskParams, TaskFile
+from .tracing import traced
 from .utils import (StopInputGroup, TerminateExecution, ArgumentError, env,
-                    expand_size, format_HHMMSS, get_traceback, short_repr)
+                    expand_size, format_HHMMSS, get_traceback, invalidate_dir_listing,
+                    short_repr)
 from .executor_utils import (clear_output, create_task, verify_input, reevaluate_output,
                     validate_step_sig, statementMD5, get_traceback_msg)
 
@@ -42,7 +47,7 @@ class TaskManager:
         self._unsubmitted_tasks = []
         # derived from _unsubmitted_tasks
         self._all_ids = []
-        self._all_output = []
+        self._all_output = sos_targets()
         #
         self._terminate = False
         #
@@ -216,6 +221,103 @@ def evaluate_shared(vars, option):
         raise RuntimeError(f'Unacceptable shared option. Only str, sequence, or mapping are accepted in sequence: {option}')
     return shared_vars
 
+
+# number of items of for_each variables that are read at a time
+_for_each_chunk_size = 1000
+
+
+class _ForEachValues:
+    # Values of a for_each variable that are accessed by index. Values that are
+    # not sequences, such as pandas Series and Index, numpy arrays, or arrays
+    # backed by files (e.g. numpy.memmap), are read in chunks of
+    # _for_each_chunk_size items instead of one item at a time. Rows of pandas
+    # DataFrame are taken by position from chunks of rows.
+    def __init__(self, values):
+        self._values = values
+        self._chunk_start = 0
+        self._chunk = []
+
+    def __getitem__(self, idx):
+        values = self._values
+        if isinstance(values, Sequence):
+            return values[idx]
+        # values can only be pandas objects if pandas has been imported
+        pd = sys.modules.get('pandas', None)
+        if idx < self._chunk_start or idx >= self._chunk_start + len(self._chunk):
+            self._chunk_start = idx - idx % _for_each_chunk_size
+            end = self._chunk_start + _for_each_chunk_size
+            if pd is not None and isinstance(values, pd.DataFrame):
+                self._chunk = values.iloc[self._chunk_start:end]
+            elif pd is not None and isinstance(values, pd.Series):
+                self._chunk = values.iloc[self._chunk_start:end].array
+            else:
+                self._chunk = values[self._chunk_start:end]
+        if pd is not None and isinstance(self._chunk, pd.DataFrame):
+            return self._chunk.iloc[idx - self._chunk_start]
+        return self._chunk[idx - self._chunk_start]
+
+
+class _InputGroups(Sequence):
+    # Input groups that are created when they are accessed, so that steps with
+    # a large number of substeps do not create all groups before the first one
+    # is executed. Groups repeated by for_each are not copied.
+    def __init__(self, get_group, size, repeat=1):
+        self._get_group = get_group
+        self._size = size
+        self._repeat = repeat
+
+    def repeated(self, times):
+        return _InputGroups(self._get_group, self._size, self._repeat * times)
+
+    def __len__(self):
+        return self._size * self._repeat
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in range(len(self))[idx]]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('input group index out of range')
+        return self._get_group(idx % self._size)
+
+
+class _SubstepVars(Sequence):
+    # Variables of substeps, which are created when they are accessed. base_vars
+    # are variables of input groups (None if there is none), and each for_each
+    # loop repeats all existing substeps for each of its values, so that
+    # substep idx = loop_idx * n_groups + group_idx after the first loop.
+    def __init__(self, base_vars, n_groups, loops=[]):
+        self._base_vars = base_vars
+        self._n_groups = n_groups
+        self._loops = loops
+
+    def expanded(self, names, values, size):
+        return _SubstepVars(self._base_vars, self._n_groups,
+            self._loops + [(names, values, size)])
+
+    def __len__(self):
+        size = self._n_groups
+        for loop in self._loops:
+            size *= loop[2]
+        return size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in range(len(self))[idx]]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('substep index out of range')
+        vars = {} if self._base_vars is None else dict(self._base_vars[idx % self._n_groups])
+        idx //= self._n_groups
+        for names, values, size in self._loops:
+            for name, value in zip(names, values):
+                vars[name] = value[idx % size]
+            idx //= size
+        return vars
+
+
 class Base_Step_Executor:
     # This base class defines how steps are executed. The derived classes will reimplement
     # some function to behave differently in different modes.
@@ -258,7 +360,7 @@ class Base_Step_Executor:
     def handle_group_by(ifiles: sos_targets, group_by: Union[int, str]):
         '''Handle input option group_by'''
         if group_by == 'single':
-            return [ifiles.slice(x) for x in range(len(ifiles))]
+            return _InputGroups(ifiles.slice, len(ifiles))
         elif group_by == 'all':
             # default option
             return [ifiles]
@@ -356,7 +458,8 @@ class Base_Step_Executor:
             if group_by < 1:
                 raise ValueError(
                     'Value of paramter group_by should be a positive number.')
-            return [ifiles.slice(slice(i,i + group_by)) for i in range(0, len(ifiles), group_by)]
+            return _InputGroups(lambda i: ifiles.slice(slice(i * group_by, (i + 1) * group_by)),
+                (len(ifiles) + group_by - 1) // group_by)
         elif callable(group_by):
             try:
                 return [sos_targets(x) for x in group_by(ifiles)]
@@ -479,7 +582,8 @@ class Base_Step_Executor:
                 res.keys(), ifiles, _groups, _vars)
 
     @staticmethod
-    def handle_for_each(for_each, _groups: List[sos_targets], _vars: List[dict]):
+    def handle_for_each(for_each, _groups: Sequence, _vars: _SubstepVars):
+        '''Handle input option for_each and return expanded groups and vars'''
         if for_each is None or not for_each:
             for_each = []
         elif isinstance(for_each, (str, dict)):
@@ -533,43 +637,31 @@ class Base_Step_Executor:
             # get loop size
             loop_size = None
             for name, values in zip(fe_iter_names, fe_values):
-                if not isinstance(values, Sequence):
-                    try:
-                        import pandas as pd
-                        if not isinstance(values, (pd.DataFrame, pd.Series, pd.Index)):
-                            raise ValueError(
-                                f'Unacceptable for_each data type {values.__class__.__name__}')
-                    except Exception as e:
-                        raise ValueError(
-                            f'Cannot iterate through variable {name}: {e}')
+                # besides sequences, objects with a length that can be sliced,
+                # such as pandas DataFrame, Series, Index, and numpy arrays
+                # are accepted
+                if not isinstance(values, Sequence) and (isinstance(values, Mapping) or
+                        not hasattr(values, '__len__') or not hasattr(values, '__getitem__')):
+                    raise ValueError(
+                        f'Cannot iterate through variable {name}: Unacceptable for_each data type {values.__class__.__name__}')
                 if loop_size is None:
                     loop_size = len(values)
                 elif loop_size != len(values):
                     raise ValueError(
                         f'Length of variable {name} (length {len(values)}) should match the length of other variables (length {loop_size}).')
-            # expand
-            _tmp_groups = copy.deepcopy(_groups)
-            _groups.clear()
-            for _ in range(loop_size):
-                _groups.extend(_tmp_groups)
-            #
-            _tmp_vars = copy.deepcopy(_vars)
-            _vars.clear()
-            for vidx in range(loop_size):
-                for idx, _ in enumerate(_tmp_vars):
-                    for var_name, values in zip(fe_iter_names, fe_values):
-                        if isinstance(values, Sequence):
-                            _tmp_vars[idx][var_name] = values[vidx]
-                        elif isinstance(values, (pd.DataFrame, pd.Series)):
-                            _tmp_vars[idx][var_name] = values.iloc[vidx]
-                        elif isinstance(values, pd.Index):
-                            _tmp_vars[idx][var_name] = values[vidx]
-                        else:
-                            raise ValueError(
-                                f'Failed to iterate through for_each variable {short_repr(values)}')
-                _vars.extend(copy.deepcopy(_tmp_vars))
+            # expand. Groups are shared by substeps because each substep gets
+            # a copy-on-write copy of its group as _input. Variables of each
+            # substep are created from the loop values when the substep is
+            # executed.
+            if not isinstance(_groups, _InputGroups):
+                _groups = _InputGroups(_groups.__getitem__, len(_groups))
+            _groups = _groups.repeated(loop_size)
+            _vars = _vars.expanded(fe_iter_names,
+                [_ForEachValues(x) for x in fe_values], loop_size)
+        return _groups, _vars
 
     # directive input
+    @traced
     def process_input_args(self, ifiles: sos_targets, **kwargs):
         """This function handles directive input and all its parameters.
         It
@@ -632,7 +724,11 @@ class Base_Step_Executor:
         else:
             _groups = [ifiles]
         #
-        _vars = [{} for x in _groups]
+        # variables of input groups are only created if they are set
+        if any(x in kwargs for x in ('paired_with', 'pattern', 'group_with')):
+            _vars = [{} for x in _groups]
+        else:
+            _vars = None
         # handle paired_with
         if 'paired_with' in kwargs:
             Base_Step_Executor.handle_paired_with(
@@ -646,8 +742,9 @@ class Base_Step_Executor:
             Base_Step_Executor.handle_group_with(
                 kwargs['group_with'], ifiles,  _groups, _vars)
         # handle for_each
+        _vars = _SubstepVars(_vars, len(_groups))
         if 'for_each' in kwargs:
-            Base_Step_Executor.handle_for_each(
+            _groups, _vars = Base_Step_Executor.handle_for_each(
                 kwargs['for_each'], _groups, _vars)
         return _groups, _vars
 
@@ -692,7 +789,7 @@ class Base_Step_Executor:
             env.sos_dict.set('step_output', copy.deepcopy(ofiles))
         else:
             for ofile in ofiles:
-                if ofile in env.sos_dict['step_output']._targets:
+                if ofile in env.sos_dict['step_output']:
                     raise ValueError(
                         f'Output {ofile} from substep {env.sos_dict["_index"]} overlaps with output from a previous substep')
             env.sos_dict['step_output'].extend(ofiles)
@@ -752,6 +849,7 @@ class Base_Step_Executor:
             self.submit_tasks(tasks)
         return task_id
 
+    @traced
     def wait_for_results(self, all_submitted):
         if self.concurrent_substep:
             self.wait_for_substep()
@@ -793,36 +891,38 @@ class Base_Step_Executor:
             if tf.has_stdout():
                 print(TaskFile(tid).stdout)
 
-        for idx, task in enumerate(self.proc_results):
+        task_results = {}
+        for idx, task in self.proc_results.items():
             # if it is done
-            if isinstance(task, dict):
+            if not isinstance(task, str):
                 continue
             if task in results:
-                self.proc_results[idx] = results[task]
+                task_results[idx] = results[task]
             else:
                 # can be a subtask
                 for _, mres in results.items():
                     if 'subtasks' in mres and task in mres['subtasks']:
-                        self.proc_results[idx] = mres['subtasks'][task]
+                        task_results[idx] = mres['subtasks'][task]
                     elif 'exception' in mres:
-                        self.proc_results[idx] = mres
+                        task_results[idx] = mres
         #
         # check if all have results?
-        if any(isinstance(x, str) for x in self.proc_results):
+        missing = [x for idx, x in self.proc_results.items()
+                   if isinstance(x, str) and idx not in task_results]
+        if missing:
             raise RuntimeError(
-                f'Failed to get results for tasks {", ".join(x for x in self.proc_results if isinstance(x, str))}')
+                f'Failed to get results for tasks {", ".join(missing)}')
         #
-        for idx, res in enumerate(self.proc_results):
+        for idx, res in task_results.items():
             if 'skipped' in res and res['skipped']:
                 self.completed['__task_skipped__'] += 1
                 # complete case: task skipped
-                env.controller_push_socket.send_pyobj(['progress', 'substep_completed', env.sos_dict['step_id']])
+                self.report_progress('substep_completed')
             else:
                 # complete case: task completed
-                env.controller_push_socket.send_pyobj(['progress', 'substep_ignored', env.sos_dict['step_id']])
+                self.report_progress('substep_ignored')
                 self.completed['__task_completed__'] += 1
-            if 'shared' in res:
-                self.shared_vars[idx].update(res['shared'])
+            self.fold_result(idx, res)
 
     def log(self, stage=None, msg=None):
         if stage == 'start':
@@ -831,11 +931,11 @@ class Base_Step_Executor:
         elif stage == 'input statement':
             env.logger.trace(f'Handling input statement {msg}')
         elif stage == '_input':
-            if env.sos_dict['_input'] is not None:
+            if env.sos_dict['_input'] is not None and env.verbosity > 2:
                 env.logger.debug(
                     f'_input: ``{short_repr(env.sos_dict["_input"])}``')
         elif stage == '_depends':
-            if env.sos_dict['_depends'] is not None:
+            if env.sos_dict['_depends'] is not None and env.verbosity > 2:
                 env.logger.debug(
                     f'_depends: ``{short_repr(env.sos_dict["_depends"])}``')
         elif stage == 'input':
@@ -863,24 +963,112 @@ class Base_Step_Executor:
     def prepare_substep(self):
         # socket to collect result
         self.result_pull_socket = env.zmq_context.socket(zmq.PULL)
-        port = self.result_pull_socket.bind_to_random_port('tcp://127.0.0.1')
-        env.config['sockets']['result_push_socket'] = port
-
-    def submit_substep(self, substep):
-        env.substep_frontend_socket.send_pyobj(substep)
+        env.config['sockets']['result_push_socket'] = bind_to_random_endpoint(
+            self.result_pull_socket)
+        # number of substeps that have been submitted but not returned
+        self._pending_substeps = 0
+
+    @traced
+    def submit_substep(self, substep, buffers=None):
+        # throttle the submission of substeps by collecting results of
+        # submitted substeps if there are too many of them pending
+        while self._pending_substeps >= env.config['substep_queue_hwm']:
+            self.process_substep_result(self.result_pull_socket.recv_pyobj())
+        # proc_vars are pickled, and out-of-band buffers of them are sent as
+        # separate frames. Messages are sent by zmq after send_multipart
+        # returns so only read-only buffers are sent without being copied.
+        # Writable buffers (e.g. numpy arrays) could be changed in the
+        # meantime by the next substep and are copied.
+        frames = [pickle.dumps(substep, protocol=pickle.HIGHEST_PROTOCOL)]
+        if buffers:
+            frames.extend(x if x.readonly else bytes(x) for x in buffers)
+        env.substep_frontend_socket.send_multipart(frames, copy=not buffers)
+        self._pending_substeps += 1
+
+    def process_substep_result(self, res):
+        self._pending_substeps -= 1
+        if "index" not in res:
+            raise RuntimeError("Result received from substep does not have key index")
+        if 'task_id' not in res and 'exception' not in res:
+            # complete case: concurrent ignore or execution without task
+            self.report_progress('substep_ignored' if res.get('sig_skipped', 0) else 'substep_completed')
+        if 'task_id' in res:
+            # if substep returns tasks, the substep is pending until the
+            # completion of the task
+            task = self.submit_task(res['task_id'], res['task_def'], res['task_vars'])
+            self.proc_results[res['index']] = task
+            return
+        self.fold_result(res['index'], res)
+
+    def add_pending(self, idx, task=None):
+        # a concurrent substep (None) or a task (task id) is pending
+        self.proc_results[idx] = task
+        heapq.heappush(self._pending_indexes, idx)
+
+    def fold_result(self, idx, res):
+        # results of substeps and tasks are folded into the step as they
+        # arrive so that only results of failed ones are kept until the end
+        # of the step
+        if 'sig_skipped' in res:
+            self.completed['__substep_skipped__'] += 1
+            self.completed['__substep_completed__'] -= 1
+        if 'output' in res and env.sos_dict['step_output'].undetermined():
+            self.set_output_group(idx, res['output'])
+        if 'shared' in res and res['shared']:
+            self.share_vars(idx, res['shared'])
+        if res['ret_code'] != 0:
+            self.proc_results[idx] = res
+        else:
+            self.proc_results.pop(idx, None)
+            if res.get('stdout', None) or res.get('stderr', None):
+                heapq.heappush(self._completed_output,
+                               (idx, res.get('stdout', None), res.get('stderr', None)))
+        self.flush_output()
+
+    def flush_output(self):
+        # output of completed substeps is written after the output of all
+        # previous substeps, which can complete later
+        pending = self._pending_indexes
+        while pending and isinstance(self.proc_results.get(pending[0], {}), dict):
+            heapq.heappop(pending)
+        while self._completed_output and (not pending or self._completed_output[0][0] < pending[0]):
+            _, stdout, stderr = heapq.heappop(self._completed_output)
+            if stdout:
+                sys.stdout.write(stdout)
+            if stderr:
+                sys.stderr.write(stderr)
+
+    def set_output_group(self, idx, output):
+        # only non-empty output groups are kept
+        if output:
+            self.output_groups[idx] = output
+        else:
+            self.output_groups.pop(idx, None)
 
+    def share_vars(self, idx, vars):
+        # variables of substeps are only kept if they are needed by option shared
+        if 'shared' in self.step.options:
+            self.shared_vars.setdefault(idx, {}).update(vars)
+
+    def report_progress(self, status):
+        # progress of substeps is accumulated and sent to the controller
+        # at most once a second, instead of one message per substep
+        self._substep_progress[status] += 1
+        if time.time() - self._progress_last_flushed > 1:
+            self.flush_progress()
+
+    def flush_progress(self):
+        if self._substep_progress:
+            env.controller_push_socket.send_pyobj(['progress', 'substep_counts',
+                env.sos_dict['step_id'], self._substep_progress['substep_completed'],
+                self._substep_progress['substep_ignored']])
+            self._substep_progress.clear()
+        self._progress_last_flushed = time.time()
+
+    @traced
     def wait_for_substep(self):
-        for ss in self.proc_results:
-            res = self.result_pull_socket.recv_pyobj()
-            #
-            if "index" not in res:
-                raise RuntimeError("Result received from substep does not have key index")
-            if 'task_id' in res:
-                # if substep returns tasks, ...
-                task = self.submit_task(res['task_id'], res['task_def'], res['task_vars'])
-                self.proc_results[res['index']] = task
-            else:
-                self.proc_results[res['index']] = res
+        while self._pending_substeps > 0:
+            self.process_substep_result(self.result_pull_socket.recv_pyobj())
 
     def collect_result(self):
         # only results will be sent back to the master process
@@ -902,6 +1090,7 @@ class Base_Step_Executor:
         result['__shared__'] = {}
         if 'shared' in self.step.options:
             result['__shared__'] = self.shared_vars
+        self.flush_progress()
         env.controller_push_socket.send_pyobj(['progress', 'step_completed',
             -1 if 'sos_run' in env.sos_dict['__signature_vars__'] else self.completed['__step_completed__'],
             env.sos_dict['step_name'], env.sos_dict['step_output']])
@@ -915,6 +1104,11 @@ class Base_Step_Executor:
         self.last_res = None
         self.start_time = time.time()
         self.completed = defaultdict(int)
+        # progress of substeps that have not been sent to the controller
+        self._substep_progress = defaultdict(int)
+        self._progress_last_flushed = self.start_time
+        # outputs of previous steps could have been written by other processes
+        invalidate_dir_listing()
         #
         # prepare environments, namely variables that can be used by the step
         #
@@ -963,8 +1157,9 @@ class Base_Step_Executor:
         # _index is needed for pre-input action's active option and for debug output of scripts
         env.sos_dict.set('_index', 0)
 
-        env.logger.trace(
-            f'Executing step {env.sos_dict["step_name"]} with step_input {env.sos_dict["step_input"]} and step_output {env.sos_dict["step_output"]}')
+        if env.verbosity > 3:
+            env.logger.trace(
+                f'Executing step {env.sos_dict["step_name"]} with step_input {env.sos_dict["step_input"]} and step_output {env.sos_dict["step_output"]}')
 
         # look for input statement.
         input_statement_idx = [idx for idx, x in enumerate(
@@ -1032,21 +1227,26 @@ class Base_Step_Executor:
             # assuming everything starts from 0 is after input
             input_statement_idx = 0
 
-        self.proc_results = []
+        # results of pending and failed substeps and tasks by their indexes,
+        # heap of indexes of pending ones, and heap of output of completed
+        # substeps that is not yet written
+        self.proc_results = {}
+        self._pending_indexes = []
+        self._completed_output = []
         self.vars_to_be_shared = set()
         if 'shared' in self.step.options:
             self.vars_to_be_shared = parse_shared_vars(self.step.options['shared'])
         self.vars_to_be_shared = sorted([x[5:] if x.startswith('step_') else x for x in self.vars_to_be_shared if x not in ('step_', 'step_input', 'step_output', 'step_depends')])
-        self.shared_vars = [{} for x in self._substeps]
+        # shared variables of substeps by their indexes
+        self.shared_vars = {}
         # run steps after input statement, which will be run multiple times for each input
         # group.
         env.sos_dict.set('__num_groups__', len(self._substeps))
 
         # determine if a single index or the whole step should be skipped
         skip_index = False
-        # signatures of each index, which can remain to be None if no output
-        # is defined.
-        self.output_groups = [[] for x in self._substeps]
+        # non-empty output of substeps by their indexes
+        self.output_groups = {}
 
         if self.concurrent_substep:
             if len([
@@ -1064,9 +1264,11 @@ class Base_Step_Executor:
         try:
             self.completed['__substep_skipped__'] = 0
             self.completed['__substep_completed__'] = len(self._substeps)
-            # pending signatures are signatures for steps with external tasks
-            pending_signatures = [None for x in self._substeps]
+            # pending signatures are signatures for substeps with external
+            # tasks, which are written after the completion of the tasks
+            pending_signatures = {}
             for idx, (g, v) in enumerate(zip(self._substeps, self._vars)):
+                pending_sig = None
                 # other variables
                 #
                 env.sos_dict.update(v)
@@ -1101,7 +1303,7 @@ class Base_Step_Executor:
                         post_statement = [['!', '']]
                     else:
                         # complete case: no step, no statement
-                        env.controller_push_socket.send_pyobj(['progress', 'substep_completed', env.sos_dict['step_id']])
+                        self.report_progress('substep_completed')
 
                 for statement in pre_statement + self.step.statements[input_statement_idx:] + post_statement:
                     # if input is undertermined, we can only process output:
@@ -1121,12 +1323,12 @@ class Base_Step_Executor:
                                         'step_output', sos_targets())
                                 ofiles: sos_targets = expand_output_files(value, *args)
                                 if g.valid() and ofiles.valid():
-                                    if any(x in g._targets for x in ofiles if not isinstance(x, sos_step)):
+                                    if any(x in g for x in ofiles if not isinstance(x, sos_step)):
                                         raise RuntimeError(
                                             f'Overlapping input and output files: {", ".join(repr(x) for x in ofiles if x in g)}')
                                 # set variable _output and output
                                 self.process_output_args(ofiles, **kwargs)
-                                self.output_groups[idx] = env.sos_dict['_output']
+                                self.set_output_group(idx, env.sos_dict['_output'])
                             elif key == 'depends':
                                 try:
                                     dfiles = expand_depends_files(*args)
@@ -1167,20 +1369,20 @@ class Base_Step_Executor:
                                 #
                                 # __step_context__ is not needed because substep
                                 # executor does not support nested workflow
-                                proc_vars = env.sos_dict.clone_selected_vars(
+                                proc_vars, buffers = env.sos_dict.pickle_selected_vars(
                                     env.sos_dict['__signature_vars__']
                                     | {'_input', '_output', '_depends', '_index',
                                      'step_output', '__args__', 'step_name',
                                       '_runtime', 'step_id', 'workflow_id',
                                       '__signature_vars__'})
 
-                                self.proc_results.append({})
+                                self.add_pending(idx)
                                 self.submit_substep(dict(stmt=statement[1],
                                     global_def=self.step.global_def,
                                     task=self.step.task,
                                     proc_vars=proc_vars,
                                     shared_vars=self.vars_to_be_shared,
-                                    config=env.config))
+                                    config=env.config), buffers)
                             else:
                                 if env.config['sig_mode'] == 'ignore' or env.sos_dict['_output'].unspecified():
                                     env.logger.trace(f'Execute substep {env.sos_dict["step_name"]} without signature')
@@ -1191,10 +1393,10 @@ class Base_Step_Executor:
                                         if not self.step.task:
                                             # if no task, this step is __completed
                                             # complete case: local skip without task
-                                            env.controller_push_socket.send_pyobj(['progress', 'substep_completed', env.sos_dict['step_id']])
+                                            self.report_progress('substep_completed')
                                     if 'shared' in self.step.options:
                                         try:
-                                            self.shared_vars[env.sos_dict['_index']].update({
+                                            self.share_vars(env.sos_dict['_index'], {
                                                 x:env.sos_dict[x] for x in self.vars_to_be_shared
                                                     if x in env.sos_dict})
                                         except Exception as e:
@@ -1214,11 +1416,11 @@ class Base_Step_Executor:
                                     skip_index = bool(matched)
                                     if matched:
                                         if env.sos_dict['step_output'].undetermined():
-                                            self.output_groups[env.sos_dict['_index']] = matched["output"]
+                                            self.set_output_group(env.sos_dict['_index'], matched["output"])
                                         if 'vars' in matched:
-                                            self.shared_vars[env.sos_dict['_index']].update(matched["vars"])
+                                            self.share_vars(env.sos_dict['_index'], matched["vars"])
                                         # complete case: local skip without task
-                                        env.controller_push_socket.send_pyobj(['progress', 'substep_ignored', env.sos_dict['step_id']])
+                                        self.report_progress('substep_ignored')
                                     else:
                                         sig.lock()
                                         try:
@@ -1226,7 +1428,7 @@ class Base_Step_Executor:
                                             self.execute(statement[1])
                                             if 'shared' in self.step.options:
                                                 try:
-                                                    self.shared_vars[env.sos_dict['_index']].update({
+                                                    self.share_vars(env.sos_dict['_index'], {
                                                         x:env.sos_dict[x] for x in self.vars_to_be_shared
                                                             if x in env.sos_dict})
                                                 except Exception as e:
@@ -1238,18 +1440,18 @@ class Base_Step_Executor:
                                             if not self.step.task:
                                                 if env.sos_dict['step_output'].undetermined():
                                                     output = reevaluate_output()
-                                                    self.output_groups[env.sos_dict['_index']] = output
+                                                    self.set_output_group(env.sos_dict['_index'], output)
                                                     sig.set_output(output)
                                                 sig.write()
                                                 # complete case : local execution without task
-                                                env.controller_push_socket.send_pyobj(['progress', 'substep_completed', env.sos_dict['step_id']])
+                                                self.report_progress('substep_completed')
                                             else:
-                                                pending_signatures[idx] = sig
+                                                pending_sig = sig
                                             sig.release()
 
 
                         except StopInputGroup as e:
-                            self.output_groups[idx] = []
+                            self.set_output_group(idx, [])
                             if e.message:
                                 env.logger.info(e)
                             skip_index = True
@@ -1274,11 +1476,11 @@ class Base_Step_Executor:
                     skip_index = bool(matched)
                     if matched:
                         if env.sos_dict['step_output'].undetermined():
-                            self.output_groups[env.sos_dict['_index']] = matched["output"]
-                        self.shared_vars[env.sos_dict['_index']].update(matched["vars"])
+                            self.set_output_group(env.sos_dict['_index'], matched["output"])
+                        self.share_vars(env.sos_dict['_index'], matched["vars"])
                         # complete case: step with task ignored
-                        env.controller_push_socket.send_pyobj(['progress', 'substep_ignored', env.sos_dict['step_id']])
-                    pending_signatures[idx] = sig
+                        self.report_progress('substep_ignored')
+                    pending_sig = sig
 
                 # if this index is skipped, go directly to the next one
                 if skip_index:
@@ -1325,7 +1527,9 @@ class Base_Step_Executor:
                 try:
                     task_id, taskdef, task_vars = create_task(self.step.global_def, self.step.task)
                     task = self.submit_task(task_id, taskdef, task_vars)
-                    self.proc_results.append(task)
+                    self.add_pending(idx, task)
+                    if pending_sig is not None:
+                        pending_signatures[idx] = pending_sig
                 except Exception as e:
                     # FIXME: cannot catch exception from subprocesses
                     if env.verbosity > 2:
@@ -1340,20 +1544,10 @@ class Base_Step_Executor:
                 # endfor loop for each input group
                 #
             self.wait_for_results(all_submitted=True)
-            for idx, res in enumerate(self.proc_results):
-                if 'sig_skipped' in res:
-                    self.completed['__substep_skipped__'] += 1
-                    self.completed['__substep_completed__'] -= 1
-                if 'output' in res and env.sos_dict['step_output'].undetermined():
-                    self.output_groups[idx] = res['output']
-            # check results
-            for proc_result in [x for x in self.proc_results if x['ret_code'] == 0]:
-                if 'stdout' in proc_result and proc_result['stdout']:
-                    sys.stdout.write(proc_result['stdout'])
-                if 'stderr' in proc_result and proc_result['stderr']:
-                    sys.stderr.write(proc_result['stderr'])
-
-            for proc_result in [x for x in self.proc_results if x['ret_code'] != 0]:
+            # output of successful substeps and tasks has been written so
+            # only failed ones are left
+            self.flush_output()
+            for _, proc_result in sorted(self.proc_results.items()):
                 if 'stdout' in proc_result and proc_result['stdout']:
                     sys.stdout.write(proc_result['stdout'])
                 if 'stderr' in proc_result and proc_result['stderr']:
@@ -1364,22 +1558,25 @@ class Base_Step_Executor:
             # finalize output from output_groups because some output might be skipped
             # this is the final version of the output but we do maintain output
             # during the execution of step, for compatibility.
-            env.sos_dict.set(
-                'step_output', sos_targets(self.output_groups[0]))
-            for og in self.output_groups[1:]:
-                env.sos_dict['step_output'].extend(og)
+            step_output = sos_targets([])
+            for idx in sorted(self.output_groups):
+                step_output.extend(self.output_groups[idx])
+            env.sos_dict.set('step_output', step_output)
             env.sos_dict['step_output'].dedup()
+            invalidate_dir_listing([x for x in env.sos_dict['step_output']._targets
+                                    if isinstance(x, file_target)])
 
             # now that output is settled, we can write remaining signatures
-            for idx, res in enumerate(self.proc_results):
-                if pending_signatures[idx] is not None:
-                    if res['ret_code'] == 0:
-                        pending_signatures[idx].write()
+            for idx, sig in pending_signatures.items():
+                if idx not in self.proc_results:
+                    sig.write()
 
             # if there exists an option shared, the variable would be treated as
             # provides=sos_variable(), and then as step_output
             if 'shared' in self.step.options:
-                self.shared_vars = evaluate_shared(self.shared_vars, self.step.options['shared'])
+                self.shared_vars = evaluate_shared(
+                    [self.shared_vars.get(x, {}) for x in range(len(self._substeps))],
+                    self.step.options['shared'])
                 env.sos_dict.quick_update(self.shared_vars)
             self.log('output')
             self.verify_output()
@@ -1435,7 +1632,8 @@ class Step_Executor(Base_Step_Executor):
 
 
     def submit_tasks(self, tasks):
-        env.logger.debug(f'Send {tasks}')
+        if env.verbosity > 2:
+            env.logger.debug(f'Send {tasks}')
         if 'queue' in env.sos_dict['_runtime'] and env.sos_dict['_runtime']['queue']:
             host = env.sos_dict['_runtime']['queue']
         else:
@@ -1466,8 +1664,9 @@ class Step_Executor(Base_Step_Executor):
         try:
             res = Base_Step_Executor.run(self)
             if self.socket is not None:
-                env.logger.debug(
-                    f'Step {self.step.step_name()} sends result {short_repr(res)}')
+                if env.verbosity > 2:
+                    env.logger.debug(
+                        f'Step {self.step.step_name()} sends result {short_repr(res)}')
                 self.socket.send_pyobj(res)
             else:
                 return res
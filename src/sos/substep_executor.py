@@ -10,7 +10,9 @@ import zmq
 
 from io import StringIO
 
+from .controller import endpoint
 from .eval import SoS_exec
+from .tracing import trace_span
 from .targets import (RemovedTarget, RuntimeInfo, UnavailableLock,
                       UnknownTarget)
 from .executor_utils import (prepare_env, clear_output, verify_input, kill_all_subprocesses,
@@ -91,9 +93,10 @@ def execute_substep(stmt, global_def='', task='', proc_vars={}, shared_vars=[],
 
     try:
         res_socket = env.zmq_context.socket(zmq.PUSH)
-        res_socket.connect(f'tcp://127.0.0.1:{config["sockets"]["result_push_socket"]}')
-        res = _execute_substep(stmt=stmt, global_def=global_def, task=task, proc_vars=proc_vars,
-            shared_vars=shared_vars, config=config)
+        res_socket.connect(endpoint(config["sockets"]["result_push_socket"]))
+        with trace_span('substep', step=proc_vars.get('step_name', ''), index=proc_vars['_index']):
+            res = _execute_substep(stmt=stmt, global_def=global_def, task=task, proc_vars=proc_vars,
+                shared_vars=shared_vars, config=config)
         res_socket.send_pyobj(res)
     finally:
         res_socket.close()
@@ -124,8 +127,6 @@ def _execute_substep(stmt, global_def, task, proc_vars, shared_vars, config):
             if matched:
                 # avoid sig being released in the final statement
                 sig = None
-                # complete case: concurrent ignore without task
-                env.controller_push_socket.send_pyobj(['progress', 'substep_ignored', env.sos_dict['step_id']])
                 return {'index': env.sos_dict['_index'], 'ret_code': 0, 'sig_skipped': 1, 'output': matched['output'],
                     'shared': matched['vars']}
             sig.lock()
@@ -139,13 +140,14 @@ def _execute_substep(stmt, global_def, task, proc_vars, shared_vars, config):
 
         if stmt:
             # statement can be empty for task only substep
-            if capture_output:
-                with stdoutIO() as (out, err):
+            with trace_span('exec'):
+                if capture_output:
+                    with stdoutIO() as (out, err):
+                        SoS_exec(stmt, return_result=False)
+                        outmsg = out.getvalue()
+                        errmsg = err.getvalue()
+                else:
                     SoS_exec(stmt, return_result=False)
-                    outmsg = out.getvalue()
-                    errmsg = err.getvalue()
-            else:
-                SoS_exec(stmt, return_result=False)
         if task:
             task_id, taskdef, task_vars = create_task(global_def, task)
             res = {'index': env.sos_dict['_index'], 'task_id': task_id, 'task_def': taskdef, 'task_vars': task_vars}
@@ -157,12 +159,12 @@ def _execute_substep(stmt, global_def, task, proc_vars, shared_vars, config):
             if sig:
                 sig.set_output(env.sos_dict['_output'])
                 # sig.write will use env.signature_push_socket
-                if sig.write():
+                with trace_span('write_signature'):
+                    written = sig.write()
+                if written:
                     res.update({'output': list(sig.content['output'].keys()), 'shared': sig.content['end_context']})
             if capture_output:
                 res.update({'stdout': outmsg, 'stderr': errmsg})
-            # complete case: concurrent execution without task
-            env.controller_push_socket.send_pyobj(['progress', 'substep_completed', env.sos_dict['step_id']])
         return res
     except (StopInputGroup, TerminateExecution, UnknownTarget, RemovedTarget, UnavailableLock) as e:
         clear_output()
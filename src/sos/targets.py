@@ -3,7 +3,6 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 
-import glob
 import os
 import pickle
 import re
@@ -17,9 +16,9 @@ from pathlib import Path
 from shlex import quote
 from typing import Union, Dict, Any
 import fasteners
-import pkg_resources
 
-from .utils import (Error, env, pickleable, short_repr, stable_repr)
+from .utils import (Error, env, glob_files, invalidate_dir_listing, is_zapped,
+                    pickleable, short_repr, stable_repr)
 
 
 try:
@@ -116,6 +115,9 @@ def fileMD5(filename, partial=True):
 
 class BaseTarget(object):
     '''A base class for all targets (e.g. a file)'''
+    # attributes of file_target are declared as slots so that large number
+    # of file targets do not have a dictionary each
+    __slots__ = ()
 
     def __init__(self, *args):
         self._sigfile = None
@@ -425,6 +427,8 @@ def collapseuser(path):
 class path(type(Path())):
     '''A regular target for files.
     '''
+    __slots__ = ()
+
     CONVERTERS = {
         'u': os.path.expanduser,
         'U': collapseuser,
@@ -500,33 +504,52 @@ class path(type(Path())):
     def __hash__(self):
         return hash(repr(self))
 
-    def zap(self):
-        zap_file = self + '.zapped'
-        if not self.exists() and zap_file.is_file():
+    def zap(self, pool=None):
+        if not self.exists() and is_zapped(self):
             return
         if not self.exists() or not self.is_file():
             raise FileNotFoundError(str(self))
-        with open(zap_file, 'w') as md5:
-            md5.write(
-                f'{self.resolve()}\t{os.path.getmtime(self)}\t{os.path.getsize(self)}\t{fileMD5(self)}\n')
+        # the file is zapped in the background if a ZapPool is specified, in
+        # which case the caller should call pool.wait() before using it
+        if pool is None:
+            self._zap()
+        else:
+            pool.submit(self)
+
+    def _zap(self):
+        st = os.stat(self)
+        md5 = self._fresh_md5(st) or fileMD5(self)
+        with open(self + '.zapped', 'w') as sig:
+            sig.write(
+                f'{self.resolve()}\t{st.st_mtime}\t{st.st_size}\t{md5}\n')
         self.unlink()
+        invalidate_dir_listing([self])
+
+    def _fresh_md5(self, st):
+        # md5 of the file that has been calculated for its signature
+        return None
 
 
 class file_target(path, BaseTarget):
     '''A regular target for files.
     '''
+    __slots__ = ('_md5', '_md5_stat', '_sigfile')
 
     def __init__(self, *args):
         # this is path segments
         super(file_target, self).__init__(*args)
         if len(args) == 1 and isinstance(args[0], file_target):
             self._md5 = args[0]._md5
+            self._md5_stat = args[0]._md5_stat
         else:
             self._md5 = None
+            self._md5_stat = None
 
     def _init(self, template=None):
         super(file_target, self)._init(template)
         self._md5 = None
+        # (mtime, size) of the file when its md5 was calculated
+        self._md5_stat = None
 
     def create_placeholder(self):
         # create an empty placeholder file
@@ -538,7 +561,7 @@ class file_target(path, BaseTarget):
         try:
             if mode in ('any', 'target') and self.exists():
                 return True
-            elif mode == 'any' and (self + '.zapped').exists():
+            elif mode == 'any' and is_zapped(self):
                 return True
             return False
         except Exception as e:
@@ -549,7 +572,7 @@ class file_target(path, BaseTarget):
         try:
             return os.path.getsize(self)
         except:
-            if (self + '.zapped').is_file():
+            if is_zapped(self):
                 with open(self + '.zapped') as sig:
                     line = sig.readline()
                     _, _, s, _ = line.strip().rsplit('\t', 3)
@@ -565,9 +588,11 @@ class file_target(path, BaseTarget):
         '''Return file signature'''
         if self.exists():
             if not self._md5:
+                st = os.stat(self)
                 self._md5 = fileMD5(self)
+                self._md5_stat = (st.st_mtime, st.st_size)
             return (os.path.getmtime(self), os.path.getsize(self), self._md5)
-        elif (self + '.zapped').is_file():
+        elif is_zapped(self):
             with open(self + '.zapped') as sig:
                 line = sig.readline()
                 _, mtime, size, md5 = line.strip().rsplit('\t', 3)
@@ -590,7 +615,7 @@ class file_target(path, BaseTarget):
             except:
                 return False
         if not self.exists():
-            if (self + '.zapped').is_file():
+            if is_zapped(self):
                 with open(self + '.zapped') as sig:
                     line = sig.readline()
                     _, mtime, size, md5 = line.strip().rsplit('\t', 3)
@@ -604,10 +629,26 @@ class file_target(path, BaseTarget):
     def write_sig(self):
         '''Write signature to sig store'''
         if not self._md5:
+            st = os.stat(self)
             self._md5 = fileMD5(self)
+            self._md5_stat = (st.st_mtime, st.st_size)
         with open(self.sig_file(), 'w') as sig:
             sig.write(f'{os.path.getmtime(self)}\t{os.path.getsize(self)}\t{self._md5}')
 
+    def _fresh_md5(self, st):
+        # md5 calculated for the signature of the file is reused if the file
+        # has not been changed since then
+        if self._md5 and self._md5_stat == (st.st_mtime, st.st_size):
+            return self._md5
+        try:
+            with open(self.sig_file()) as sig:
+                mtime, size, md5 = sig.read().strip().split()
+            if float(mtime) == st.st_mtime and int(size) == st.st_size:
+                return md5
+        except Exception:
+            pass
+        return None
+
     def __hash__(self):
         return hash(repr(self))
 
@@ -615,6 +656,63 @@ class file_target(path, BaseTarget):
         return isinstance(obj, file_target) and os.path.abspath(self) == os.path.abspath(obj)
 
 
+class ZapPool:
+    '''A bounded pool of threads that zap files in the background. Files
+    submitted to the pool are not zapped until wait() returns.'''
+
+    def __init__(self, max_workers):
+        self._max_workers = max(max_workers, 1)
+        self._executor = None
+        # futures of files that are being zapped, by name
+        self._pending = {}
+
+    def submit(self, target):
+        if str(target) in self._pending:
+            return
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        # wait for the oldest file if too many files are queued
+        while len(self._pending) >= 2 * self._max_workers:
+            self._pending.pop(next(iter(self._pending))).result()
+        self._pending[str(target)] = self._executor.submit(target._zap)
+
+    def wait(self):
+        '''Wait for the completion of all submitted files, and raise the first
+        error if any of them failed to be zapped'''
+        pending = list(self._pending.values())
+        self._pending.clear()
+        errors = [x.exception() for x in pending]
+        errors = [x for x in errors if x is not None]
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        try:
+            self.wait()
+        except Exception as e:
+            env.logger.warning(f'Failed to zap file: {e}')
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def zap_files(files, pool=None):
+    '''Zap files, with a ZapPool if there are more than one file. Files are
+    zapped before the function returns unless a pool is specified.'''
+    if pool is not None or len(files) < 2:
+        for f in files:
+            f.zap(pool)
+        return
+    pool = ZapPool(env.config['zap_workers'])
+    try:
+        for f in files:
+            f.zap(pool)
+        pool.wait()
+    finally:
+        pool.shutdown()
+
+
 class paths(Sequence, os.PathLike):
     '''A collection of targets'''
     # check if string contains wildcard character
@@ -640,7 +738,7 @@ class paths(Sequence, os.PathLike):
             self._paths.extend(arg._paths)
         elif isinstance(arg, str):
             if self.wildcard.search(arg):
-                matched = sorted(glob.glob(os.path.expanduser(arg)))
+                matched = sorted(glob_files(os.path.expanduser(arg)))
                 if matched:
                     self._paths.extend([path(x) for x in matched])
                 else:
@@ -660,9 +758,8 @@ class paths(Sequence, os.PathLike):
         elif arg is not None:
             self._paths.append(path(str(arg)))
 
-    def zap(self):
-        for p in self._paths:
-            p.zap()
+    def zap(self, pool=None):
+        zap_files(self._paths, pool)
 
     def __getstate__(self):
         return self._paths
@@ -725,6 +822,11 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
     '''
     # check if string contains wildcard character
     wildcard = re.compile('[*?\[]')
+    # if the lists of targets and sources are shared with a copy of this object
+    _shared = False
+    # index of targets as [cwd, keys, absolute paths of file targets, other
+    # targets], built when needed and extended as targets are appended
+    _index = None
 
     def __init__(self, *args, undetermined: Union[bool, str]=None,
         source='', verify_existence=False):
@@ -767,7 +869,38 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
     def valid(self):
         return self._targets or self._undetermined is False
 
+    def _unshare(self):
+        # get private copies of shared lists before they are changed
+        if self._shared:
+            self._targets = list(self._targets)
+            self._sources = list(self._sources)
+            if self._index is not None:
+                self._index = [self._index[0], list(self._index[1]),
+                               set(self._index[2]), set(self._index[3])]
+            self._shared = False
+
+    def _target_index(self):
+        # keys of targets are absolute paths for file targets, which depend on
+        # the current working directory, and the targets themselves otherwise
+        cwd = os.getcwd()
+        if self._index is None or self._index[0] != cwd:
+            self._index = [cwd, [], set(), set()]
+        keys = self._index[1]
+        files = self._index[2]
+        others = self._index[3]
+        for idx in range(len(keys), len(self._targets)):
+            target = self._targets[idx]
+            if isinstance(target, file_target):
+                key = os.path.abspath(target)
+                files.add(key)
+            else:
+                key = target
+                others.add(key)
+            keys.append(key)
+        return self._index
+
     def __append__(self, arg, source='', verify_existence=False):
+        self._unshare()
         if isinstance(arg, paths):
             self._targets.extend([file_target(x) for x in arg._paths])
             self._sources.extend([source]*len(arg._paths))
@@ -776,7 +909,7 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
             self._sources.append(source)
         elif isinstance(arg, str):
             if self.wildcard.search(arg):
-                matched = sorted(glob.glob(os.path.expanduser(arg)))
+                matched = sorted(glob_files(os.path.expanduser(arg)))
                 if matched:
                     self._targets.extend([file_target(x) for x in matched])
                     self._sources.extend([source]*len(matched))
@@ -824,22 +957,47 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
     #    return [x.target_name() if isinstance(x, file_target) else x for x in self._targets]
 
     def extend(self, another):
-        self._targets.extend(sos_targets(another)._targets)
-        self._sources.extend(sos_targets(another)._sources)
+        self._unshare()
+        another = sos_targets(another)
+        self._targets.extend(another._targets)
+        self._sources.extend(another._sources)
 
-    def zap(self):
+    def zap(self, pool=None):
         for target in self._targets:
-            if isinstance(target, file_target):
-                target.zap()
-            else:
+            if not isinstance(target, file_target):
                 env.logger.debug(f'Ignore non-file target {target}')
+        zap_files([x for x in self._targets if isinstance(x, file_target)], pool)
+
+    def __deepcopy__(self, memo):
+        # targets are not changed after creation so a copy shares the lists
+        # of targets and sources with the original object, until one of them
+        # is changed (copy-on-write).
+        ret = self.__class__.__new__(self.__class__)
+        ret._targets = self._targets
+        ret._sources = self._sources
+        ret._undetermined = self._undetermined
+        ret._index = self._index
+        ret._shared = self._shared = True
+        return ret
 
     def __getstate__(self):
+        # file targets are saved by names, and sources are saved as a single
+        # string if they are the same, so that groups of many files are
+        # small to pickle and to send to substeps
+        if all(type(x) is file_target for x in self._targets):
+            sources = self._sources
+            if sources and sources.count(sources[0]) == len(sources):
+                sources = sources[0]
+            return ('file_target', [str(x) for x in self._targets], sources, self._undetermined)
         return (self._targets, self._sources, self._undetermined)
 
     def __setstate__(self, state) -> None:
         if isinstance(state, tuple):
-            if len(state) == 2:
+            if len(state) == 4:
+                self._targets = [file_target(x) for x in state[1]]
+                self._sources = [state[2]] * len(self._targets) if isinstance(state[2], str) else state[2]
+                self._undetermined = state[3]
+            elif len(state) == 2:
                 self._targets = state[0]
                 self._sources = [''] * len(self._targets)
                 self._undetermined = state[1]
@@ -917,10 +1075,35 @@ class sos_targets(BaseTarget, Sequence, os.PathLike):
             raise ValueError(f'Cannot get name() for group of targets {self}')
 
     def dedup(self):
-        self._targets = list(dict.fromkeys(self._targets))
+        # keep the first occurrences of targets and their sources
+        keys = self._target_index()[1]
+        seen = set()
+        kept = []
+        for idx, key in enumerate(keys):
+            if key not in seen:
+                seen.add(key)
+                kept.append(idx)
+        if len(kept) == len(keys):
+            return
+        self._targets = [self._targets[x] for x in kept]
+        self._sources = [self._sources[x] for x in kept]
+        self._index = None
+        self._shared = False
+
+    def __contains__(self, target):
+        _, _, files, others = self._target_index()
+        if isinstance(target, file_target):
+            return os.path.abspath(target) in files
+        try:
+            return target in others
+        except TypeError:
+            # unhashable objects cannot be one of the targets
+            return False
 
     def __hash__(self):
-        return hash(repr(self))
+        # consistent with __eq__, which compares targets, and file targets
+        # by their absolute paths
+        return hash(tuple(self._target_index()[1]))
 
     def __eq__(self, other):
         try:
@@ -1009,8 +1192,9 @@ class InMemorySignature:
             return self.content
         if self.output_files.undetermined():
             self.output_files = env.sos_dict['_output']
-            env.logger.trace(
-                f'Set undetermined output files to {env.sos_dict["_output"]}')
+            if env.verbosity > 3:
+                env.logger.trace(
+                    f'Set undetermined output files to {env.sos_dict["_output"]}')
         input_sig = {}
         for f in self.input_files:
             try:
@@ -1099,10 +1283,10 @@ class InMemorySignature:
                             target_class = eval(target_type)
                         else:
                             # check registry
-                            for entrypoint in pkg_resources.iter_entry_points(group='sos_targets'):
-                                if entrypoint.name.strip() == target_type:
-                                    target_class = entrypoint.load()
-                                    break
+                            from .utils import get_plugin_index, load_plugin
+                            plugins = get_plugin_index().get('sos_targets', {})
+                            if target_type in plugins:
+                                target_class = load_plugin(plugins[target_type][0])
                         if target_class is None:
                             raise ValueError(
                                 f'Failed to identify target class {target_type}')
@@ -1171,7 +1355,7 @@ class RuntimeInfo(InMemorySignature):
             self._lock = None
             raise UnavailableLock(
                 (self.input_files, self.output_files, self.sig_id))
-        else:
+        elif env.verbosity > 3:
             env.logger.trace(
                 f'Lock acquired for output files {short_repr(self.output_files)}')
 
@@ -1183,8 +1367,9 @@ class RuntimeInfo(InMemorySignature):
         if self._lock:
             try:
                 self._lock.release()
-                env.logger.trace(
-                    f'Lock released for output files {short_repr(self.output_files)}')
+                if env.verbosity > 3:
+                    env.logger.trace(
+                        f'Lock released for output files {short_repr(self.output_files)}')
             except Exception as e:
                 if not quiet:
                     env.logger.warning(
@@ -1194,7 +1379,8 @@ class RuntimeInfo(InMemorySignature):
 
     def set_output(self, files: sos_targets):
         # add signature file if input and output files are dynamic
-        env.logger.trace(f'Set output of signature to {files}')
+        if env.verbosity > 3:
+            env.logger.trace(f'Set output of signature to {files}')
         self.output_files = files
 
     def write(self, rebuild=False):
@@ -1204,7 +1390,7 @@ class RuntimeInfo(InMemorySignature):
         '''
         if not self.output_files.valid():
             raise ValueError(f'Cannot write signature with undetermined output {self.output_files}')
-        else:
+        elif env.verbosity > 3:
             env.logger.trace(f'write signature {self.sig_id} with output {self.output_files}')
         ret = super(RuntimeInfo, self).write()
         if ret is False:
@@ -14,7 +14,6 @@ from .targets import (InMemorySignature, UnknownTarget, file_target,
                       remote, sos_step, dynamic, sos_targets)
 from .utils import StopInputGroup, env, short_repr, pickleable
 from .tasks import TaskFile, remove_task_files
-from .step_executor import parse_shared_vars
 from .executor_utils import __null_func__, get_traceback_msg
 
 def collect_task_result(task_id, sos_dict, skipped=False, signature=None):
@@ -386,6 +385,8 @@ del sos_handle_parameter_
             env.sos_dict.set(key, sos_targets(resolve_remote(x)
                                               for x in sos_dict[key] if not isinstance(x, sos_step)))
 
+    # step_executor is imported only when needed to reduce the startup time of tasks
+    from .step_executor import parse_shared_vars
     sig = None if env.config['sig_mode'] == 'ignore' or env.sos_dict['_output'].unspecified() else InMemorySignature(
         env.sos_dict['_input'], env.sos_dict['_output'],
         env.sos_dict['_depends'], env.sos_dict['__signature_vars__'],
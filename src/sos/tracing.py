@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
+# Distributed under the terms of the 3-clause BSD License.
+import glob
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from .utils import env
+
+#
+# Tracing of workflow execution (option --trace of sos run).
+#
+# Processes involved in the execution of a workflow (master, step workers and
+# substep workers) append timed spans to their own files under
+# env.config['trace_dir'], which are merged by the master process into a
+# single file in the trace event format that can be opened by chrome://tracing
+# or other trace viewers.
+#
+
+# (pid, trace_dir, file object) of the trace file of the current process
+_trace_file = None
+
+
+def _get_trace_file():
+    global _trace_file
+    pid = os.getpid()
+    trace_dir = env.config['trace_dir']
+    if _trace_file is None or _trace_file[0] != pid or _trace_file[1] != trace_dir:
+        trace_file = open(os.path.join(trace_dir, f'{pid}.jsonl'), 'a', buffering=1)
+        # name of process that is displayed by trace viewers
+        trace_file.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': mp.current_process().name}}) + '\n')
+        _trace_file = (pid, trace_dir, trace_file)
+    return _trace_file[2]
+
+
+@contextmanager
+def trace_span(name, cat='sos', **kwargs):
+    '''Record the execution of a block of code as a span with specified name,
+    category, and arguments, if tracing is enabled.'''
+    if not env.config.get('trace_dir', None):
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        try:
+            _get_trace_file().write(json.dumps({'name': name, 'cat': cat, 'ph': 'X',
+                'ts': int(start * 1000000), 'dur': int((end - start) * 1000000),
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {x: str(y) for x, y in kwargs.items()}}) + '\n')
+        except Exception as e:
+            env.logger.debug(f'Failed to write trace of {name}: {e}')
+
+
+def traced(func):
+    '''Decorator that records each call to func as a span'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not env.config.get('trace_dir', None):
+            return func(*args, **kwargs)
+        with trace_span(func.__qualname__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def merge_traces(trace_dir, trace_file):
+    '''Merge spans recorded by all processes under trace_dir to trace_file'''
+    global _trace_file
+    if _trace_file is not None and _trace_file[1] == trace_dir:
+        _trace_file[2].close()
+        _trace_file = None
+    events = []
+    for filename in glob.glob(os.path.join(trace_dir, '*.jsonl')):
+        with open(filename) as trace:
+            for line in trace:
+                try:
+                    events.append(json.loads(line))
+                except Exception:
+                    # last line of a process that was killed
+                    env.logger.debug(f'Ignore incomplete trace {line} in {filename}')
+    events.sort(key=lambda x: x.get('ts', 0))
+    with open(trace_file, 'w') as trace:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+    env.logger.info(f'Trace of workflow execution is saved to {trace_file}')
@@ -6,7 +6,10 @@
 import argparse
 import base64
 import copy
+import fnmatch
 import getpass
+import hashlib
+import json
 import logging
 import math
 import os
@@ -19,18 +22,14 @@ import time
 import traceback
 import types
 import urllib
-from zmq.log.handlers import PUBHandler
 
 import urllib.parse
-import urllib.request
 from collections import Sequence, Mapping, Set, defaultdict
 from html.parser import HTMLParser
 from io import FileIO, StringIO
 from typing import Optional, List
 
 import fasteners
-import yaml
-from tqdm import tqdm as ProgressBar
 
 __all__ = ['logger', 'get_output']
 
@@ -193,7 +192,9 @@ class WorkflowDict(object):
     def set(self, key, value):
         '''A short cut to set value to key without triggering any logging
         or warning message.'''
-        env.logger.trace(f"Set {key} to {short_repr(value)} of type {value.__class__.__name__}")
+        # check verbosity to avoid the formatting of values on a hot path
+        if env.verbosity > 3:
+            env.logger.trace(f"Set {key} to {short_repr(value)} of type {value.__class__.__name__}")
         self._dict[key] = value
         # if self._change_all_cap_vars is not None and key.isupper():
         #    self._check_readonly(key, value)
@@ -280,6 +281,36 @@ class WorkflowDict(object):
     def clone_selected_vars(self, selected=None):
         return {x: copy.deepcopy(y) for x, y in self._dict.items() if (not selected or x in selected) and pickleable(y, x)}
 
+    def pickle_selected_vars(self, selected=None):
+        '''Pickle selected variables in a single pass, skipping variables that
+        cannot be pickled. Returns a dictionary of name -> (pickled value,
+        number of out-of-band buffers), and a list of out-of-band buffers
+        that should be sent along with the dictionary (see unpickle_vars).'''
+        vars = {}
+        buffers = []
+        for x, y in self._dict.items():
+            if selected and x not in selected:
+                continue
+            if isinstance(y, (types.ModuleType, WorkflowDict)) or callable(y):
+                continue
+            try:
+                if pickle.HIGHEST_PROTOCOL >= 5:
+                    # large binary data (e.g. numpy arrays) are passed
+                    # as out-of-band buffers without being copied
+                    var_buffers = []
+                    value = pickle.dumps(y, protocol=5, buffer_callback=var_buffers.append)
+                    # buffers are collected before the variable is recorded so
+                    # that a failure would not misalign the buffers of others
+                    var_buffers = [b.raw() for b in var_buffers]
+                    vars[x] = (value, len(var_buffers))
+                    buffers.extend(var_buffers)
+                else:
+                    vars[x] = (pickle.dumps(y, protocol=pickle.HIGHEST_PROTOCOL), 0)
+            except Exception as e:
+                env.logger.debug(
+                    f'Object {x} with value {short_repr(y)} is not passed because it is not pickleable: {e}')
+        return vars, buffers
+
 #
 # Runtime environment
 #
@@ -337,6 +368,24 @@ class RuntimeEnvironments(object):
             'default_queue': '',
             'max_procs': 4,
             'max_running_jobs': None,
+            # recycle workers after they have executed a number of substeps
+            # or when their resident memory exceeds specified size
+            'max_substeps_per_worker': None,
+            'worker_max_rss': None,
+            # maximum number of substeps that are queued by the controller
+            # or that are pending on a step before submission is throttled
+            'substep_queue_hwm': 1000,
+            # transport of sockets between local processes, ipc or tcp
+            'socket_transport': 'ipc',
+            # file to which a trace of the execution of workflow is written
+            'trace_file': None,
+            # summarize and optionally serve metrics of the controller
+            'metrics': False,
+            'metrics_endpoint': None,
+            # reuse the DAG of the last run if the workflow and files are unchanged
+            'dag_cache': False,
+            # number of threads that zap files of a group of targets
+            'zap_workers': 4,
             'sig_mode': 'default',
             'run_mode': 'run',
             'verbosity': 1,
@@ -386,6 +435,7 @@ class RuntimeEnvironments(object):
         }
 
         if self._logging_socket:
+            from zmq.log.handlers import PUBHandler
             socket_handler = PUBHandler(self._logging_socket)
             # debug informaiton and time is always written to the log file
             socket_handler.setLevel(levels[self._verbosity])
@@ -610,6 +660,21 @@ def pickleable(obj, name):
         return False
 
 
+def unpickle_vars(vars, buffers=None):
+    '''Restore variables pickled by WorkflowDict.pickle_selected_vars'''
+    if buffers is None:
+        buffers = []
+    res = {}
+    start = 0
+    for name, (value, n_buffers) in vars.items():
+        if n_buffers:
+            res[name] = pickle.loads(value, buffers=buffers[start:start + n_buffers])
+            start += n_buffers
+        else:
+            res[name] = pickle.loads(value)
+    return res
+
+
 class ProgressFileObj(FileIO):
     '''A wrapper of a file object that update a progress bar
     during file read.
@@ -664,7 +729,28 @@ def get_output(cmd, show_command=False, prompt='$ '):
 #
 
 
+def script_search_paths(start=''):
+    '''Return paths from which scripts are searched, namely the start
+    directory and sos_path defined in ~/.sos/config.yml'''
+    import yaml
+    # a search path
+    pathes = [start]
+    sos_config_file = os.path.join(
+        os.path.expanduser('~'), '.sos', 'config.yml')
+    if os.path.isfile(sos_config_file):
+        try:
+            with open(sos_config_file) as config:
+                cfg = yaml.safe_load(config)
+        except Exception:
+            raise RuntimeError(
+                f'Failed to parse global sos config file {sos_config_file}, is it in JSON format?')
+        #
+        pathes.extend(cfg.get('sos_path', []))
+    return pathes
+
+
 def locate_script(filename, start=''):
+    import urllib.request
     #
     attemp = os.path.abspath(os.path.expanduser(filename))
     if os.path.isfile(attemp):
@@ -683,21 +769,7 @@ def locate_script(filename, start=''):
             env.logger.error(e)
             raise ValueError(f'Failed to open {filename}')
     #
-    # a search path
-    pathes = [start]
-    sos_config_file = os.path.join(
-        os.path.expanduser('~'), '.sos', 'config.yml')
-    if os.path.isfile(sos_config_file):
-        try:
-            with open(sos_config_file) as config:
-                cfg = yaml.safe_load(config)
-        except Exception:
-            raise RuntimeError(
-                f'Failed to parse global sos config file {sos_config_file}, is it in JSON format?')
-        #
-        pathes.extend(cfg.get('sos_path', []))
-    #
-    for path in pathes:
+    for path in script_search_paths(start):
         if not path:
             continue
         attemp = os.path.join(os.path.expanduser(
@@ -841,6 +913,7 @@ class ActivityNotifier(threading.Thread):
                     prog.close()
                 break
             if not prog:
+                from tqdm import tqdm as ProgressBar
                 print(self.msg)
                 prog = ProgressBar(desc='', position=0,
                                    bar_format='{desc}', total=100000000)
@@ -1053,54 +1126,127 @@ class TimeoutInterProcessLock(fasteners.InterProcessLock):
                     msg = True
 
 
-def load_config_files(filename=None):
-    cfg = {}
-    config_lock = os.path.join(env.temp_dir, 'sos_config.lck')
-    # site configuration file
-    sos_config_file = os.path.join(
-        os.path.split(__file__)[0], 'site_config.yml')
-    if os.path.isfile(sos_config_file):
-        with TimeoutInterProcessLock(config_lock):
-            try:
-                with open(sos_config_file) as config:
-                    cfg = yaml.safe_load(config)
-            except Exception as e:
-                raise RuntimeError(
-                    f'Failed to parse global sos hosts file {sos_config_file}, is it in YAML/JSON format? ({e})')
-
-    # global site file
-    sos_config_file = os.path.join(
-        os.path.expanduser('~'), '.sos', 'hosts.yml')
-    if os.path.isfile(sos_config_file):
-        with TimeoutInterProcessLock(config_lock):
-            try:
-                with open(sos_config_file) as config:
-                    dict_merge(cfg, yaml.safe_load(config))
-            except Exception as e:
-                raise RuntimeError(
-                    f'Failed to parse global sos hosts file {sos_config_file}, is it in YAML/JSON format? ({e})')
-    # global config file
-    sos_config_file = os.path.join(
-        os.path.expanduser('~'), '.sos', 'config.yml')
-    if os.path.isfile(sos_config_file):
-        with TimeoutInterProcessLock(config_lock):
-            try:
-                with open(sos_config_file) as config:
-                    dict_merge(cfg, yaml.safe_load(config))
-            except Exception as e:
-                raise RuntimeError(
-                    f'Failed to parse global sos config file {sos_config_file}, is it in YAML/JSON format? ({e})')
+def _config_sources(filename=None):
+    sources = [
+        # site configuration file
+        ('global sos hosts file', os.path.join(os.path.split(__file__)[0], 'site_config.yml')),
+        # global site file
+        ('global sos hosts file', os.path.join(os.path.expanduser('~'), '.sos', 'hosts.yml')),
+        # global config file
+        ('global sos config file', os.path.join(os.path.expanduser('~'), '.sos', 'config.yml'))]
     # user-specified configuration file.
     if filename is not None:
         if not os.path.isfile(os.path.expanduser(filename)):
             raise RuntimeError(f'Config file {filename} not found')
-        with TimeoutInterProcessLock(config_lock):
+        sources.append(('config file', os.path.abspath(os.path.expanduser(filename))))
+    return sources
+
+
+def _config_fingerprint(sources):
+    fingerprint = []
+    for _, source in sources:
+        try:
+            st = os.stat(source)
+            fingerprint.append((source, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fingerprint.append((source, None, None))
+    return fingerprint
+
+
+def _owned_by_user(filename_or_fd):
+    # on systems without uid (windows), files are assumed to be private
+    return not hasattr(os, 'getuid') or os.stat(filename_or_fd).st_uid == os.getuid()
+
+
+def private_cache_dir(name):
+    '''Return directory ~/.sos/cache/name for caches that are loaded with
+    pickle. Because loading a pickle can execute arbitrary code, ~/.sos and
+    the cache directories should be owned by the current user, and the cache
+    directories should not be accessible to others. None is returned if this
+    is not the case.'''
+    sos_dir = os.path.join(os.path.expanduser('~'), '.sos')
+    cache_dir = os.path.join(sos_dir, 'cache', name)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        for dirname in (sos_dir, os.path.dirname(cache_dir), cache_dir):
+            if not _owned_by_user(dirname):
+                raise ValueError(f'{dirname} is not owned by the current user')
+            if dirname != sos_dir and os.stat(dirname).st_mode & 0o077:
+                os.chmod(dirname, 0o700)
+    except Exception as e:
+        env.logger.debug(f'Cache {name} is disabled: {e}')
+        return None
+    return cache_dir
+
+
+def load_private_pickle(filename):
+    '''Load a pickled cache file from a directory returned by private_cache_dir,
+    after checking that the file is owned by the current user.'''
+    with open(filename, 'rb') as cache:
+        if not _owned_by_user(cache.fileno()):
+            raise ValueError(f'{filename} is not owned by the current user')
+        return pickle.load(cache)
+
+
+# fingerprint and pickled configuration of the last load_config_files
+_config_cache = {}
+
+
+def load_config_files(filename=None):
+    '''Load and merge site, hosts, global, and user-specified configuration
+    files. The merged configuration is cached (in memory and under
+    ~/.sos/cache) with the mtime and size of the files so that the files are
+    parsed, with an interprocess lock, only if they have been changed.'''
+    sources = _config_sources(filename)
+    fingerprint = _config_fingerprint(sources)
+    cache_key = hashlib.md5(repr(sources).encode()).hexdigest()
+    cache_dir = private_cache_dir('config')
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, f'{cache_key}.pkl')
+    cached = _config_cache.get(cache_key, None)
+    if cached is None and cache_file is not None:
+        try:
+            cached = load_private_pickle(cache_file)
+        except Exception:
+            pass
+    if cached is not None and cached[0] == fingerprint:
+        # return a new copy each time because the configuration can be
+        # modified by the caller
+        cfg = pickle.loads(cached[1])
+        _config_cache[cache_key] = cached
+        env.sos_dict.set('CONFIG', cfg)
+        return cfg
+    cfg = _load_config_files(sources)
+    try:
+        cached = (fingerprint, pickle.dumps(cfg))
+        _config_cache[cache_key] = cached
+        if cache_file is None:
+            return cfg
+        # concurrent processes could write the same cache so we write to a
+        # temporary file and rename it
+        tmp_file = f'{cache_file}.{os.getpid()}'
+        with open(tmp_file, 'wb') as cache:
+            pickle.dump(cached, cache)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        env.logger.debug(f'Failed to cache configuration: {e}')
+    return cfg
+
+
+def _load_config_files(sources):
+    import yaml
+    cfg = {}
+    config_lock = os.path.join(env.temp_dir, 'sos_config.lck')
+    # the lock is only needed when the configuration files are parsed
+    with TimeoutInterProcessLock(config_lock):
+        for desc, sos_config_file in sources:
+            if not os.path.isfile(sos_config_file):
+                continue
             try:
-                with open(os.path.expanduser(filename)) as config:
+                with open(sos_config_file) as config:
                     dict_merge(cfg, yaml.safe_load(config))
             except Exception as e:
                 raise RuntimeError(
-                    f'Failed to parse config file {filename}, is it in YAML/JSON format? ({e})')
+                    f'Failed to parse {desc} {sos_config_file}, is it in YAML/JSON format? ({e})')
     if 'user_name' not in cfg:
         cfg['user_name'] = getpass.getuser().lower()
     env.sos_dict.set('CONFIG', cfg)
@@ -1149,6 +1295,284 @@ def load_config_files(filename=None):
     return cfg
 
 
+def _plugin_fingerprint(metadata_dirs):
+    # entry points change only if packages are installed or removed, which
+    # changes the modification time of directories on sys.path, or if the
+    # metadata (.dist-info or .egg-info) of a plugin is updated, e.g. for a
+    # package installed in development mode. Directories are not listed so
+    # that the fingerprint is cheap to compute with many packages installed.
+    fingerprint = [sys.version]
+    files = [x for x in sys.path if x] + metadata_dirs + \
+        [os.path.join(x, 'entry_points.txt') for x in metadata_dirs]
+    for filename in files:
+        try:
+            fingerprint.append([filename, os.stat(filename).st_mtime])
+        except OSError:
+            pass
+    return fingerprint
+
+
+def _scan_plugins():
+    from ._version import __version__
+    index = defaultdict(dict)
+    # metadata directories of distributions with sos plugins
+    metadata_dirs = []
+
+    def sos_requirement(requires):
+        # minimal version of sos required by a plugin if not met by
+        # the current version of sos
+        for req in requires:
+            m = re.match(r'^sos\s*>=\s*([^\s;,]+)', str(req))
+            if m:
+                from pkg_resources import parse_version
+                if parse_version(__version__) < parse_version(m.group(1)):
+                    return m.group(1)
+        return None
+
+    try:
+        from importlib.metadata import distributions
+        seen = set()
+        for dist in distributions():
+            # skip duplicated distributions that are hidden by earlier ones on sys.path
+            name = dist.metadata['Name']
+            if name in seen:
+                continue
+            seen.add(name)
+            eps = [x for x in dist.entry_points if x.group.startswith('sos_')]
+            if not eps:
+                continue
+            required = sos_requirement(dist.requires or [])
+            if getattr(dist, '_path', None) is not None:
+                metadata_dirs.append(str(dist._path))
+            for ep in eps:
+                index[ep.group][ep.name] = [ep.value, required]
+    except ImportError:
+        # python < 3.8
+        import pkg_resources
+        for dist in pkg_resources.working_set:
+            eps = {group: x for group, x in dist.get_entry_map().items() if group.startswith('sos_')}
+            if not eps:
+                continue
+            required = sos_requirement(dist.requires())
+            if getattr(dist, 'egg_info', None):
+                metadata_dirs.append(dist.egg_info)
+            for group, entries in eps.items():
+                for name, ep in entries.items():
+                    index[group][name] = [
+                        f'{ep.module_name}:{".".join(ep.attrs)}', required]
+    return dict(index), metadata_dirs
+
+
+_plugin_index = None
+
+
+def get_plugin_index():
+    '''Return a dictionary of {group: {name: [module:attr, required_version]}}
+    of entry points of sos plugins, where required_version is the version of
+    sos required by the plugin if it is not met by the current version. The
+    index is cached under ~/.sos so that installed distributions are scanned
+    only when they are changed.'''
+    global _plugin_index
+    if _plugin_index is not None:
+        return _plugin_index
+    index_file = os.path.join(os.path.expanduser('~'), '.sos', 'plugin_index.json')
+    try:
+        with open(index_file) as idx:
+            cached = json.load(idx)
+        if cached['fingerprint'] == _plugin_fingerprint(cached['metadata']):
+            _plugin_index = cached['index']
+            return _plugin_index
+    except Exception:
+        pass
+    _plugin_index, metadata_dirs = _scan_plugins()
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        # write to a temporary file and rename so that concurrent processes
+        # always read a complete index
+        tmp_file = f'{index_file}.{os.getpid()}'
+        with open(tmp_file, 'w') as idx:
+            json.dump({'fingerprint': _plugin_fingerprint(metadata_dirs),
+                'metadata': metadata_dirs, 'index': _plugin_index}, idx)
+        os.replace(tmp_file, index_file)
+    except Exception as e:
+        env.logger.debug(f'Failed to save plugin index {index_file}: {e}')
+    return _plugin_index
+
+
+def load_plugin(spec):
+    '''Import and return a plugin from the module:attr specification of
+    its entry point'''
+    import importlib
+    module, attrs = re.sub(r'\s*\[.*\]\s*$', '', spec).split(':')
+    obj = importlib.import_module(module.strip())
+    for attr in attrs.strip().split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+#
+# Directory listings are cached so that globbing many patterns under the same
+# tree lists each directory only once. A listing is reused as long as the
+# modification time of the directory is unchanged, and is dropped explicitly
+# when SoS writes output files to the directory. Because the modification
+# time of directories is unreliable for files written by other hosts on
+# network file systems such as NFS (attribute caching), a listing is also
+# reused for at most _listing_ttl seconds.
+#
+_listing_cache = {}
+_listing_ttl = 10
+# names of .zapped files in cached listings, saved with the listing
+# from which they are collected
+_zapped_names = {}
+_glob_magic = re.compile('[*?[]')
+# set of directories in which glob patterns are matched, if they are being
+# recorded (see record_glob_dirs)
+_glob_dirs = None
+
+
+def _list_dir(dirname):
+    # return a list of (name, is_dir, is_symlink), or None if dirname
+    # cannot be listed
+    key = os.path.abspath(dirname)
+    try:
+        mtime = os.stat(key).st_mtime
+    except OSError:
+        _listing_cache.pop(key, None)
+        return None
+    listed_at = time.time()
+    cached = _listing_cache.get(key)
+    if cached is not None and cached[0] == mtime and listed_at - cached[1] < _listing_ttl:
+        return cached[2]
+    entries = []
+    try:
+        with os.scandir(key) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir, entry.is_symlink()))
+    except OSError:
+        return None
+    # files created in the same clock tick as the listing would not change
+    # the modification time of the directory so recently modified directories
+    # are listed again
+    if listed_at - mtime > 1:
+        _listing_cache[key] = (mtime, listed_at, entries)
+    return entries
+
+
+def _glob_in_dir(dirname, pattern, dironly):
+    if _glob_dirs is not None:
+        _glob_dirs.add(os.path.abspath(dirname or os.curdir))
+    entries = _list_dir(dirname or os.curdir)
+    if not entries:
+        return []
+    names = [name for name, is_dir, _ in entries if is_dir or not dironly]
+    if not pattern.startswith('.'):
+        names = [x for x in names if not x.startswith('.')]
+    return fnmatch.filter(names, pattern)
+
+
+def _glob(pattern, dironly):
+    dirname, basename = os.path.split(pattern)
+    if not _glob_magic.search(pattern):
+        if basename:
+            return [pattern] if os.path.lexists(pattern) else []
+        return [pattern] if os.path.isdir(dirname) else []
+    if not dirname:
+        return _glob_in_dir(dirname, basename, dironly)
+    if dirname != pattern and _glob_magic.search(dirname):
+        dirs = _glob(dirname, True)
+    else:
+        dirs = [dirname]
+    res = []
+    for d in dirs:
+        if _glob_magic.search(basename):
+            res.extend(os.path.join(d, x)
+                       for x in _glob_in_dir(d, basename, dironly))
+        elif basename:
+            if _glob_dirs is not None:
+                _glob_dirs.add(os.path.abspath(d))
+            if os.path.lexists(os.path.join(d, basename)):
+                res.append(os.path.join(d, basename))
+        elif os.path.isdir(d):
+            res.append(os.path.join(d, basename))
+    return res
+
+
+def glob_files(pattern):
+    '''Return a list of paths matching pattern, as glob.glob does, using
+    cached directory listings'''
+    return _glob(pattern, False)
+
+
+def record_glob_dirs(dirs):
+    '''Add absolute paths of directories in which glob patterns are matched,
+    including patterns that match no file, to set dirs, or stop recording
+    them if dirs is None. The set that was used before is returned.'''
+    global _glob_dirs
+    recorded, _glob_dirs = _glob_dirs, dirs
+    return recorded
+
+
+def add_glob_dirs(dirs):
+    '''Add directories globbed elsewhere (e.g. by a forked process) to the
+    directories that are being recorded'''
+    if _glob_dirs is not None:
+        _glob_dirs.update(dirs)
+
+
+def walk_dir(top):
+    '''Generate (dirpath, dirnames, filenames) under top, as os.walk does,
+    using cached directory listings'''
+    entries = _list_dir(top)
+    if entries is None:
+        return
+    yield top, [x[0] for x in entries if x[1]], [x[0] for x in entries if not x[1]]
+    for name, is_dir, is_symlink in entries:
+        if is_dir and not is_symlink:
+            yield from walk_dir(os.path.join(top, name))
+
+
+def is_zapped(filename):
+    '''Return True if filename has been zapped, namely if filename.zapped
+    exists. A .zapped file in a listing of its directory that was cached
+    less than _listing_ttl seconds ago is trusted without checking the
+    directory. Otherwise, including files that are zapped after the
+    listing, the file is checked directly.'''
+    zap_file = os.path.abspath(f'{filename}.zapped')
+    dirname, name = os.path.split(zap_file)
+    cached = _listing_cache.get(dirname)
+    if cached is not None and time.time() - cached[1] < _listing_ttl:
+        names = _zapped_names.get(dirname)
+        if names is None or names[0] is not cached[2]:
+            names = (cached[2], {x[0] for x in cached[2] if x[0].endswith('.zapped') and not x[1]})
+            _zapped_names[dirname] = names
+        if name in names[1]:
+            return True
+    return os.path.isfile(zap_file)
+
+
+def invalidate_dir_listing(filenames=None):
+    '''Drop cached listings of directories that contain filenames, including
+    their parent directories, or all cached listings if no filename is given.'''
+    if filenames is None:
+        _listing_cache.clear()
+        _zapped_names.clear()
+        return
+    if not _listing_cache:
+        return
+    seen = set()
+    for filename in filenames:
+        dirname = os.path.abspath(filename)
+        while dirname not in seen:
+            seen.add(dirname)
+            _listing_cache.pop(dirname, None)
+            _zapped_names.pop(dirname, None)
+            dirname = os.path.dirname(dirname)
+
+
 def format_duration(time_diff_secs, short=True):
     secs = int(time_diff_secs)
     rec = [
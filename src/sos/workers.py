@@ -4,26 +4,42 @@
 # Distributed under the terms of the 3-clause BSD License.
 
 import os
+import pickle
 import subprocess
 import sys
+import psutil
 import zmq
 import multiprocessing as mp
 
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Union
 
 from ._version import __version__
 from .eval import SoS_exec
-from .controller import connect_controllers, disconnect_controllers
+from .controller import connect_controllers, disconnect_controllers, endpoint
 from .targets import sos_targets
-from .utils import WorkflowDict, env, get_traceback, load_config_files, short_repr
+from .tracing import trace_span
+from .utils import (WorkflowDict, env, get_traceback, load_config_files,
+                    short_repr, unpickle_vars)
 from .executor_utils import  __null_func__
 
+
+def exceeds_max_rss(pid=None):
+    '''Check if the resident memory of process pid (default to the current
+    process) exceeds the limit set by configuration worker_max_rss.'''
+    max_rss = env.config.get('worker_max_rss', None)
+    if not max_rss:
+        return False
+    try:
+        return psutil.Process(pid).memory_info().rss > max_rss
+    except Exception:
+        return False
+
 class SoS_Worker(mp.Process):
     '''
     Worker process to process SoS step or workflow in separate process.
     '''
 
-    def __init__(self, port: int, config: Optional[Dict[str, Any]] = None, args: Optional[Any] = None, **kwargs) -> None:
+    def __init__(self, port: Union[int, str], config: Optional[Dict[str, Any]] = None, args: Optional[Any] = None, **kwargs) -> None:
         '''
         cmd_queue: a single direction queue for the master process to push
             items to the worker.
@@ -76,7 +92,7 @@ class SoS_Worker(mp.Process):
         env.zmq_context = connect_controllers()
 
         env.master_socket = env.zmq_context.socket(zmq.PAIR)
-        env.master_socket.connect(f'tcp://127.0.0.1:{self.port}')
+        env.master_socket.connect(endpoint(self.port))
 
         # wait to handle jobs
         while True:
@@ -84,15 +100,17 @@ class SoS_Worker(mp.Process):
                 work = env.master_socket.recv_pyobj()
                 if work is None:
                     break
-                env.logger.debug(
-                    f'Worker {self.name} receives request {short_repr(work)}')
+                if env.verbosity > 2:
+                    env.logger.debug(
+                        f'Worker {self.name} receives request {short_repr(work)}')
                 if work[0] == 'step':
                     # this is a step ...
                     self.run_step(*work[1:])
                 else:
                     self.run_workflow(*work[1:])
-                env.logger.debug(
-                    f'Worker {self.name} completes request {short_repr(work)}')
+                if env.verbosity > 2:
+                    env.logger.debug(
+                        f'Worker {self.name} completes request {short_repr(work)}')
             except KeyboardInterrupt:
                 break
         # Finished
@@ -163,7 +181,8 @@ class SoS_Worker(mp.Process):
 
         executor = Step_Executor(
             section, env.master_socket, mode=env.config['run_mode'])
-        executor.run()
+        with trace_span('step', step=section.step_name()):
+            executor.run()
 
 
 class SoS_SubStep_Worker(mp.Process):
@@ -171,6 +190,7 @@ class SoS_SubStep_Worker(mp.Process):
     Worker process to process SoS step or workflow in separate process.
     '''
     LRU_READY = b"\x01"
+    LRU_RETIRE = b"\x02"
 
     def __init__(self, config={}, **kwargs) -> None:
         # the worker process knows configuration file, command line argument etc
@@ -178,23 +198,53 @@ class SoS_SubStep_Worker(mp.Process):
         self.config = config
         self.daemon = True
 
+    def should_retire(self, n_substeps):
+        '''A worker retires after executing max_substeps_per_worker substeps, or
+        if its resident memory exceeds worker_max_rss, so that memory leaked
+        by user code would not accumulate during the execution of workflow.'''
+        max_substeps = env.config.get('max_substeps_per_worker', None)
+        if max_substeps and n_substeps >= max_substeps:
+            env.logger.debug(
+                f'Substep worker {os.getpid()} retires after executing {n_substeps} substeps')
+            return True
+        if n_substeps > 0 and exceeds_max_rss():
+            env.logger.debug(
+                f'Substep worker {os.getpid()} retires because its memory usage exceeds {env.config["worker_max_rss"]}')
+            return True
+        return False
+
     def run(self):
         env.config.update(self.config)
         env.zmq_context = connect_controllers()
         from .substep_executor import execute_substep
         env.master_socket = env.zmq_context.socket(zmq.REQ)
-        env.master_socket.connect(f'tcp://127.0.0.1:{self.config["sockets"]["substep_backend"]}')
+        env.master_socket.connect(endpoint(self.config["sockets"]["substep_backend"]))
         env.logger.trace(f'Substep worker {os.getpid()} started')
 
+        n_substeps = 0
         while True:
-            env.master_socket.send(self.LRU_READY)
-            msg = env.master_socket.recv_pyobj()
+            # a retiring worker tells the controller that it will not accept
+            # any more work so that the controller could start a replacement
+            if self.should_retire(n_substeps):
+                env.master_socket.send(self.LRU_RETIRE)
+            else:
+                env.master_socket.send(self.LRU_READY)
+            # the message is either a pickled None to stop the worker, or a
+            # pickled substep followed by out-of-band buffers of proc_vars
+            frames = env.master_socket.recv_multipart(copy=False)
+            msg = pickle.loads(frames[0].buffer)
             if not msg:
                 env.logger.debug(f'stop substep worker {os.getpid()}')
                 break
+            # buffers received from zmq are readonly so we copy them to
+            # bytearrays to allow in-place modification of restored objects
+            msg['proc_vars'] = unpickle_vars(msg['proc_vars'],
+                [bytearray(x.buffer) for x in frames[1:]])
 
-            env.logger.debug(f'Substep worker {os.getpid()} receives request {short_repr(msg)}')
+            if env.verbosity > 2:
+                env.logger.debug(f'Substep worker {os.getpid()} receives request {short_repr(msg)}')
             execute_substep(**msg)
+            n_substeps += 1
 
         env.master_socket.LINGER = 0
         env.master_socket.close()
@@ -3,10 +3,14 @@
 # Copyright (c) Bo Peng and the University of Texas MD Anderson Cancer Center
 # Distributed under the terms of the 3-clause BSD License.
 
+import ast
 import base64
 import os
+import pickle
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import uuid
 import zmq
@@ -23,14 +27,19 @@ from .hosts import Host
 from .parser import SoS_Step, SoS_Workflow
 from .pattern import extract_pattern
 from .workflow_report import render_report
-from .controller import Controller, connect_controllers, disconnect_controllers
-from .section_analyzer import analyze_section
+from .controller import (Controller, bind_to_random_endpoint, connect_controllers,
+                         disconnect_controllers, endpoint)
+from .section_analyzer import (analysis_cached, analyze_section, execute_global_def,
+                               prefetch_analysis)
+from .tracing import merge_traces, trace_span, traced
 from .targets import (BaseTarget, RemovedTarget, UnavailableLock,
                       UnknownTarget, file_target, path, paths,
                       sos_step, sos_targets, sos_variable, textMD5)
-from .utils import (Error, WorkflowDict, env, get_traceback,
-                    load_config_files, pickleable, short_repr)
-from .workers import SoS_Worker
+from .utils import (Error, WorkflowDict, _config_fingerprint, _config_sources, env,
+                    get_traceback, invalidate_dir_listing, load_config_files,
+                    load_private_pickle, pickleable, private_cache_dir,
+                    record_glob_dirs, short_repr)
+from .workers import SoS_Worker, exceeds_max_rss
 from .executor_utils import __null_func__
 
 __all__ = []
@@ -117,7 +126,7 @@ class ExecutionManager(object):
     def execute(self, runnable: Union[SoS_Node, dummy_node], config: Dict[str, Any], args: Any, spec: Any) -> None:
         if not self.pool:
             socket = env.zmq_context.socket(zmq.PAIR)
-            port = socket.bind_to_random_port('tcp://127.0.0.1')
+            port = bind_to_random_endpoint(socket)
             worker = SoS_Worker(port=port, config=config, args=args)
             worker.start()
         else:
@@ -152,8 +161,21 @@ class ExecutionManager(object):
         return all(x.in_status('failed') for x in self.procs)
 
     def mark_idle(self, idx: int) -> None:
-        self.pool.append(self.procs[idx])
+        proc = self.procs[idx]
         self.procs[idx] = None
+        if proc.worker is not None and exceeds_max_rss(proc.worker.pid):
+            # retire the worker instead of returning it to the pool. A new
+            # worker will be started when the next step is executed.
+            env.logger.debug(
+                f'Retire worker {proc.worker.pid} because its memory usage exceeds {env.config["worker_max_rss"]}')
+            proc.socket.send_pyobj(None)
+            proc.worker.join(5)
+            if proc.worker.is_alive():
+                proc.worker.terminate()
+            proc.socket.LINGER = 0
+            proc.socket.close()
+            return
+        self.pool.append(proc)
 
     def cleanup(self) -> None:
         self.procs = [x for x in self.procs if x is not None]
@@ -177,6 +199,45 @@ class ExecutionManager(object):
                     proc.worker.terminate()
 
 
+# functions that read files or directories, or run commands, which make
+# global definitions that call them depend on files not tracked by the DAG
+_file_readers = {'open', 'glob', 'iglob', 'listdir', 'scandir', 'walk', 'iterdir',
+                 'rglob', 'exists', 'lexists', 'isfile', 'isdir', 'getmtime',
+                 'getsize', 'stat', 'load', 'loadtxt', 'genfromtxt', 'fromfile',
+                 'paths', 'sos_targets', 'get_output', 'check_output', 'run',
+                 'Popen', 'system', 'popen'}
+
+
+def _reads_files(statements: str) -> bool:
+    '''If statements call a function that could read files, or a function
+    that cannot be identified.'''
+    try:
+        tree = ast.parse(statements)
+    except SyntaxError:
+        return True
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+        elif isinstance(node.func, ast.Attribute):
+            name = node.func.attr
+        else:
+            return True
+        if name in _file_readers or name.startswith('read'):
+            return True
+    return False
+
+
+def dag_cache_dir(project_dir: str) -> Optional[str]:
+    '''Return the directory under ~/.sos/cache/dag in which DAGs of workflows
+    executed under project_dir are saved, or None if the cache is disabled.'''
+    cache_dir = private_cache_dir('dag')
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, textMD5(os.path.abspath(project_dir)))
+
+
 class Base_Executor:
     '''This is the base class of all executor that provides common
     set up and tear functions for all executors.'''
@@ -202,6 +263,8 @@ class Base_Executor:
                             f'Undefined parameter {arg[2:]} for command line argument "{" ".join(args[idx:])}". Acceptable parameters are: {", ".join(wf_pars)}')
 
         self.shared = {} if shared is None else shared
+        # directories in which glob patterns are matched when the DAG is planned
+        self._glob_dirs = set()
         env.config.update(config)
         if env.config['config_file'] is not None:
             env.config['config_file'] = os.path.abspath(
@@ -252,6 +315,10 @@ class Base_Executor:
 
         # if this is the executor for the master workflow, start controller
         env.config['master_id'] = self.md5
+        # processes write traces to a temporary directory, which will be
+        # merged to trace_file after the completion of the workflow
+        if env.config.get('trace_file', None):
+            env.config['trace_dir'] = tempfile.mkdtemp(prefix='sos_trace_')
         #
         # control panel in a separate thread, connected by zmq socket
         ready = Event()
@@ -263,7 +330,8 @@ class Base_Executor:
         connect_controllers(env.zmq_context)
 
         try:
-            return self.run_as_master(targets=targets, mode=mode)
+            with trace_span('run_as_master', workflow=self.workflow.name):
+                return self.run_as_master(targets=targets, mode=mode)
         finally:
             # end progress bar when the master workflow stops
             env.logger.trace(f'Stop controller from {os.getpid()}')
@@ -275,6 +343,13 @@ class Base_Executor:
             # when the run() function is called again, the controller
             # thread will be start again.
             env.config['master_id'] = None
+            if env.config.get('trace_dir', None):
+                try:
+                    merge_traces(env.config['trace_dir'], env.config['trace_file'])
+                except Exception as e:
+                    env.logger.warning(f'Failed to save trace of workflow execution: {e}')
+                shutil.rmtree(env.config['trace_dir'], ignore_errors=True)
+                env.config['trace_dir'] = None
 
     def calculate_md5(self) -> str:
         with StringIO() as sig:
@@ -322,7 +397,7 @@ class Base_Executor:
     def skip(self, section: SoS_Step) -> bool:
         if section.global_def:
             try:
-                SoS_exec(section.global_def)
+                execute_global_def(section.global_def)
             except subprocess.CalledProcessError as e:
                 raise RuntimeError(e.stderr)
             except RuntimeError as e:
@@ -372,6 +447,8 @@ class Base_Executor:
                 return True
         return False
 
+    @traced
+    @analysis_cached
     def resolve_dangling_targets(self, dag: SoS_DAG, targets: Optional[sos_targets]=None) -> int:
         '''Feed dangling targets with their dependncies from auxiliary steps,
         optionally add other targets'''
@@ -623,6 +700,8 @@ class Base_Executor:
                 break
         return resolved
 
+    @traced
+    @analysis_cached
     def initialize_dag(self, targets: Optional[List[str]] = [], nested: bool = False) -> SoS_DAG:
         '''Create a DAG by analyzing sections statically.'''
         self.reset_dict()
@@ -630,6 +709,9 @@ class Base_Executor:
         dag = SoS_DAG(name=self.md5)
         default_input: sos_targets = sos_targets([])
         targets = sos_targets(targets)
+        # analyze steps that do not depend on previous steps concurrently
+        prefetch_analysis(self.workflow.sections + self.workflow.auxiliary_sections,
+                          env.config['max_procs'])
         for idx, section in enumerate(self.workflow.sections):
             if self.skip(section):
                 continue
@@ -711,6 +793,124 @@ class Base_Executor:
         dag.save(env.config['output_dag'])
         return dag
 
+    # number of DAGs saved for each project with option --dag-cache
+    _max_cached_dags = 20
+
+    def _dag_cache_file(self, targets: sos_targets) -> Optional[str]:
+        # the DAG depends on the workflow, its parameters, targets, and
+        # configuration files that can be used by global definitions
+        cache_dir = dag_cache_dir(env.exec_dir)
+        if cache_dir is None:
+            return None
+        key = textMD5(f'{__version__} {self.md5} {self.workflow.content.md5} {targets!r} {self.shared!r} '
+            f'{_config_fingerprint(_config_sources(env.config["config_file"]))}')
+        return os.path.join(cache_dir, f'{key}.pkl')
+
+    @staticmethod
+    def _stat_files(files: List[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+        manifest = {}
+        for filename in files:
+            try:
+                st = os.stat(filename)
+                manifest[filename] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                manifest[filename] = None
+        return manifest
+
+    def snapshot_dag(self, dag: SoS_DAG) -> Optional[bytes]:
+        '''Pickle a planned DAG with the uuids and provided targets of all
+        sections so that it can be saved after a successful run.'''
+        sections = self.workflow.sections + self.workflow.auxiliary_sections
+        try:
+            return pickle.dumps(([x.uuid for x in sections],
+                                 [x.options._expressions.get('provides', None) for x in sections], dag))
+        except Exception as e:
+            env.logger.debug(f'Failed to pickle DAG: {e}')
+            return None
+
+    def save_dag(self, targets: sos_targets, planned: bytes, dag: SoS_DAG) -> None:
+        '''Save a planned DAG with a manifest of the stat of all files used
+        by the DAG and their directories, and directories in which glob
+        patterns are matched.'''
+        # global definitions, which are executed during planning, could use
+        # files that are not recorded in the manifest
+        if any(_reads_files(x) for x in {x.global_def for x in
+               self.workflow.sections + self.workflow.auxiliary_sections if x.global_def}):
+            env.logger.debug('DAG is not saved because global definitions could read files')
+            return
+        files = set()
+        for node in dag.nodes():
+            for node_targets in (node._input_targets, node._depends_targets, node._output_targets):
+                if not node_targets.valid():
+                    continue
+                # other targets (e.g. executable, R_library, remote) could
+                # change without changing any file used by the DAG
+                if not all(isinstance(x, (file_target, sos_step, sos_variable)) for x in node_targets):
+                    env.logger.debug('DAG is not saved because it depends on targets other than files')
+                    return
+                files |= {os.path.abspath(x) for x in node_targets if isinstance(x, file_target)}
+        # directories are included so that new files matching glob
+        # patterns invalidate the DAG
+        files |= {os.path.dirname(x) for x in files} | {os.path.abspath(os.getcwd())}
+        files |= self._glob_dirs
+        cache_file = self._dag_cache_file(targets)
+        if cache_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}'
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump((self._stat_files(sorted(files)), planned, self._glob_dirs), cache)
+            os.replace(tmp_file, cache_file)
+            # only DAGs of the most recently used workflows are kept
+            cache_dir = os.path.dirname(cache_file)
+            cached = sorted((os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+                             if x.endswith('.pkl')), key=os.path.getmtime, reverse=True)
+            for filename in cached[self._max_cached_dags:]:
+                os.remove(filename)
+        except Exception as e:
+            env.logger.debug(f'Failed to save DAG to {cache_file}: {e}')
+
+    def load_dag(self, targets: sos_targets) -> Tuple[Optional[SoS_DAG], Optional[bytes]]:
+        '''Load the DAG saved by a previous run if the workflow, its parameters,
+        and all files used by the DAG are unchanged. Return the DAG and its
+        pickled version, or None if the DAG needs to be planned.'''
+        if not env.config.get('dag_cache', False):
+            return None, None
+        cache_file = self._dag_cache_file(targets)
+        if cache_file is None:
+            return None, None
+        try:
+            manifest, planned, glob_dirs = load_private_pickle(cache_file)
+            if self._stat_files(list(manifest.keys())) != manifest:
+                env.logger.debug('Files used by the DAG have been changed')
+                return None, None
+            steps, provides, dag = pickle.loads(planned)
+            # kept for the DAG saved after this run
+            self._glob_dirs = glob_dirs
+            # mark the DAG as recently used
+            os.utime(cache_file)
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            env.logger.debug(f'Failed to load DAG from {cache_file}: {e}')
+            return None, None
+        sections = self.workflow.sections + self.workflow.auxiliary_sections
+        if len(steps) != len(sections):
+            return None, None
+        # steps are identified by uuids that are different for each run
+        uuids = dict(zip(steps, [x.uuid for x in sections]))
+        for node in dag.nodes():
+            node._step_uuid = uuids[node._step_uuid]
+        # shared variables are added to provides of steps during planning
+        for section, provide in zip(sections, provides):
+            if provide is not None:
+                section.options['provides'] = provide
+        self.reset_dict()
+        env.logger.debug(f'Use DAG of workflow {self.workflow.name} saved in {cache_file}')
+        dag.save(env.config['output_dag'])
+        return dag, planned
+
     def describe_completed(self):
         # return a string to summarize completed and skipped steps, substeps, and tasks
         res = []
@@ -846,6 +1046,7 @@ class Base_Executor:
                 f'Unacceptable value for parameter shared: {option}')
         return {x: env.sos_dict[x] for x in svars if x in env.sos_dict and pickleable(env.sos_dict[x], x)}
 
+    @traced
     def finalize_and_report(self):
         # remove task pending status if the workflow is completed normally
         if self.workflow.name != 'scratch':
@@ -886,6 +1087,8 @@ class Base_Executor:
 
     def run_as_master(self, targets=None, mode=None) -> Dict[str, Any]:
         self.completed = defaultdict(int)
+        # directory listings are reused only within a run
+        invalidate_dir_listing()
 
         self.write_workflow_info()
 
@@ -915,8 +1118,15 @@ class Base_Executor:
             env.logger.warning(
                 f'Failed to remove existing DAG file {env.config["output_dag"]}: {e}')
 
-        # process step of the pipelinp
-        dag = self.initialize_dag(targets=targets)
+        # process step of the pipelinp, or use the DAG of a previous run
+        dag, planned = self.load_dag(targets)
+        if dag is None:
+            recorded = record_glob_dirs(self._glob_dirs)
+            try:
+                dag = self.initialize_dag(targets=targets)
+            finally:
+                record_glob_dirs(recorded)
+            planned = self.snapshot_dag(dag)
         #
         manager = ExecutionManager(env.config['max_procs'])
         #
@@ -1008,8 +1218,9 @@ class Base_Executor:
                     # if we does get the result, we send the process to pool
                     manager.mark_idle(idx)
 
-                    env.logger.debug(
-                        f'{i_am()} receive a result {short_repr(res)}')
+                    if env.verbosity > 2:
+                        env.logger.debug(
+                            f'{i_am()} receive a result {short_repr(res)}')
                     if hasattr(runnable, '_from_nested'):
                         # if the runnable is from nested, we will need to send the result back to the workflow
                         env.logger.debug(f'{i_am()} send res to nested')
@@ -1127,8 +1338,7 @@ class Base_Executor:
                         runnable._from_nested = True
                         runnable._child_socket = env.zmq_context.socket(
                             zmq.PAIR)
-                        runnable._child_socket.connect(
-                            f'tcp://127.0.0.1:{port}')
+                        runnable._child_socket.connect(endpoint(port))
 
                         env.logger.debug(
                             f'{i_am()} sends {section.step_name()} from step queue with args {args} and context {context}')
@@ -1210,7 +1420,9 @@ class Base_Executor:
                                   RuntimeError(
                                       f'{len(sections)} pending step{"s" if len(sections) > 1 else ""}: {", ".join(sections)}'))
             raise exec_error
-        elif 'pending_tasks' not in wf_result or not wf_result['pending_tasks']:
+        if planned is not None:
+            self.save_dag(targets, planned, dag)
+        if 'pending_tasks' not in wf_result or not wf_result['pending_tasks']:
             self.finalize_and_report()
         else:
             # exit with pending tasks
@@ -1274,8 +1486,9 @@ class Base_Executor:
                             f'Nested workflow is not supposed to receive task, workflow, or step requests. {res} received.')
 
                     manager.mark_idle(idx)
-                    env.logger.debug(
-                        f'{i_am()} receive a result {short_repr(res)}')
+                    if env.verbosity > 2:
+                        env.logger.debug(
+                            f'{i_am()} receive a result {short_repr(res)}')
                     if isinstance(res, (UnknownTarget, RemovedTarget)):
                         self.handle_unknown_target(res, dag, runnable)
                     elif isinstance(res, UnavailableLock):
@@ -1355,7 +1568,7 @@ class Base_Executor:
                     parent_socket.send_pyobj(f'step {step_id}')
 
                     socket = env.zmq_context.socket(zmq.PAIR)
-                    port = socket.bind_to_random_port('tcp://127.0.0.1')
+                    port = bind_to_random_endpoint(socket)
                     parent_socket.send_pyobj((section, runnable._context, shared, self.args,
                                               env.config, env.verbosity, port))
                     # this is a real step
@@ -5,6 +5,7 @@
 
 import os
 import subprocess
+import time
 import unittest
 from io import StringIO
 
@@ -1164,6 +1165,232 @@ c_20 -> b_20;
 }
 ''')
 
+    def testGlobalDefExecutedOnce(self):
+        '''Test global definition is executed once for the analysis of steps'''
+        if os.path.isfile('global_def.txt'):
+            os.remove('global_def.txt')
+        self.temp_files.append('global_def.txt')
+        script = SoS_Script('''
+[global]
+with open('global_def.txt', 'a') as cnt:
+    cnt.write('x')
+files = [f'g{i}.txt' for i in range(3)]
+
+[step_10: provides='g0.txt']
+_output.touch()
+
+[step_20: provides='g1.txt']
+depends: 'g0.txt'
+_output.touch()
+
+[step_30: provides='g2.txt']
+depends: 'g1.txt'
+_output.touch()
+
+[default]
+depends: files
+''')
+        wf = script.workflow()
+        dag = Base_Executor(wf).initialize_dag()
+        self.assertEqual(dag.number_of_nodes(), 4)
+        # once by the executor, once with and once without parameters
+        with open('global_def.txt') as cnt:
+            self.assertEqual(cnt.read(), 'xxx')
+
+    def testGlobalDefCache(self):
+        '''Test variables restored from executed global definitions'''
+        from sos.section_analyzer import _assigned_names, execute_global_def
+        self.assertEqual(_assigned_names('import os.path\na = [1]\ndef f():\n    b = 1\n'),
+                         {'os', 'a', 'f'})
+        # names that could be created indirectly
+        for script in ('def f():\n    global b\n    b = 1\nf()\n', "exec('b = 1')\n",
+                       "globals()['b'] = 1\n", 'from os.path import *\n'):
+            self.assertIsNone(_assigned_names(script))
+        # restored variables are copies of the cached ones
+        global_def = 'import os\ngdc = [1]\ngdm = {"os": os}\n'
+        for i in range(3):
+            execute_global_def(global_def)
+            self.assertEqual(env.sos_dict['gdc'], [1])
+            self.assertTrue(env.sos_dict['gdm']['os'] is os)
+            env.sos_dict['gdc'].append(2)
+
+    def testAnalysisOfIndependentSteps(self):
+        '''Test analysis of steps with and without default input'''
+        script = SoS_Script('''
+def value(x):
+    return x
+
+[A_1]
+input: value([])
+output: 'ca1.txt'
+
+[A_2]
+input: value(['ca1.txt'])
+
+[A_3]
+input: value([])
+output: value('ca3.txt')
+
+[A_4]
+input: group_by=1
+output: 'ca4.txt'
+''')
+        wf = script.workflow('A')
+        dag = Base_Executor(wf).initialize_dag()
+        self.assertDAG(dag, '''
+strict digraph "" {
+A_1;
+A_4;
+A_2;
+A_3;
+A_1 -> A_2;
+A_2 -> A_3;
+A_3 -> A_4;
+}
+''')
+
+    def testPrefetchAnalysis(self):
+        '''Test analysis of independent steps in forked processes'''
+        from unittest import mock
+        import sos.section_analyzer as sa
+        analyzed = []
+        analyze_statements = sa._analyze_statements
+
+        def record(section, *args):
+            analyzed.append((section.step_name(), os.getpid()))
+            return analyze_statements(section, *args)
+
+        script = SoS_Script('''
+import os
+pids = set()
+def value(x):
+    pids.add(os.getpid())
+    return x
+
+[A_1]
+input: value([])
+output: 'pa1.txt'
+
+[A_2]
+input: value(['pa1.txt'])
+
+[A_3]
+input: value([])
+output: value('pa3.txt')
+
+[A_4]
+input: group_by=1
+output: 'pa4.txt'
+''')
+        wf = script.workflow('A')
+        with mock.patch('sos.section_analyzer._analyze_statements', record):
+            dag = Base_Executor(wf).initialize_dag()
+        # only the step that depends on its previous step is analyzed here,
+        # as a forward-style step and as an auxiliary step
+        self.assertEqual(analyzed, [('A_4', os.getpid())] * 2)
+        self.assertDAG(dag, '''
+strict digraph "" {
+A_1;
+A_4;
+A_2;
+A_3;
+A_1 -> A_2;
+A_2 -> A_3;
+A_3 -> A_4;
+}
+''')
+        # steps were not analyzed in the current process
+        self.assertNotIn(os.getpid(), env.sos_dict.get('pids', set()))
+
+    def testDAGCache(self):
+        '''Test reuse of the DAG of unchanged workflows'''
+        import shutil
+        from sos.workflow_executor import dag_cache_dir
+        for f in ('dc0.txt', 'dc1.txt'):
+            if os.path.isfile(f):
+                os.remove(f)
+        self.temp_files.extend(['dc0.txt', 'dc1.txt'])
+        planned = []
+
+        class Executor(Base_Executor):
+            def initialize_dag(self, *args, **kwargs):
+                planned.append(1)
+                return super(Executor, self).initialize_dag(*args, **kwargs)
+
+        script = SoS_Script('''
+parameter: a = 0
+
+[dc_0: provides='dc0.txt', shared='dc']
+dc = 1
+_output.touch()
+
+[default]
+depends: 'dc0.txt', sos_variable('dc')
+output: 'dc1.txt'
+_output.touch()
+''')
+        cfg = {'dag_cache': True}
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 1)
+        # DAG is reused if nothing has been changed
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 1)
+        # DAG is planned again if a file used by the DAG is changed
+        time.sleep(0.01)
+        with open('dc0.txt', 'w') as dc:
+            dc.write('changed')
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 2)
+        # or if the parameters are changed
+        Executor(script.workflow(), args=['--a', '1'], config=cfg).run()
+        self.assertEqual(len(planned), 3)
+        # or if the cache is not enabled
+        Executor(script.workflow()).run()
+        self.assertEqual(len(planned), 4)
+        # saved DAGs are removed with signatures
+        self.assertTrue(os.listdir(dag_cache_dir(os.getcwd())))
+        subprocess.call('sos remove -s', shell=True)
+        self.assertFalse(os.path.isdir(dag_cache_dir(os.getcwd())))
+        # DAGs that depend on targets other than files are not saved
+        script = SoS_Script('''
+[default]
+depends: executable('ls')
+output: 'dc1.txt'
+_output.touch()
+''')
+        Executor(script.workflow(), config=cfg).run()
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 6)
+        # or global definitions that read files
+        script = SoS_Script('''
+with open('dc0.txt') as dc:
+    content = dc.read()
+
+[default]
+output: 'dc1.txt'
+_output.touch()
+''')
+        Executor(script.workflow(), config=cfg).run()
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 8)
+        # new files matching a pattern that matched nothing invalidate the DAG
+        if os.path.isdir('dc_dir'):
+            shutil.rmtree('dc_dir')
+        os.mkdir('dc_dir')
+        script = SoS_Script('''
+[default]
+input: paths('dc_dir/*.txt')
+output: 'dc1.txt'
+_output.touch()
+''')
+        Executor(script.workflow(), config=cfg).run()
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 9)
+        with open(os.path.join('dc_dir', 'dc2.txt'), 'w') as dc:
+            dc.write('new')
+        Executor(script.workflow(), config=cfg).run()
+        self.assertEqual(len(planned), 10)
+        shutil.rmtree('dc_dir')
 
 if __name__ == '__main__':
     unittest.main()
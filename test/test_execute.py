@@ -1266,6 +1266,349 @@ path(f'{random.randint(0, 1000000)}.dout').touch()
         douts = glob.glob('*.dout')
         self.assertEqual(len(douts), 3)
 
+    def testRecycleSubstepWorkers(self):
+        '''Test the retirement of substep workers after max_substeps_per_worker substeps'''
+        for i in range(5):
+            if os.path.isfile(f'recycle_{i}.txt'):
+                os.remove(f'recycle_{i}.txt')
+        script = SoS_Script('''
+input: for_each={'i': range(5)}, concurrent=True
+output: f'recycle_{i}.txt'
+with open(_output, 'w') as out:
+    out.write(str(os.getpid()))
+''')
+        wf = script.workflow()
+        Base_Executor(wf, config={'max_substeps_per_worker': 1, 'sig_mode': 'force'}).run()
+        pids = set()
+        for i in range(5):
+            with open(f'recycle_{i}.txt') as res:
+                pids.add(res.read())
+            os.remove(f'recycle_{i}.txt')
+        # each worker executes only one substep
+        self.assertEqual(len(pids), 5)
+
+    def testThrottledSubstepSubmission(self):
+        '''Test the execution of concurrent substeps with a low high-water mark'''
+        script = SoS_Script('''
+input: for_each={'i': range(10)}, concurrent=True
+output: f'throttle_{i}.txt'
+_output.touch()
+''')
+        wf = script.workflow()
+        Base_Executor(wf, config={'substep_queue_hwm': 2, 'sig_mode': 'force'}).run()
+        for i in range(10):
+            self.assertTrue(os.path.isfile(f'throttle_{i}.txt'))
+            os.remove(f'throttle_{i}.txt')
+
+    def testSocketTransport(self):
+        '''Test the execution of workflows with ipc and tcp transports'''
+        script = SoS_Script('''
+[1]
+input: for_each={'i': range(3)}, concurrent=True
+output: f'transport_{i}.txt'
+_output.touch()
+
+[2]
+output: 'transport_3.txt'
+_output.touch()
+''')
+        wf = script.workflow()
+        for transport in ('ipc', 'tcp'):
+            Base_Executor(wf, config={'socket_transport': transport, 'sig_mode': 'force'}).run()
+            for i in range(4):
+                self.assertTrue(os.path.isfile(f'transport_{i}.txt'))
+                os.remove(f'transport_{i}.txt')
+            # temporary directory for ipc sockets is removed
+            self.assertFalse(env.config['ipc_dir'])
+
+    def testTrace(self):
+        '''Test tracing of workflow execution'''
+        import json
+        if os.path.isfile('trace.json'):
+            os.remove('trace.json')
+        script = SoS_Script('''
+[1]
+input: for_each={'i': range(2)}, concurrent=True
+output: f'trace_{i}.txt'
+_output.touch()
+''')
+        wf = script.workflow()
+        Base_Executor(wf, config={'trace_file': 'trace.json', 'sig_mode': 'force'}).run()
+        with open('trace.json') as trace:
+            events = json.load(trace)['traceEvents']
+        names = {x['name'] for x in events}
+        for name in ('run_as_master', 'SoS_DAG.build', 'step', 'substep', 'exec'):
+            self.assertTrue(name in names)
+        # master, step worker, and substep workers
+        self.assertGreaterEqual(len({x['pid'] for x in events}), 3)
+        for i in range(2):
+            os.remove(f'trace_{i}.txt')
+        os.remove('trace.json')
+
+    def testCoalescedProgress(self):
+        '''Test the accounting of aggregated progress of substeps'''
+        from threading import Event
+        from sos.controller import Controller
+        controller = Controller(Event())
+        controller.handle_ctl_push_msg(['progress', 'substep_counts', 'a', 3, 0])
+        controller.handle_ctl_push_msg(['progress', 'substep_counts', 'a', 2, 4])
+        controller.handle_ctl_push_msg(['progress', 'substep_counts', 'b', 0, 5])
+        self.assertEqual(dict(controller._completed), {'a': 5})
+        self.assertEqual(dict(controller._ignored), {'a': 4, 'b': 5})
+
+    def testControllerMetrics(self):
+        '''Test histograms, counters and gauges of controller metrics'''
+        from sos.controller import ControllerMetrics
+        metrics = ControllerMetrics()
+        metrics.observe('signature_req:step', 0.0005)
+        metrics.observe('signature_req:step', 0.5)
+        metrics.incr('substeps_dispatched', 3)
+        metrics.set_gauge('substep_queue_depth', 10)
+        metrics.set_gauge('substep_queue_depth', 2)
+        text = metrics.render()
+        self.assertIn('sos_controller_latency_seconds_bucket{type="signature_req:step",le="0.001"} 1', text)
+        self.assertIn('sos_controller_latency_seconds_bucket{type="signature_req:step",le="+Inf"} 2', text)
+        self.assertIn('sos_controller_latency_seconds_count{type="signature_req:step"} 2', text)
+        self.assertIn('sos_controller_substeps_dispatched_total 3', text)
+        self.assertIn('sos_controller_substep_queue_depth 2', text)
+        self.assertIn('sos_controller_substep_queue_depth_max 10', text)
+        self.assertIn('signature_req:step', metrics.summary())
+
+    def testMetricsEndpoint(self):
+        '''Test serving controller metrics during the execution of workflow'''
+        import tempfile
+        metrics_dir = tempfile.mkdtemp()
+        metrics_endpoint = f'ipc://{metrics_dir}/metrics'
+        if os.path.isfile('metrics.txt'):
+            os.remove('metrics.txt')
+        script = SoS_Script(f'''
+[1]
+input: for_each=dict(i=range(4)), concurrent=True
+pass
+
+[2]
+import zmq
+socket = zmq.Context.instance().socket(zmq.REQ)
+socket.connect('{metrics_endpoint}')
+socket.send(b'metrics')
+with open('metrics.txt', 'w') as metrics:
+    metrics.write(socket.recv_string())
+socket.close()
+''')
+        wf = script.workflow()
+        try:
+            Base_Executor(wf, config={'sig_mode': 'force', 'metrics': True,
+                'metrics_endpoint': metrics_endpoint}).run()
+            with open('metrics.txt') as metrics:
+                text = metrics.read()
+            self.assertIn('sos_controller_substeps_dispatched_total 4', text)
+            self.assertIn('sos_controller_substep_queue_depth', text)
+            self.assertIn('type="substep_queue_wait"', text)
+        finally:
+            shutil.rmtree(metrics_dir)
+            if os.path.isfile('metrics.txt'):
+                os.remove('metrics.txt')
+
+    def testSplitControllers(self):
+        '''Test signatures and substeps handled by controller threads'''
+        import sos.workflow_executor
+        from sos.controller import Controller, SignatureController, stop_thread
+        controllers = []
+
+        class RecordedController(Controller):
+            def run(self):
+                controllers.append(self)
+                Controller.run(self)
+
+        script = SoS_Script('''
+[1]
+input: for_each=dict(i=range(4)), concurrent=True
+output: f'split_ctl_{i}.txt'
+_output.touch()
+''')
+        self.temp_files.extend([f'split_ctl_{i}.txt' for i in range(4)])
+        orig_controller = sos.workflow_executor.Controller
+        sos.workflow_executor.Controller = RecordedController
+        try:
+            wf = script.workflow()
+            res = Base_Executor(wf, config={'metrics': True}).run()
+            self.assertEqual(res['__completed__']['__substep_completed__'], 4)
+            # signatures saved by the first run are used by the second
+            res = Base_Executor(wf, config={'metrics': True}).run()
+            self.assertEqual(res['__completed__']['__substep_skipped__'], 4)
+        finally:
+            sos.workflow_executor.Controller = orig_controller
+        self.assertEqual(len(controllers), 2)
+        for controller in controllers:
+            # substeps are dispatched by substep broker, signatures are
+            # handled by signature controller
+            self.assertEqual(controller.metrics.counters['substeps_dispatched'], 4)
+            self.assertTrue(any(x.startswith('signature_req:')
+                for x in controller.metrics.histograms))
+            # all threads are joined after the completion of the workflow
+            self.assertFalse(controller.is_alive())
+            self.assertFalse(controller.signature_controller.is_alive())
+            self.assertFalse(controller.substep_broker.is_alive())
+        #
+        # stop_thread stops and joins a standalone signature controller
+        import threading
+        ready = threading.Event()
+        sig_controller = SignatureController(ready, controllers[0].metrics)
+        sig_controller.start()
+        ready.wait()
+        stop_thread(sig_controller)
+        self.assertFalse(sig_controller.is_alive())
+
+    def testLazySubsteps(self):
+        '''Test input groups and variables of substeps created on demand'''
+        from sos.step_executor import Base_Step_Executor, _SubstepVars
+        from sos.targets import sos_targets
+        ifiles = sos_targets(['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt'])
+        groups = Base_Step_Executor.handle_group_by(ifiles, 2)
+        self.assertFalse(isinstance(groups, list))
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[-1], sos_targets('e.txt'))
+        self.assertEqual([len(x) for x in groups], [2, 2, 1])
+        self.assertRaises(IndexError, groups.__getitem__, 3)
+        #
+        groups = Base_Step_Executor.handle_group_by(ifiles.slice([0, 1]), 'single')
+        groups, vars = Base_Step_Executor.handle_for_each(
+            [dict(i=[1, 2, 3]), dict(j=['a', 'b'])], groups, _SubstepVars(None, len(groups)))
+        self.assertEqual(len(groups), 12)
+        self.assertEqual(len(vars), 12)
+        # groups vary fastest, followed by values of the first loop
+        self.assertEqual([str(x) for x in groups[:4]], ['a.txt', 'b.txt', 'a.txt', 'b.txt'])
+        self.assertEqual(vars[0], {'i': 1, 'j': 'a'})
+        self.assertEqual(vars[3], {'i': 2, 'j': 'a'})
+        self.assertEqual(vars[6], {'i': 1, 'j': 'b'})
+        self.assertEqual(vars[-1], {'i': 3, 'j': 'b'})
+        # each substep gets its own dictionary
+        vars[0]['i'] = 10
+        self.assertEqual(vars[0]['i'], 1)
+        #
+        # results of concurrent substeps are collected as they arrive
+        script = SoS_Script('''
+[1]
+input: for_each=dict(i=range(20)), concurrent=True
+output: f'lazy_{i}.txt'
+_output.touch()
+
+[2]
+with open('lazy_out.txt', 'w') as out:
+    out.write(' '.join(str(x) for x in step_input))
+''')
+        self.temp_files.extend([f'lazy_{i}.txt' for i in range(20)] + ['lazy_out.txt'])
+        wf = script.workflow()
+        Base_Executor(wf).run()
+        with open('lazy_out.txt') as out:
+            self.assertEqual(out.read(), ' '.join(f'lazy_{i}.txt' for i in range(20)))
+        #
+        script = SoS_Script('''
+[1]
+input: for_each=dict(i=range(4)), concurrent=True
+if i == 2:
+    raise ValueError('failed substep')
+''')
+        wf = script.workflow()
+        self.assertRaises(Exception, Base_Executor(wf).run)
+        #
+        # output of substeps is written in the order of their indexes, and
+        # results of successful substeps are not kept
+        from io import StringIO
+        from unittest import mock
+        executor = Base_Step_Executor.__new__(Base_Step_Executor)
+        executor.proc_results = {}
+        executor._pending_indexes = []
+        executor._completed_output = []
+        for idx in range(3):
+            executor.add_pending(idx)
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            executor.fold_result(2, {'ret_code': 0, 'stdout': 'c'})
+            executor.fold_result(1, {'ret_code': 0, 'stdout': 'b'})
+            self.assertEqual(out.getvalue(), '')
+            executor.fold_result(0, {'ret_code': 0, 'stdout': 'a'})
+            self.assertEqual(out.getvalue(), 'abc')
+        self.assertEqual(executor.proc_results, {})
+
+    def testSubstepBuffers(self):
+        '''Test that only read-only buffers of substeps are sent without copying'''
+        try:
+            import numpy as np
+        except ImportError:
+            return
+        from unittest import mock
+        from sos.step_executor import Base_Step_Executor
+        executor = Base_Step_Executor.__new__(Base_Step_Executor)
+        executor._pending_substeps = 0
+        readonly = np.arange(3)
+        readonly.flags.writeable = False
+        writable = np.arange(3)
+        with mock.patch.object(env, 'substep_frontend_socket', create=True) as socket:
+            executor.submit_substep({}, [memoryview(readonly), memoryview(writable)])
+        frames = socket.send_multipart.call_args[0][0]
+        self.assertTrue(frames[1].obj is readonly)
+        writable[0] = 10
+        self.assertEqual(np.frombuffer(frames[2], dtype=writable.dtype)[0], 0)
+
+    def testForEachChunks(self):
+        '''Test for_each over arrays and pandas objects read in chunks'''
+        try:
+            import numpy as np
+            import pandas as pd
+        except ImportError:
+            return
+        import sos.step_executor
+        from sos.step_executor import Base_Step_Executor, _SubstepVars
+        from sos.targets import sos_targets
+        chunk_size = sos.step_executor._for_each_chunk_size
+        sos.step_executor._for_each_chunk_size = 3
+        try:
+            series = pd.Series(pd.date_range('2020-01-01', periods=8), index=list('abcdefgh'))
+            data = pd.DataFrame({'A': range(8)})
+            groups, vars = Base_Step_Executor.handle_for_each(
+                [dict(t=series, a=np.arange(8) * 2, d=data)], [sos_targets()],
+                _SubstepVars(None, 1))
+            self.assertEqual(len(vars), 8)
+            for idx in (0, 4, 7, 2, 3):
+                self.assertEqual(vars[idx]['t'], series.iloc[idx])
+                self.assertEqual(vars[idx]['a'], idx * 2)
+                self.assertEqual(vars[idx]['d']['A'], idx)
+        finally:
+            sos.step_executor._for_each_chunk_size = chunk_size
+        # objects without length or that cannot be indexed are not accepted
+        self.assertRaises(ValueError, Base_Step_Executor.handle_for_each,
+            [dict(a={'x': 1})], [sos_targets()], _SubstepVars(None, 1))
+        self.assertRaises(ValueError, Base_Step_Executor.handle_for_each,
+            [dict(a=set([1, 2]))], [sos_targets()], _SubstepVars(None, 1))
+        #
+        script = SoS_Script('''
+import numpy as np
+values = np.arange(5)
+total = 0
+
+[1: shared='total']
+input: for_each='values'
+total += int(_values)
+''')
+        wf = script.workflow()
+        Base_Executor(wf).run()
+        self.assertEqual(env.sos_dict['total'], 10)
+        #
+        # rows of data frames are passed as series
+        script = SoS_Script('''
+import pandas as pd
+data = pd.DataFrame({'A': range(5), 'B': list('abcde')}, index=list('vwxyz'))
+rows = []
+
+[1: shared='rows']
+input: for_each='data'
+rows.append((_data.name, int(_data['A']), _data['B']))
+''')
+        wf = script.workflow()
+        Base_Executor(wf).run()
+        self.assertEqual(env.sos_dict['rows'],
+            [('v', 0, 'a'), ('w', 1, 'b'), ('x', 2, 'c'), ('y', 3, 'd'), ('z', 4, 'e')])
+
     def testGroupByWithEmtpyInput(self):
         ''' Test option group by with empty input #1044'''
         script = SoS_Script('''
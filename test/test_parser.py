@@ -5,6 +5,7 @@
 
 import os
 import subprocess
+import shutil
 import unittest
 
 from sos.parser import ParsingError, SoS_Script
@@ -1484,6 +1485,61 @@ res1 = tt.gv
         self.assertEqual(env.sos_dict['res1'], 1)
         os.remove('inc.sos')
 
+    def testParsedScriptCache(self):
+        '''Test reuse and invalidation of cached parsed scripts'''
+        for name, content in [('cache_inc.sos', '%include cache_nested\ngv = 1\n[A]\n'),
+                              ('cache_nested.sos', 'nv = 1\n[B]\n')]:
+            with open(name, 'w') as ts:
+                ts.write(content)
+        self.temp_files.extend(['cache_inc.sos', 'cache_nested.sos'])
+        script = SoS_Script('%include cache_inc\n[0]\n')
+        self.assertEqual(script._included_files,
+                         [os.path.abspath('cache_inc.sos'), os.path.abspath('cache_nested.sos')])
+        # parsed from cache, with a new copy of sections
+        script1 = SoS_Script('%include cache_inc\n[0]\n')
+        self.assertEqual(script1.workflows, script.workflows)
+        self.assertEqual(script1.global_def, script.global_def)
+        self.assertFalse(script1.sections[0] is script.sections[0])
+        # change of files included indirectly invalidates the cache
+        with open('cache_nested.sos', 'w') as ts:
+            ts.write('nv = 2\n[C]\n')
+        script2 = SoS_Script('%include cache_inc\n[0]\n')
+        self.assertIn('cache_inc.cache_nested.C', script2.workflows)
+        self.assertNotIn('cache_inc.cache_nested.B', script2.workflows)
+        self.assertIn('nv = 2', script2.global_def)
+        # the cache is invalid if a new file shadows an included file
+        os.makedirs('cache_dir', exist_ok=True)
+        with open(os.path.join('cache_dir', 'cache_main.sos'), 'w') as ts:
+            ts.write('%include cache_shadow\n[0]\n')
+        with open(os.path.join('cache_dir', 'cache_shadow.sos'), 'w') as ts:
+            ts.write('[D]\n')
+        try:
+            script = SoS_Script(filename=os.path.join('cache_dir', 'cache_main.sos'))
+            self.assertIn('cache_shadow.D', script.workflows)
+            # files in the current directory are searched before the
+            # directory of the script
+            with open('cache_shadow.sos', 'w') as ts:
+                ts.write('[E]\n')
+            self.temp_files.append('cache_shadow.sos')
+            script = SoS_Script(filename=os.path.join('cache_dir', 'cache_main.sos'))
+            self.assertIn('cache_shadow.E', script.workflows)
+            self.assertNotIn('cache_shadow.D', script.workflows)
+        finally:
+            shutil.rmtree('cache_dir')
+
+    def testParsedScriptCacheSize(self):
+        '''Test removal of least recently used parsed scripts'''
+        from unittest import mock
+        import sos.parser
+        with mock.patch('sos.parser._max_parse_cache', 2), \
+                mock.patch('sos.parser._max_parsed_scripts', 3):
+            cache_files = [SoS_Script(f'cache_size = {idx}\n[{idx}]\n')._parse_cache_file()
+                           for idx in range(5)]
+            self.assertEqual(list(sos.parser._parse_cache), cache_files[3:])
+            # the most recently saved scripts are kept
+            self.assertEqual([os.path.isfile(x) for x in cache_files],
+                             [False, False, True, True, True])
+
     def testFromInclude(self):
         '''Test include keyword'''
         with open('inc.sos', 'w') as ts:
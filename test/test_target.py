@@ -11,8 +11,8 @@ import unittest
 
 from sos.eval import interpolate
 from sos.parser import SoS_Script
-from sos.targets import file_target, path, paths, sos_targets
-from sos.utils import env
+from sos.targets import file_target, path, paths, sos_step, sos_targets
+from sos.utils import env, invalidate_dir_listing
 from sos.workflow_executor import Base_Executor
 
 
@@ -91,6 +91,71 @@ class TestTarget(unittest.TestCase):
         for idx, i in enumerate(t):
             self.assertEqual(str(i), str(idx + 1))
 
+    def testCopyTargets(self):
+        '''Test that copies of sos_targets share targets until changed'''
+        import copy
+        a = sos_targets('a.txt', 'b.txt', source='step')
+        b = copy.deepcopy(a)
+        self.assertEqual(a, b)
+        self.assertTrue(a._targets is b._targets)
+        b.extend('c.txt')
+        self.assertEqual(len(a), 2)
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b._sources, ['step', 'step', ''])
+        a.extend(['d.txt', 'e.txt'])
+        self.assertEqual(len(a), 4)
+        self.assertEqual(len(b), 3)
+
+    def testCompactTargets(self):
+        '''Test compact representation and pickling of file targets'''
+        import pickle
+        # file targets do not have a dictionary
+        self.assertFalse(hasattr(file_target('a.txt'), '__dict__'))
+        a = sos_targets({'s1': ['a.txt', 'b.txt'], 's2': 'c.txt'})
+        self.assertEqual(a.__getstate__()[:3],
+            ('file_target', ['a.txt', 'b.txt', 'c.txt'], ['s1', 's1', 's2']))
+        b = pickle.loads(pickle.dumps(a))
+        self.assertEqual(b, a)
+        self.assertEqual(b.sources, ['s1', 's1', 's2'])
+        self.assertTrue(all(isinstance(x, file_target) for x in b))
+        # same sources are saved only once
+        a = sos_targets([f'{x}.txt' for x in range(10)], source='s')
+        self.assertEqual(a.__getstate__()[2], 's')
+        self.assertEqual(pickle.loads(pickle.dumps(a)).sources, ['s'] * 10)
+        # sos_targets with other targets
+        a = sos_targets('a.txt', sos_step('b'), undetermined=False)
+        b = pickle.loads(pickle.dumps(a))
+        self.assertEqual(b, a)
+        self.assertTrue(b.valid())
+        self.assertEqual(sos_targets().__getstate__()[0], 'file_target')
+        self.assertFalse(pickle.loads(pickle.dumps(sos_targets())).valid())
+
+    def testTargetsIndex(self):
+        '''Test membership and deduplication of targets'''
+        import copy
+        a = sos_targets('a.txt', 'b.txt', sos_step('a'), source='step')
+        self.assertTrue(file_target('a.txt') in a)
+        self.assertTrue(file_target(os.path.abspath('b.txt')) in a)
+        self.assertTrue(sos_step('a') in a)
+        self.assertFalse(file_target('c.txt') in a)
+        self.assertFalse(sos_step('b') in a)
+        b = copy.deepcopy(a)
+        b.extend('c.txt')
+        self.assertTrue(file_target('c.txt') in b)
+        self.assertFalse(file_target('c.txt') in a)
+        #
+        a.extend(sos_targets(os.path.abspath('a.txt'), 'd.txt', 'b.txt', source='other'))
+        self.assertEqual(len(a), 6)
+        a.dedup()
+        self.assertEqual(a, ['a.txt', 'b.txt', sos_step('a'), 'd.txt'])
+        self.assertEqual(a.sources, ['step', 'step', 'step', 'other'])
+        self.assertTrue(file_target('d.txt') in a)
+        self.assertFalse([] in a)
+        # equal targets have the same hash
+        self.assertEqual(hash(sos_targets('a.txt', sos_step('a'))),
+                         hash(sos_targets(os.path.abspath('a.txt'), sos_step('a'))))
+        self.assertEqual(len({a, copy.deepcopy(a), b}), 2)
+
     def testExpandWildcard(self):
         '''test wildcard expansion of sos_targets'''
         a = sos_targets('*.py')
@@ -458,6 +523,69 @@ run:
         self.assertTrue(os.path.isfile('testzap1.txt.zapped'))
         self.assertFalse(os.path.isfile('testzap1.txt'))
 
+    def testZapPool(self):
+        '''Test zapping files in the background and reusing their md5'''
+        import time
+        from unittest import mock
+        import sos.targets
+        from sos.targets import ZapPool
+        from sos.utils import glob_files, is_zapped, _listing_cache
+        if os.path.isdir('zap_pool'):
+            shutil.rmtree('zap_pool')
+        os.mkdir('zap_pool')
+        files = [os.path.join('zap_pool', f'f{i}.txt') for i in range(10)]
+        for f in files:
+            with open(f, 'w') as sf:
+                sf.write(f)
+        pool = ZapPool(2)
+        try:
+            sos_targets(files[:5]).zap(pool)
+            pool.wait()
+        finally:
+            pool.shutdown()
+        # files are zapped by a pool before zap() returns
+        paths(files[5:]).zap()
+        for f in files:
+            self.assertFalse(os.path.isfile(f))
+            self.assertTrue(os.path.isfile(f + '.zapped'))
+        # errors of zapping are raised by wait
+        pool = ZapPool(1)
+        pool.submit(path(os.path.join('zap_pool', 'nonexistent.txt')))
+        self.assertRaises(FileNotFoundError, pool.wait)
+        pool.shutdown()
+        #
+        # md5 calculated for the signature of the file is not calculated again
+        target = file_target(os.path.join('zap_pool', 'sig.txt'))
+        with open(target, 'w') as sf:
+            sf.write('some text')
+        md5 = target.target_signature()[2]
+        fileMD5 = sos.targets.fileMD5
+        sos.targets.fileMD5 = None
+        try:
+            target.zap()
+        finally:
+            sos.targets.fileMD5 = fileMD5
+        with open(os.path.join('zap_pool', 'sig.txt.zapped')) as sig:
+            self.assertEqual(sig.read().strip().rsplit('\t', 1)[-1], md5)
+        self.assertEqual(target.target_signature()[2], md5)
+        #
+        # .zapped files are looked up in cached directory listings
+        old = time.time() - 100
+        os.utime('zap_pool', (old, old))
+        glob_files(os.path.join('zap_pool', '*.txt'))
+        self.assertIn(os.path.abspath('zap_pool'), _listing_cache)
+        with mock.patch('os.path.isfile', side_effect=AssertionError):
+            self.assertTrue(is_zapped(files[0]))
+            self.assertTrue(file_target(files[1]).target_exists())
+        # files that are not in the listing are checked directly
+        self.assertFalse(is_zapped(os.path.join('zap_pool', 'f10.txt')))
+        with open(os.path.join('zap_pool', 'f10.txt.zapped'), 'w') as sf:
+            sf.write('zapped')
+        self.assertTrue(is_zapped(os.path.join('zap_pool', 'f10.txt')))
+        shutil.rmtree('zap_pool')
+        invalidate_dir_listing()
+        self.assertFalse(is_zapped(files[0]))
+
     def testZapRun(self):
         '''Test run with zapped input files'''
         with open('zap1.txt', 'w') as sf:
@@ -510,6 +638,41 @@ a = 1
         wf = script.workflow()
         self.assertRaises(Exception, Base_Executor(wf).run)
 
+    def testDirListingCache(self):
+        '''Test reuse and invalidation of cached directory listings'''
+        import sos.utils
+        shutil.rmtree('temp_listing', ignore_errors=True)
+        os.makedirs('temp_listing/sub')
+        for f in ['temp_listing/a.txt', 'temp_listing/b.txt', 'temp_listing/sub/c.txt']:
+            with open(f, 'w') as out:
+                out.write('test')
+        mtime = os.path.getmtime('temp_listing') - 100
+        os.utime('temp_listing', (mtime, mtime))
+        self.assertEqual(len(sos_targets('temp_listing/*.txt')), 2)
+        self.assertEqual(len(paths('temp_listing/*/*.txt')), 1)
+        # a listing is listed again if a file is written by SoS, even if
+        # the directory appears unchanged (e.g. on network file systems)
+        with open('temp_listing/d.txt', 'w') as out:
+            out.write('test')
+        os.utime('temp_listing', (mtime, mtime))
+        invalidate_dir_listing(['temp_listing/d.txt'])
+        self.assertEqual(len(sos_targets('temp_listing/*.txt')), 3)
+        # or if the listing is older than its time to live
+        with open('temp_listing/e.txt', 'w') as out:
+            out.write('test')
+        os.utime('temp_listing', (mtime, mtime))
+        ttl = sos.utils._listing_ttl
+        sos.utils._listing_ttl = 0
+        try:
+            self.assertEqual(len(sos_targets('temp_listing/*.txt')), 4)
+        finally:
+            sos.utils._listing_ttl = ttl
+        os.remove('temp_listing/e.txt')
+        # or the directory is changed
+        os.remove('temp_listing/d.txt')
+        self.assertEqual(len(sos_targets('temp_listing/*.txt')), 2)
+        shutil.rmtree('temp_listing')
+
 
 if __name__ == '__main__':
     unittest.main()
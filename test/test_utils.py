@@ -14,7 +14,7 @@ from sos.pattern import expand_pattern, extract_pattern
 from sos.targets import executable, sos_targets, file_target, sos_step
 # these functions are normally not available but can be imported
 # using their names for testing purposes
-from sos.utils import WorkflowDict, env, logger, stable_repr
+from sos.utils import WorkflowDict, env, logger, stable_repr, unpickle_vars
 from sos.workflow_executor import analyze_section
 from sos.workflow_executor import Base_Executor
 
@@ -63,6 +63,149 @@ class TestUtils(unittest.TestCase):
         d['a'] += 1
         self.assertEqual(d['a'], 2)
 
+    def testPickleSelectedVars(self):
+        '''Test pickling of selected variables of workflow dict'''
+        d = WorkflowDict()
+        d.set('a', 1)
+        d.set('b', sos_targets('a.txt'))
+        d.set('c', lambda x: x)
+        d.set('d', bytearray(b'abc'))
+        vars, buffers = d.pickle_selected_vars({'a', 'b', 'c', 'd'})
+        # functions are not passed
+        self.assertEqual(set(vars.keys()), {'a', 'b', 'd'})
+        res = unpickle_vars(vars, buffers)
+        self.assertEqual(res['a'], 1)
+        self.assertEqual(res['b'], sos_targets('a.txt'))
+        self.assertEqual(res['d'], bytearray(b'abc'))
+        # variables without out-of-band buffers
+        self.assertEqual(unpickle_vars({'a': vars['a']}), {'a': 1})
+
+    def testLazyLogging(self):
+        '''Test that values are not formatted for logging at default verbosity'''
+        class Expensive:
+            n_repr = 0
+
+            def __repr__(self):
+                Expensive.n_repr += 1
+                return 'Expensive()'
+
+            def __short_repr__(self):
+                return repr(self)
+
+        d = WorkflowDict()
+        env.verbosity = 1
+        d.set('a', Expensive())
+        d['b'] = Expensive()
+        d.update({'c': Expensive()})
+        self.assertEqual(Expensive.n_repr, 0)
+        # values are formatted for trace messages
+        env.verbosity = 4
+        d.set('a', Expensive())
+        self.assertGreater(Expensive.n_repr, 0)
+
+    def testLazyPlugins(self):
+        '''Test the plugin index and lazy loading of plugins by sos.runtime'''
+        import subprocess
+        from sos.utils import get_plugin_index, load_plugin
+        from sos.targets import file_target as ft
+        index = get_plugin_index()
+        self.assertIn('run', index['sos_actions'])
+        self.assertIs(load_plugin(index['sos_targets']['file_target'][0]), ft)
+        # plugins are not imported until they are used
+        res = subprocess.check_output([sys.executable, '-c',
+            'import sys, sos.runtime as rt; print("sos.actions_r" in sys.modules); '
+            'rt.R.__name__; print("sos.actions_r" in sys.modules)']).decode().split()
+        self.assertEqual(res, ['False', 'True'])
+        # targets are loaded as classes that can be checked and subclassed
+        import sos.runtime as rt
+        from sos.targets import BaseTarget
+        self.assertTrue(issubclass(rt.executable, BaseTarget))
+        self.assertIsInstance(rt.file_target('a.txt'), ft)
+
+        class my_target(rt.file_target):
+            pass
+        self.assertIsInstance(my_target('a.txt'), BaseTarget)
+
+    def testImportTime(self):
+        '''Test that commands such as sos execute do not import heavy modules'''
+        import subprocess
+        res = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            'import sys, sos.__main__, sos.tasks, sos.task_executor, sos.hosts; '
+            'print(" ".join(x for x in ("pkg_resources", "networkx", "pydot", "pexpect", '
+            '"tqdm", "yaml") if x in sys.modules))'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, check=True)
+        self.assertEqual(res.stdout.decode().strip(), '')
+        # cumulative import time of the modules in microseconds
+        import_time = sum(int(line.split('|')[1]) for line in res.stderr.decode().splitlines()
+            if line.startswith('import time:') and line.split('|')[-1].strip() in
+            ('sos.__main__', 'sos.tasks', 'sos.task_executor', 'sos.hosts'))
+        self.assertLess(import_time, 1000000)
+
+    def testConfigCache(self):
+        '''Test caching of merged configuration files'''
+        import glob
+        import time
+        import sos.utils
+        from sos.utils import load_config_files
+        with open('test_cache.yml', 'w') as config:
+            config.write('a: 1\n')
+        self.assertEqual(load_config_files('test_cache.yml')['a'], 1)
+        # cached configuration is returned without parsing the files
+        parse_config = sos.utils._load_config_files
+        n_parsed = []
+        sos.utils._load_config_files = lambda x: n_parsed.append(x) or parse_config(x)
+        try:
+            sos.utils._config_cache.clear()
+            cfg = load_config_files('test_cache.yml')
+            self.assertEqual(cfg['a'], 1)
+            self.assertEqual(n_parsed, [])
+            # the returned configuration is a copy
+            cfg['a'] = 5
+            self.assertEqual(load_config_files('test_cache.yml')['a'], 1)
+            # changed files are parsed again
+            time.sleep(0.01)
+            with open('test_cache.yml', 'w') as config:
+                config.write('a: 2\nb: 3\n')
+            cfg = load_config_files('test_cache.yml')
+            self.assertEqual((cfg['a'], cfg['b']), (2, 3))
+            self.assertEqual(len(n_parsed), 1)
+            # the cache is saved in a directory only accessible to the user
+            cache_dir = sos.utils.private_cache_dir('config')
+            self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            os.chmod(cache_dir, 0o777)
+            self.assertEqual(sos.utils.private_cache_dir('config'), cache_dir)
+            self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            # cache files owned by others are not loaded
+            if hasattr(os, 'getuid') and os.getuid() == 0:
+                for cache_file in glob.glob(os.path.join(cache_dir, '*.pkl')):
+                    os.chown(cache_file, 65534, -1)
+                sos.utils._config_cache.clear()
+                load_config_files('test_cache.yml')
+                self.assertEqual(len(n_parsed), 2)
+        finally:
+            sos.utils._load_config_files = parse_config
+            os.remove('test_cache.yml')
+
+    def testBenchmark(self):
+        '''Test running benchmarks with small workloads'''
+        from sos.benchmark import run_benchmarks
+        res = run_benchmarks(['dag_build', 'step_signatures'], scale=0.02, repeat=2)
+        self.assertEqual([x['name'] for x in res['benchmarks']], ['dag_build', 'step_signatures'])
+        for bench in res['benchmarks']:
+            self.assertEqual(len(bench['times']), 2)
+            self.assertGreater(bench['size'], 0)
+            self.assertGreater(bench['latency'], 0)
+        # benchmarks are run in temporary directories
+        self.assertFalse(os.path.isfile('f0.txt'))
+        # tasks of the benchmark are not saved to ~/.sos/tasks
+        home = os.environ['HOME']
+        task_dir = os.path.join(home, '.sos', 'tasks')
+        existing = set(os.listdir(task_dir)) if os.path.isdir(task_dir) else set()
+        res = run_benchmarks(['check_tasks'], scale=0.005, repeat=1)
+        self.assertEqual(res['benchmarks'][0]['size'], 5)
+        self.assertEqual(os.environ['HOME'], home)
+        self.assertEqual(set(os.listdir(task_dir)) if os.path.isdir(task_dir) else set(), existing)
+
     def testPatternMatch(self):
         '''Test snake match's pattern match facility'''
         res = extract_pattern('{a}-{b}.txt', ['file-1.txt', 'file-ab.txt'])
@@ -94,6 +237,25 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(expand_pattern('{a}_{c}.txt'), [
                          '100_file1.txt', '100_file2.txt', '100_file 3.txt'])
 
+    def testPatternMatchManyFiles(self):
+        '''Test extracting and expanding pattern with a large number of files'''
+        files = [f'sample{i}/read_{i % 2}.fastq' for i in range(20000)]
+        files.append('unmatched.txt')
+        res = extract_pattern('{sample}/read_{pair}.fastq', files)
+        self.assertEqual(len(res['sample']), 20001)
+        self.assertEqual(res['sample'][:2], ['sample0', 'sample1'])
+        self.assertEqual(res['pair'][:2], ['0', '1'])
+        self.assertEqual(res['sample'][-1], None)
+        self.assertEqual(res['pair'][-1], None)
+        #
+        env.sos_dict = WorkflowDict({
+            'sample': [f'sample{i}' for i in range(10000)],
+            'pair': 1,
+        })
+        res = expand_pattern('{sample}/read_{pair}.fastq')
+        self.assertEqual(len(res), 10000)
+        self.assertEqual(res[:2], ['sample0/read_1.fastq', 'sample1/read_1.fastq'])
+
     def testAccessedVars(self):
         '''Test accessed vars of a SoS expression or statement.'''
         self.assertEqual(accessed_vars('''a = 1'''), {'a'})